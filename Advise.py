@@ -0,0 +1,115 @@
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import os
+import mmap
+import ctypes
+import ctypes.util
+
+
+# madvise and posix_fadvise advice; Linux uses the same values for both
+NORMAL = 0
+RANDOM = 1
+SEQUENTIAL = 2
+WILLNEED = 3
+DONTNEED = 4
+
+NAMES = {
+	NORMAL : 'normal',
+	RANDOM : 'random',
+	SEQUENTIAL : 'sequential',
+	WILLNEED : 'willneed',
+	DONTNEED : 'dontneed',
+}
+
+PAGE_SZ = mmap.PAGESIZE
+
+
+def load_libc():
+	# Python 2 exposes neither madvise nor posix_fadvise
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library('c'),
+				   use_errno=True)
+		libc.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+					 ctypes.c_int]
+		libc.posix_fadvise.argtypes = [ctypes.c_int,
+					       ctypes.c_longlong,
+					       ctypes.c_longlong, ctypes.c_int]
+		libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+					 ctypes.c_char_p]
+	except (OSError, AttributeError, TypeError):
+		return None
+	return libc
+
+libc = load_libc()
+
+
+def map_address(map):
+	# address of an mmap object's mapping, or None; found through
+	# the buffer interface, which reads none of the mapped pages
+	if libc is None or not isinstance(map, mmap.mmap) or len(map) == 0:
+		return None
+	addr = ctypes.c_void_p()
+	n = ctypes.c_ssize_t()
+	try:
+		if ctypes.pythonapi.PyObject_AsReadBuffer(ctypes.py_object(map),
+				ctypes.byref(addr), ctypes.byref(n)) != 0:
+			return None
+	except (AttributeError, TypeError):
+		return None
+	return addr.value
+
+def madvise(addr, length, advice):
+	if libc is None or addr is None:
+		return False
+	return libc.madvise(addr, length, advice) == 0
+
+def fadvise(fd, offset, length, advice):
+	# length 0 means to the end of the file
+	if libc is None or fd is None:
+		return False
+	return libc.posix_fadvise(fd, offset, length, advice) == 0
+
+def resident(addr, length):
+	# bytes of the mapping in the page cache
+	if libc is None or addr is None or length == 0:
+		return 0
+	n_pages = (length + PAGE_SZ - 1) // PAGE_SZ
+	vec = ctypes.create_string_buffer(n_pages)
+	if libc.mincore(addr, length, vec) != 0:
+		return 0
+	return sum(ord(c) & 1 for c in vec.raw) * PAGE_SZ
+
+def file_resident(filename):
+	try:
+		fd = os.open(filename, os.O_RDONLY)
+	except OSError:
+		return 0
+	try:
+		if os.fstat(fd).st_size == 0:
+			return 0
+		map = mmap.mmap(fd, 0, mmap.MAP_SHARED, mmap.PROT_READ)
+	except (OSError, mmap.error):
+		return 0
+	finally:
+		os.close(fd)
+	n = resident(map_address(map), len(map))
+	map.close()
+	return n
+
+def evict(filename):
+	# drop a file's clean pages from the page cache, for cold reads
+	if libc is None:
+		return False
+	try:
+		fd = os.open(filename, os.O_RDONLY)
+	except OSError:
+		return False
+	ok = (libc.posix_fadvise(fd, 0, 0, DONTNEED) == 0)
+	os.close(fd)
+	return ok
+
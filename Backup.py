@@ -0,0 +1,158 @@
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import os
+import errno
+
+import Stats
+from util import trypread, trywrite, fsync_dir
+
+
+COPY_CHUNK = 1024 * 1024
+
+
+class Backup(object):
+	# places database files into a backup directory.  immutable
+	# files are taken from the directory itself if already present,
+	# else hard-linked from a previous backup or the database, and
+	# copied only when linking is impossible.
+	def __init__(self, dbdir, dest, incremental_from=None, stats=None):
+		self.dbdir = dbdir
+		self.dest = dest
+		self.incremental_from = incremental_from
+		if stats is None:
+			stats = Stats.Stats(False)
+		self.stats = stats
+
+	def open(self):
+		try:
+			os.mkdir(self.dest)
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				return False
+		return os.path.isdir(self.dest)
+
+	def copy(self, srcdir, name, size, tail=''):
+		# the first size bytes of srcdir/name, then tail, written
+		# to a temporary file and renamed into place
+		tmpname = self.dest + '/' + name + '.tmp'
+		try:
+			src_fd = os.open(srcdir + '/' + name, os.O_RDONLY)
+		except OSError:
+			return False
+		try:
+			fd = os.open(tmpname,
+				     os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+		except OSError:
+			os.close(src_fd)
+			return False
+
+		ok = True
+		pos = 0
+		while ok and pos < size:
+			data = trypread(src_fd, min(COPY_CHUNK, size - pos), pos)
+			if not data:
+				ok = False
+				break
+			ok = trywrite(fd, data)
+			pos += len(data)
+		os.close(src_fd)
+		if ok and tail:
+			ok = trywrite(fd, tail)
+
+		try:
+			os.fsync(fd)
+			os.close(fd)
+			if ok:
+				os.rename(tmpname, self.dest + '/' + name)
+			else:
+				os.unlink(tmpname)
+		except OSError:
+			return False
+
+		if ok:
+			self.stats.inc('backup.files_copied')
+			self.stats.inc('backup.bytes_copied', size)
+		return ok
+
+	def link(self, srcdir, name):
+		try:
+			os.link(srcdir + '/' + name, self.dest + '/' + name)
+		except OSError:
+			return False
+		self.stats.inc('backup.files_linked')
+		return True
+
+	def same(self, srcdir, name):
+		try:
+			f1 = open(srcdir + '/' + name, 'rb')
+			f2 = open(self.dbdir + '/' + name, 'rb')
+			try:
+				return f1.read() == f2.read()
+			finally:
+				f1.close()
+				f2.close()
+		except IOError:
+			return False
+
+	def add(self, name, check=False):
+		# an immutable file: same name, same contents.  with
+		# check, a copy already in dest or incremental_from is
+		# used only if its contents match: backups write root
+		# files under ids of their own, which the database may
+		# later use for a different root.
+		dest = self.dest + '/' + name
+		if os.path.exists(dest):
+			if not check or self.same(self.dest, name):
+				self.stats.inc('backup.files_present')
+				return True
+			try:
+				os.unlink(dest)
+			except OSError:
+				return False
+
+		try:
+			size = os.path.getsize(self.dbdir + '/' + name)
+		except OSError:
+			return False
+
+		if self.incremental_from is not None:
+			prev = self.incremental_from + '/' + name
+			if (os.path.exists(prev) and
+			    os.path.getsize(prev) == size and
+			    (not check or
+			     self.same(self.incremental_from, name)) and
+			    (self.link(self.incremental_from, name) or
+			     self.copy(self.incremental_from, name, size))):
+				return True
+
+		if self.link(self.dbdir, name):
+			return True
+		return self.copy(self.dbdir, name, size)
+
+	def add_prefix(self, name, size, tail=''):
+		# a file still being appended to, up to size
+		return self.copy(self.dbdir, name, size, tail)
+
+	def write_super(self, data):
+		# written last: a backup without a superblock is incomplete
+		tmpname = self.dest + '/super.tmp'
+		try:
+			fd = os.open(tmpname,
+				     os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+			ok = trywrite(fd, data)
+			os.fsync(fd)
+			os.close(fd)
+			if not ok:
+				os.unlink(tmpname)
+				return False
+			os.rename(tmpname, self.dest + '/super')
+		except OSError:
+			return False
+
+		return fsync_dir(self.dest)
+
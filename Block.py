@@ -7,18 +7,59 @@
 #
 
 import struct
+import zlib
 import os
 import mmap
 import random
+from multiprocessing.pool import ThreadPool
 
+import Advise
+import Bloom
+import KeyArray
 import PDcodec_pb2
-from util import trywrite, updcrc, readrecstr, writerecstr
+import Stats
+import ValueLog
+import BufferPool
+from util import trywrite, trypread, updcrc, readrecstr, writerecstr
 
 
 MIN_BLK_SZ = 1024
 TARGET_BLK_SZ = 4 * 1024 * 1024
 MAX_BLK_SZ = 16 * 1024 * 1024
 
+# blocks smaller than this fraction of TARGET_BLK_SZ are merged with
+# their underfilled neighbours
+MERGE_FILL = 0.25
+
+VERIFY_CHUNK = 1024 * 1024
+
+# max threads used by BlockManager.get_many
+OPEN_THREADS = 8
+
+
+def read_trailer(dbdir, file_id):
+	# (file size, key count), from the DTRL record alone; None if
+	# unreadable
+	try:
+		fd = os.open(dbdir + "/block.%x" % (file_id,), os.O_RDONLY)
+	except OSError:
+		return None
+	try:
+		size = os.fstat(fd).st_size
+		data = trypread(fd, 24, size - 24)
+	except OSError:
+		data = None
+	finally:
+		os.close(fd)
+
+	if data is None or len(data) != 24:
+		return None
+	tup = readrecstr(data[:20])
+	if tup is None or tup[0] != 'DTRL' or len(tup[1]) != 8:
+		return None
+	(arrpos, n_keys) = struct.unpack('<II', tup[1])
+	return (size, n_keys)
+
 
 class BlockIdx(object):
 	def __init__(self):
@@ -52,7 +93,7 @@ class BlockEnt(object):
 
 
 class Block(object):
-	def __init__(self, dbdir, file_id):
+	def __init__(self, dbdir, file_id, stats=None, hints=False):
 		self.dbdir = dbdir
 		self.fd = None
 		self.st = None
@@ -60,16 +101,45 @@ class Block(object):
 		self.file_id = file_id
 		self.n_keys = 0
 		self.arrpos = -1
+		self.bloom = None
+		self.keyarr = None
+
+		# whether to advise the kernel of access patterns; the
+		# mapping address, for madvise, and the pattern last advised
+		self.hints = hints
+		self.map_addr = None
+		self.access = None
+
+		if stats is None:
+			stats = Stats.Stats(False)
+		self.stats = stats
+
+		# outstanding BlockLeases; close is deferred until the
+		# last is released
+		self.leases = 0
+		self.close_pending = False
+		self.viewed = False
 
 	def __del__(self):
 		self.close()
 
 	def close(self):
+		if self.leases > 0:
+			self.close_pending = True
+			return
+		self.close_pending = False
+
+		self.map_addr = None
+		self.access = None
 		if self.map is not None:
-			try:
-				self.map.close()
-			except OSError:
-				pass
+			# once views into the map have been handed out, the
+			# mapping is left to be freed along with the last
+			# of them, rather than unmapped under them
+			if not self.viewed:
+				try:
+					self.map.close()
+				except OSError:
+					pass
 			self.map = None
 
 		if self.fd is not None:
@@ -87,10 +157,14 @@ class Block(object):
 			self.st = os.fstat(self.fd)
 			if (self.st.st_size > MAX_BLK_SZ):
 				return False
-			self.map = mmap.mmap(self.fd, 0, mmap.MAP_SHARED,
-					     mmap.PROT_READ)
+			self.mapfile()
 		except OSError:
 			return False
+		self.map_addr = Advise.map_address(self.map)
+
+		# header, index and trailer reads below are point reads;
+		# without the hint, each faults in a whole readahead window
+		self.advise(Advise.RANDOM)
 
 		# verify magic number header
 		if self.map[:8] != 'BLOCK   ':
@@ -107,8 +181,59 @@ class Block(object):
 		if self.st.st_size < (self.arrpos + (self.n_keys * 8)):
 			return False
 
+		# optional Bloom filter and key array, between DIDX and DTRL
+		pos = self.arrpos + (self.n_keys * 8) + 4
+		end = self.st.st_size - 24
+		while pos < end:
+			n = struct.unpack('<I', self.map[pos + 4:pos + 8])[0]
+			tup = readrecstr(self.map[pos:pos + 8 + n + 4])
+			if tup is None:
+				return False
+			if tup[0] == 'BLOM':
+				self.bloom = Bloom.Bloom(tup[1])
+			elif tup[0] == 'KU64':
+				if len(tup[1]) != self.n_keys * 8:
+					return False
+				self.keyarr = KeyArray.KeyArray(tup[1])
+			pos += 8 + n + 4
+
 		return True
 
+	def mapfile(self):
+		self.map = mmap.mmap(self.fd, 0, mmap.MAP_SHARED,
+				     mmap.PROT_READ)
+
+	def advise(self, access):
+		# tell the kernel how the block is being read: point
+		# lookups (Advise.RANDOM) should not read around the pages
+		# they touch, while scans and checkpoints
+		# (Advise.SEQUENTIAL) read the whole block, and have it
+		# read ahead
+		if access == self.access or not self.hints:
+			return
+		self.access = access
+
+		if self.map_addr is not None:
+			ok = Advise.madvise(self.map_addr, self.st.st_size, access)
+		else:
+			ok = Advise.fadvise(self.fd, 0, 0, access)
+		if not ok:
+			return
+		self.stats.inc('block.advise_' + Advise.NAMES[access])
+		if access == Advise.SEQUENTIAL:
+			self.prefetch()
+
+	def prefetch(self):
+		# start reading the whole block into the page cache
+		if self.map_addr is not None:
+			ok = Advise.madvise(self.map_addr, self.st.st_size,
+					    Advise.WILLNEED)
+		else:
+			ok = Advise.fadvise(self.fd, 0, 0, Advise.WILLNEED)
+		if ok:
+			self.stats.inc('block.prefetch_bytes', self.st.st_size)
+		return ok
+
 	def create(self):
 		try:
 			name = "/block.%x" % (self.file_id,)
@@ -119,6 +244,77 @@ class Block(object):
 
 		return True
 
+	def verify(self, throttle=None):
+		# returns None if the block is intact, or a description
+		# of the first problem found
+		end = self.st.st_size - 4
+		if end < 8:
+			return "file too short"
+
+		# whole-file CRC trailer
+		crc = 0
+		pos = 0
+		while pos < end:
+			n = min(VERIFY_CHUNK, end - pos)
+			crc = updcrc(self.map[pos : pos + n], crc)
+			if throttle is not None:
+				throttle(n)
+			pos += n
+		if struct.unpack('<I', self.map[end:end+4])[0] != crc:
+			return "whole-file CRC mismatch"
+
+		# walk records, checking per-record CRCs and layout
+		data_pos = []
+		pos = 8
+		recname = None
+		while pos < end:
+			if pos + 12 > end:
+				return "truncated record at %d" % (pos,)
+			recname = self.map[pos : pos + 4]
+			datalen = struct.unpack('<I',
+						self.map[pos + 4 : pos + 8])[0]
+			rec_end = pos + 8 + datalen
+			if rec_end + 4 > end:
+				return "record overruns file at %d" % (pos,)
+			crc = updcrc(self.map[pos : rec_end], 0)
+			crc_in = struct.unpack('<I',
+					       self.map[rec_end : rec_end + 4])[0]
+			if crc != crc_in:
+				return "%s record CRC mismatch at %d" % \
+					(recname, pos)
+
+			if recname in ('DATA', 'DATZ', 'VPTR'):
+				data_pos.append(pos + 8)
+			elif recname == 'DIDX':
+				if pos + 8 != self.arrpos:
+					return "DIDX position mismatch"
+
+			pos = rec_end + 4
+
+		if recname != 'DTRL':
+			return "missing DTRL trailer"
+
+		# index entries must point at DATA records, in key order
+		if self.n_keys != len(data_pos):
+			return "DIDX has %d keys, file has %d DATA records" % \
+				(self.n_keys, len(data_pos))
+		last_key = None
+		for idx in xrange(self.n_keys):
+			blkidx = self.getblkidx(idx)
+			if blkidx is None or blkidx.entpos != data_pos[idx]:
+				return "bad DIDX entry %d" % (idx,)
+			k = self.read_key(blkidx)
+			if last_key is not None and k <= last_key:
+				return "keys out of order at DIDX entry %d" % \
+					(idx,)
+			last_key = k
+			if (self.keyarr is not None and
+			    (len(k) != KeyArray.KEY_LEN or
+			     self.keyarr.get(idx) != KeyArray.key_int(k))):
+				return "KU64 mismatch at DIDX entry %d" % (idx,)
+
+		return None
+
 	def getblkidx(self, idx):
 		# validate idx
 		pos = self.arrpos + (idx * 8)
@@ -135,33 +331,123 @@ class Block(object):
 
 		return blkidx
 
-	def lookup(self, k):
-		# TODO: bisect
-		# in-order linear search, key >= ours is found
-		for idx in xrange(self.n_keys):
-			# read position array for key offset into
-			blkidx = self.getblkidx(idx)
+	def read_key(self, blkidx):
+		keypos = blkidx.entpos + (4 * 2)
+		return self.map[keypos : keypos + blkidx.k_len]
+
+	def lookup_pos(self, k, lo=0):
+		# binary search, index of first key >= ours is found
+		if self.keyarr is not None and len(k) == KeyArray.KEY_LEN:
+			return self.keyarr.find(KeyArray.key_int(k), lo)
+
+		hi = self.n_keys
+		while lo < hi:
+			mid = (lo + hi) // 2
+			blkidx = self.getblkidx(mid)
 			if blkidx is None:
 				return None
+			if self.read_key(blkidx) < k:
+				lo = mid + 1
+			else:
+				hi = mid
 
-			# test key against search key
-			keypos = blkidx.entpos + (4 * 2)
-			test_key = self.map[keypos : keypos + blkidx.k_len]
-			if k == test_key:
-				return blkidx
-			if k < test_key:
+		return lo
+
+	def lookup(self, k):
+		self.advise(Advise.RANDOM)
+		if self.keyarr is not None and len(k) == KeyArray.KEY_LEN:
+			n = KeyArray.key_int(k)
+			idx = self.keyarr.find(n)
+			if idx >= self.n_keys or self.keyarr.get(idx) != n:
 				return None
+			return self.getblkidx(idx)
 
-		return None
+		if self.bloom is not None and not self.bloom.may_contain(k):
+			return None
+
+		idx = self.lookup_pos(k)
+		if idx is None or idx >= self.n_keys:
+			return None
+
+		blkidx = self.getblkidx(idx)
+		if blkidx is None:
+			return None
+
+		# test key against search key
+		if self.read_key(blkidx) != k:
+			return None
+
+		return blkidx
+
+	def lookup_many(self, keys):
+		# keys must be sorted; each search resumes where the
+		# previous one ended, making one forward pass over DIDX.
+		# uint64 keys are searched for together, in the key array.
+		# a pass over many keys gains from the kernel's readahead.
+		if len(keys) > 1:
+			self.advise(Advise.NORMAL)
+		else:
+			self.advise(Advise.RANDOM)
+
+		if (self.keyarr is not None and
+		    all(len(k) == KeyArray.KEY_LEN for k in keys)):
+			ret = []
+			for idx in self.keyarr.match_many(KeyArray.key_ints(keys)):
+				if idx is None:
+					ret.append(None)
+					continue
+				blkidx = self.getblkidx(idx)
+				if blkidx is None:
+					return None
+				ret.append(blkidx)
+			return ret
+
+		ret = []
+		lo = 0
+		for k in keys:
+			if (self.bloom is not None and
+			    not self.bloom.may_contain(k)):
+				ret.append(None)
+				continue
+
+			idx = self.lookup_pos(k, lo)
+			if idx is None:
+				return None
+			lo = idx
+
+			blkidx = None
+			if idx < self.n_keys:
+				blkidx = self.getblkidx(idx)
+				if (blkidx is not None and
+				    self.read_key(blkidx) != k):
+					blkidx = None
+			ret.append(blkidx)
+
+		return ret
+
+	def recname(self, blkidx):
+		return self.map[blkidx.entpos - 8 : blkidx.entpos - 4]
 
 	def read_record(self, blkidx):
+		# value-log pointer records are returned as ValuePtr
 		blkent = BlockEnt()
 		blkent.deserialize_hdr(self.map[blkidx.entpos :
 						blkidx.entpos + (4 * 2)])
 
+		pos = blkidx.entpos + (4 * 2)
+		data = self.map[pos : pos + blkent.k_len + blkent.v_len]
+
 		fmt = "%ds%ds" % (blkent.k_len, blkent.v_len)
 		(blkent.k, blkent.v) = struct.unpack(fmt, data)
 
+		recname = self.recname(blkidx)
+		if recname == 'VPTR':
+			ptr = ValueLog.ValuePtr()
+			ptr.deserialize(blkent.v)
+			blkent.v = ptr
+		elif recname == 'DATZ':
+			blkent.v = zlib.decompress(blkent.v)
+
 		return blkent
 
 	def read_value(self, blkidx):
@@ -170,13 +456,42 @@ class Block(object):
 						blkidx.entpos + (4 * 2)])
 
 		v_pos = blkidx.entpos + (4 * 2) + blkent.k_len
+		v = self.map[v_pos : v_pos + blkent.v_len]
+
+		recname = self.recname(blkidx)
+		if recname == 'VPTR':
+			ptr = ValueLog.ValuePtr()
+			ptr.deserialize(v)
+			return ptr
+		elif recname == 'DATZ':
+			return zlib.decompress(v)
+
+		return v
+
+	def read_view(self, blkidx):
+		# as read_value, but a read-only view into the map,
+		# rather than a copy
+		recname = self.recname(blkidx)
+		if recname == 'VPTR':
+			return self.read_value(blkidx)
+		if recname == 'DATZ':
+			return memoryview(self.read_value(blkidx))
+
+		blkent = BlockEnt()
+		blkent.deserialize_hdr(self.map[blkidx.entpos :
+						blkidx.entpos + (4 * 2)])
 
-		return self.map[v_pos : v_pos + blkent.v_len]
+		v_pos = blkidx.entpos + (4 * 2) + blkent.k_len
+		self.viewed = True
+		return memoryview(buffer(self.map, v_pos, blkent.v_len))
 
 	def readall(self):
+		self.advise(Advise.SEQUENTIAL)
 		ret_data = []
 		for idx in xrange(self.n_keys):
 			blkidx = self.getblkidx(idx)
+			if blkidx is None:
+				return None
 			blkent = self.read_record(blkidx)
 
 			tup = (blkent.k, blkent.v)
@@ -185,7 +500,23 @@ class Block(object):
 
 		return ret_data
 
-	def write_values(self, vals):
+	def iterate(self, idx=0):
+		self.advise(Advise.SEQUENTIAL)
+		while idx < self.n_keys:
+			blkidx = self.getblkidx(idx)
+			if blkidx is None:
+				return
+			blkent = self.read_record(blkidx)
+
+			yield (blkent.k, blkent.v)
+
+			idx += 1
+
+	def write_values(self, vals, opts=None):
+		# opts, a TableOptions, may ask for compressed values and a
+		# Bloom filter
+		compress = (opts is not None and
+			    opts.compression == PDcodec_pb2.TableOptions.ZLIB)
 		idxs = []
 
 		# section 1: header
@@ -202,13 +533,23 @@ class Block(object):
 
 			blkent = BlockEnt()
 			blkent.k = key
-			blkent.v = val
+			if isinstance(val, ValueLog.ValuePtr):
+				recname = 'VPTR'
+				blkent.v = val.serialize()
+			else:
+				recname = 'DATA'
+				blkent.v = val
+				if compress:
+					z = zlib.compress(val)
+					if len(z) < len(val):
+						recname = 'DATZ'
+						blkent.v = z
 
 			blkidx = BlockIdx()
 			blkidx.entpos = pos + 8
 			blkidx.k_len = len(blkent.k)
 
-			rec_data = writerecstr('DATA', blkent.serialize())
+			rec_data = writerecstr(recname, blkent.serialize())
 
 			if not trywrite(self.fd, rec_data):
 				return None
@@ -231,6 +572,28 @@ class Block(object):
 
 		crc = updcrc(rec_data, crc)
 
+		# section 3a: optional Bloom filter over the keys
+		if opts is not None and opts.bloom_bits > 0:
+			rec_data = writerecstr('BLOM',
+				Bloom.build([tup[0] for tup in vals],
+					    opts.bloom_bits))
+			if not trywrite(self.fd, rec_data):
+				return None
+
+			crc = updcrc(rec_data, crc)
+
+		# section 3b: uint64 tables' keys, as a packed array
+		if (opts is not None and
+		    opts.key_encoding == PDcodec_pb2.TableOptions.UINT64):
+			keys = [tup[0] for tup in vals]
+			if all(len(k) == KeyArray.KEY_LEN for k in keys):
+				rec_data = writerecstr('KU64',
+						       KeyArray.pack(keys))
+				if not trywrite(self.fd, rec_data):
+					return None
+
+				crc = updcrc(rec_data, crc)
+
 		# section 4: data trailer
 		raw_data = struct.pack('<II', arrpos, len(vals))
 		rec_data = writerecstr('DTRL', raw_data)
@@ -247,9 +610,49 @@ class Block(object):
 		return vals[-1][0]
 
 
+class PagedBlock(Block):
+	# a Block read with pread through a shared, fixed-size buffer
+	# pool, rather than by mapping the whole file
+	def __init__(self, dbdir, file_id, pool, stats=None, hints=False):
+		Block.__init__(self, dbdir, file_id, stats, hints)
+		self.pool = pool
+
+	def mapfile(self):
+		self.map = BufferPool.PagedFile(self.pool, self.fd,
+						self.file_id, self.st.st_size)
+
+	def readall(self):
+		self.map.advise(True)
+		try:
+			return Block.readall(self)
+		finally:
+			self.map.advise(False)
+
+	def read_view(self, blkidx):
+		# pages are not mapped; a view of a copy
+		v = self.read_value(blkidx)
+		if isinstance(v, ValueLog.ValuePtr):
+			return v
+		return memoryview(v)
+
+	def iterate(self, idx=0):
+		self.map.advise(True)
+		try:
+			for tup in Block.iterate(self, idx):
+				yield tup
+		finally:
+			if self.map is not None:
+				self.map.advise(False)
+
+
 class BlockWriter(object):
-	def __init__(self, super):
+	def __init__(self, super, table='', opts=None):
 		self.super = super
+		self.table = table
+		self.opts = opts
+		self.target_sz = TARGET_BLK_SZ
+		if opts is not None and opts.target_blk_sz:
+			self.target_sz = opts.target_blk_sz
 		self.block = None
 		self.recs = []
 		self.rec_bytes = 0
@@ -258,7 +661,7 @@ class BlockWriter(object):
 	def flush(self):
 		if self.block is None:
 			return True
-		last_key = self.block.write_values(self.recs)
+		last_key = self.block.write_values(self.recs, self.opts)
 		if last_key is None:
 			return False
 		self.block.close()
@@ -282,41 +685,210 @@ class BlockWriter(object):
 			if not self.block.create():
 				return False
 
+		# large values move to the value log, leaving a pointer
+		vlog = self.super.vlog
+		if (vlog is not None and
+		    not isinstance(value, ValueLog.ValuePtr) and
+		    vlog.want(value)):
+			value = vlog.append(self.table, key, value)
+			if value is None:
+				return False
+
 		tup = (key, value)
 		self.recs.append(tup)
-		self.rec_bytes += len(key) + len(value)
+		if isinstance(value, ValueLog.ValuePtr):
+			self.rec_bytes += len(key) + ValueLog.VPTR_SZ
+		else:
+			self.rec_bytes += len(key) + len(value)
 
-		if self.rec_bytes > TARGET_BLK_SZ:
+		if self.rec_bytes > self.target_sz:
 			return self.flush()
 		return True
 
 
+class BlockLease(object):
+	# keeps a block open, and in the BlockManager cache, while views
+	# into its map are in use
+	def __init__(self, block):
+		self.block = block
+		if block is not None:
+			block.leases += 1
+
+	def __del__(self):
+		self.release()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.release()
+		return False
+
+	def release(self):
+		block = self.block
+		if block is None:
+			return
+		self.block = None
+
+		block.leases -= 1
+		if block.leases == 0 and block.close_pending:
+			block.close()
+
+# for views of values not held in a block
+NULL_LEASE = BlockLease(None)
+
+
 class BlockManager(object):
-	def __init__(self, dbdir):
+	def __init__(self, dbdir, stats=None, pool=None, hints=False):
 		self.dbdir = dbdir
+		self.hints = hints
 		self.cache = {}
+
+		# file_id -> (file size, key count), for blocks not
+		# necessarily open; blocks are immutable, so never stale
+		self.trailers = {}
 		self.size_max = 100
+		if stats is None:
+			stats = Stats.Stats(False)
+		self.stats = stats
+		self.pool = pool
+
+		# threads for get_many's parallel opens, started on
+		# first use
+		self.open_pool = None
+
+	def __del__(self):
+		self.close()
+
+	def close(self):
+		if self.open_pool is not None:
+			self.open_pool.close()
+			self.open_pool.join()
+			self.open_pool = None
+
+	def new_block(self, file_id):
+		if self.pool is not None:
+			return PagedBlock(self.dbdir, file_id, self.pool,
+					  self.stats, self.hints)
+		return Block(self.dbdir, file_id, self.stats, self.hints)
+
+	def block_meta(self, file_id):
+		# (file size, key count) without opening the block
+		block = self.cache.get(file_id)
+		if block is not None:
+			return (block.st.st_size, block.n_keys)
+		meta = self.trailers.get(file_id)
+		if meta is None:
+			meta = read_trailer(self.dbdir, file_id)
+			if meta is None:
+				return None
+			self.trailers[file_id] = meta
+			self.stats.inc('blockmgr.trailer_reads')
+		return meta
+
+	def set_hints(self, hints):
+		self.hints = hints
+		for block in self.cache.itervalues():
+			block.hints = hints
+
+	def prefetch(self, file_ids):
+		# start reading blocks about to be used into the page
+		# cache, without opening those not already open
+		n = 0
+		for file_id in file_ids:
+			block = self.cache.get(file_id)
+			if block is not None:
+				if block.prefetch():
+					n += 1
+				continue
+
+			try:
+				fd = os.open(self.dbdir + "/block.%x" % (file_id,),
+					     os.O_RDONLY)
+			except OSError:
+				continue
+			if Advise.fadvise(fd, 0, 0, Advise.WILLNEED):
+				n += 1
+				self.stats.inc('block.prefetch_bytes',
+					       os.fstat(fd).st_size)
+			os.close(fd)
+
+		self.stats.inc('blockmgr.prefetches', n)
+		return n
 
 	def get(self, file_id):
 		if file_id in self.cache:
 			block = self.cache[file_id]
+			self.stats.inc('blockmgr.hits')
 			return block
 
 		if len(self.cache) >= self.size_max:
 			self.shrink_cache()
 
-		block = Block(self.dbdir, file_id)
+		t0 = self.stats.now()
+		block = self.new_block(file_id)
 		if not block.open():
+			self.stats.inc('blockmgr.open_errors')
 			return None
+		self.stats.timing('blockmgr.opens', t0)
 
 		self.cache[file_id] = block
 
 		return block
 
+	def get_many(self, file_ids, parallel=False):
+		# returns {file_id: Block}, omitting blocks that failed
+		# to open.  with parallel, missing blocks are opened on
+		# a thread pool, then added to the cache serially.  the
+		# buffer pool is not thread safe, so paged blocks are
+		# always opened serially.
+		ret = {}
+		missing = []
+		for file_id in file_ids:
+			if file_id in self.cache:
+				ret[file_id] = self.cache[file_id]
+				self.stats.inc('blockmgr.hits')
+			else:
+				missing.append(file_id)
+
+		if not parallel or self.pool is not None or len(missing) < 2:
+			for file_id in missing:
+				block = self.get(file_id)
+				if block is not None:
+					ret[file_id] = block
+			return ret
+
+		def open_block(file_id):
+			block = self.new_block(file_id)
+			if not block.open():
+				return None
+			return block
+
+		t0 = self.stats.now()
+		if self.open_pool is None:
+			self.open_pool = ThreadPool(OPEN_THREADS)
+		blocks = self.open_pool.map(open_block, missing)
+
+		for block in blocks:
+			if block is None:
+				self.stats.inc('blockmgr.open_errors')
+				continue
+			if len(self.cache) >= self.size_max:
+				self.shrink_cache()
+			self.cache[block.file_id] = block
+			self.stats.timing('blockmgr.opens', t0)
+			ret[block.file_id] = block
+
+		return ret
+
 	def shrink_cache(self):
-		keys = self.cache.keys()
+		# leased blocks are never evicted; if all are leased, the
+		# cache overcommits rather than fail
+		keys = [key for key, block in self.cache.iteritems()
+			if block.leases == 0]
 		random.shuffle(keys)
-		while len(self.cache) >= self.size_max:
+		while len(self.cache) >= self.size_max and len(keys) > 0:
 			key = keys.pop()
 			del self.cache[key]
+			self.stats.inc('blockmgr.evictions')
 
@@ -0,0 +1,63 @@
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import struct
+import zlib
+
+
+MIN_BITS = 64
+
+# probe count, then the bit array
+BLOOM_HDR = struct.Struct('<B')
+
+
+def key_hash(k):
+	return zlib.crc32(k) & 0xffffffff
+
+def n_probes(bits_per_key):
+	# ln(2) * bits per key minimizes false positives
+	return max(1, min(30, int(bits_per_key * 0.69)))
+
+
+class Bloom(object):
+	# a Bloom filter over a block's keys.  probes are derived from
+	# one hash by double hashing, rotating it for the step.
+	def __init__(self, data):
+		self.k = BLOOM_HDR.unpack_from(data, 0)[0]
+		self.bits = bytearray(data[BLOOM_HDR.size:])
+		self.n_bits = len(self.bits) * 8
+
+	def may_contain(self, key):
+		if self.n_bits == 0:
+			return True
+		h = key_hash(key)
+		delta = ((h >> 17) | (h << 15)) & 0xffffffff
+		for i in xrange(self.k):
+			pos = h % self.n_bits
+			if not self.bits[pos >> 3] & (1 << (pos & 7)):
+				return False
+			h = (h + delta) & 0xffffffff
+		return True
+
+
+def build(keys, bits_per_key):
+	k = n_probes(bits_per_key)
+	n_bits = max(len(keys) * bits_per_key, MIN_BITS)
+	n_bytes = (n_bits + 7) // 8
+	n_bits = n_bytes * 8
+
+	bits = bytearray(n_bytes)
+	for key in keys:
+		h = key_hash(key)
+		delta = ((h >> 17) | (h << 15)) & 0xffffffff
+		for i in xrange(k):
+			pos = h % n_bits
+			bits[pos >> 3] |= (1 << (pos & 7))
+			h = (h + delta) & 0xffffffff
+
+	return BLOOM_HDR.pack(k) + str(bits)
+
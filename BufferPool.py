@@ -0,0 +1,155 @@
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import collections
+
+import Stats
+from util import trypread
+
+
+DEF_PAGE_SZ = 16 * 1024
+
+# pages read ahead, for files hinted as sequentially accessed
+SEQ_READAHEAD = 16
+
+
+class BufferPool(object):
+	def __init__(self, n_pages, page_size=DEF_PAGE_SZ, stats=None):
+		self.n_pages = n_pages
+		self.page_size = page_size
+
+		# (file_id, page_no) -> page data, in LRU order
+		self.pages = collections.OrderedDict()
+		self.pins = {}
+
+		if stats is None:
+			stats = Stats.Stats(False)
+		self.stats = stats
+
+	def pin(self, key):
+		self.pins[key] = self.pins.get(key, 0) + 1
+
+	def unpin(self, key):
+		n = self.pins[key] - 1
+		if n == 0:
+			del self.pins[key]
+		else:
+			self.pins[key] = n
+
+	def evict(self):
+		# least recently used first, skipping pinned pages
+		for key in self.pages:
+			if key not in self.pins:
+				del self.pages[key]
+				self.stats.inc('bufpool.evictions')
+				return True
+		return False
+
+	def insert(self, key, data):
+		while len(self.pages) >= self.n_pages:
+			if not self.evict():
+				# everything pinned; overcommit rather than fail
+				break
+		self.pages[key] = data
+
+	def get(self, pfile, page_no, readahead=0):
+		key = (pfile.file_id, page_no)
+		try:
+			data = self.pages.pop(key)
+			self.pages[key] = data
+			self.stats.inc('bufpool.hits')
+			return data
+		except KeyError:
+			pass
+
+		self.stats.inc('bufpool.misses')
+
+		# extend the read over following pages not yet cached
+		n = 1
+		last_page = (pfile.size - 1) // self.page_size
+		while (n <= readahead and page_no + n <= last_page and
+		       (pfile.file_id, page_no + n) not in self.pages):
+			n += 1
+
+		pos = page_no * self.page_size
+		data = trypread(pfile.fd, n * self.page_size, pos)
+		if data is None:
+			return None
+		if n > 1:
+			self.stats.inc('bufpool.readahead', n - 1)
+
+		# the requested page goes in last, most recently used
+		for i in xrange(n - 1, -1, -1):
+			page = data[i * self.page_size :
+				    (i + 1) * self.page_size]
+			self.insert((pfile.file_id, page_no + i), page)
+
+		return page
+
+
+class PagedFile(object):
+	# read-only, slice-addressed view of a file through a buffer
+	# pool, usable in place of an mmap
+	def __init__(self, pool, fd, file_id, size):
+		self.pool = pool
+		self.fd = fd
+		self.file_id = file_id
+		self.size = size
+		self.readahead = 0
+
+	def __len__(self):
+		return self.size
+
+	def advise(self, sequential):
+		if sequential:
+			self.readahead = SEQ_READAHEAD
+		else:
+			self.readahead = 0
+
+	def close(self):
+		self.fd = None
+
+	def __getitem__(self, sl):
+		if not isinstance(sl, slice):
+			return self[sl:sl + 1]
+
+		start, stop, step = sl.indices(self.size)
+		if start >= stop:
+			return ''
+
+		psz = self.pool.page_size
+		first = start // psz
+		last = (stop - 1) // psz
+
+		# common case: slice within one page
+		if first == last:
+			page = self.pool.get(self, first, self.readahead)
+			if page is None:
+				raise IOError("buffer pool read failed")
+			off = first * psz
+			return page[start - off : stop - off]
+
+		# pin pages already gathered, so reading later pages of
+		# this same slice cannot evict them
+		keys = []
+		chunks = []
+		try:
+			for page_no in xrange(first, last + 1):
+				page = self.pool.get(self, page_no,
+						     self.readahead)
+				if page is None:
+					raise IOError("buffer pool read failed")
+				key = (self.file_id, page_no)
+				self.pool.pin(key)
+				keys.append(key)
+				chunks.append(page)
+		finally:
+			for key in keys:
+				self.pool.unpin(key)
+
+		off = first * psz
+		return ''.join(chunks)[start - off : stop - off]
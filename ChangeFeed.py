@@ -0,0 +1,243 @@
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import os
+import re
+import collections
+
+import RecLogger
+
+
+CHANGE_PUT = 'put'
+CHANGE_DELETE = 'delete'
+CHANGE_DELETE_RANGE = 'delete_range'
+
+# committed transactions kept in memory, counted in changes
+DEF_RING_CHANGES = 10000
+
+# a position before every log
+START = (0, 0)
+
+LOG_RE = re.compile(r'^log\.([0-9a-f]+)$')
+
+
+class Change(object):
+	# one committed change.  range deletions carry the range start
+	# as key, and its (exclusive) end as value.  position is the
+	# (log id, file position) just past the transaction's commit.
+	__slots__ = ('table', 'op', 'key', 'value', 'txn_id', 'position')
+
+	def __init__(self, table, op, key, value, txn_id, position):
+		self.table = table
+		self.op = op
+		self.key = key
+		self.value = value
+		self.txn_id = txn_id
+		self.position = position
+
+
+def changes(txn_id, position, recs):
+	r = []
+	for dr in recs:
+		if dr.recmask & RecLogger.LOGR_DELETE_RANGE:
+			op = CHANGE_DELETE_RANGE
+			v = dr.value
+		elif dr.recmask & RecLogger.LOGR_DELETE:
+			op = CHANGE_DELETE
+			v = None
+		else:
+			op = CHANGE_PUT
+			v = dr.value
+		r.append(Change(dr.table, op, dr.key, v, txn_id, position))
+	return r
+
+
+class ChangeFeed(object):
+	# committed changes, decoded once at commit and shared by every
+	# subscription, in a ring bounded by change count.  subscribers
+	# behind the ring read older transactions from the log files.
+	def __init__(self, db, max_changes=DEF_RING_CHANGES):
+		self.db = db
+		self.stats = db.metrics
+		self.max_changes = max_changes
+		self.n_subs = 0
+		self.clear()
+
+	def clear(self):
+		# (position, changes) per transaction; start is the
+		# position before the first, and first_seq its number
+		self.ring = collections.deque()
+		self.n_changes = 0
+		self.start = None
+		self.first_seq = 0
+
+	def position(self):
+		return (self.db.logger.log_id, self.db.logger.tell())
+
+	def subscribe(self, position=None):
+		if self.n_subs == 0:
+			self.clear()
+			self.start = self.position()
+		self.n_subs += 1
+		if position is None:
+			position = self.start
+		return Subscription(self, tuple(position))
+
+	def unsubscribe(self):
+		self.n_subs -= 1
+		if self.n_subs == 0:
+			self.clear()
+
+	def publish(self, txn_id, position, recs):
+		if self.n_subs == 0:
+			return
+		r = changes(txn_id, position, recs)
+		self.ring.append((position, r))
+		self.n_changes += len(r)
+		self.stats.inc('cdc.published_txns')
+		self.stats.inc('cdc.published_changes', len(r))
+
+		while self.n_changes > self.max_changes:
+			(self.start, r) = self.ring.popleft()
+			self.n_changes -= len(r)
+			self.first_seq += 1
+			self.stats.inc('cdc.evicted_txns')
+
+	def seq_after(self, position):
+		# number of the first ring entry past position; recent
+		# entries are the likely ones, so search from the end
+		idx = len(self.ring)
+		while idx > 0 and self.ring[idx - 1][0] > position:
+			idx -= 1
+		return self.first_seq + idx
+
+	def log_ids(self, lo, hi):
+		ids = []
+		for name in os.listdir(self.db.dbdir):
+			m = LOG_RE.match(name)
+			if m is not None and lo <= int(m.group(1), 16) <= hi:
+				ids.append(int(m.group(1), 16))
+		ids.sort()
+		return ids
+
+	def read_logs(self, position, end):
+		# (position, changes) for each transaction committed
+		# after position, up to end, read from the log files
+		for log_id in self.log_ids(position[0], end[0]):
+			logger = RecLogger.RecLogger(self.db.dbdir, log_id)
+			if not logger.open(True) or not logger.readreset():
+				return
+
+			txns = {}
+			while True:
+				tup = logger.read()
+				if tup is None:
+					break
+				pos = (log_id, logger.tell())
+				if pos > end:
+					break
+				(recname, obj) = tup
+
+				if recname == RecLogger.LOGR_ID_TXN_START:
+					txns[obj.txn_id] = []
+
+				elif recname == RecLogger.LOGR_ID_TXN_ABORT:
+					txns.pop(obj.txn_id, None)
+
+				elif recname == RecLogger.LOGR_ID_TXN_COMMIT:
+					recs = txns.pop(obj.txn_id, None)
+					if recs is not None and pos > position:
+						self.stats.inc('cdc.log_txns')
+						yield (pos, changes(obj.txn_id,
+								    pos, recs))
+
+				elif recname in (RecLogger.LOGR_ID_DATA,
+						 RecLogger.LOGR_ID_DATA_COMPACT):
+					if obj.txn_id not in txns:
+						continue
+					if recname == RecLogger.LOGR_ID_DATA_COMPACT:
+						tablemeta = self.db.super.table_by_id(
+							obj.table_id)
+						if tablemeta is None:
+							continue
+						obj.table = tablemeta.name
+					txns[obj.txn_id].append(obj)
+
+			logger.close()
+
+
+class Subscription(object):
+	# an iterator over changes committed after a position.  it
+	# stops when caught up, and may be iterated again later.
+	# position advances past a transaction once all of its changes
+	# have been returned; resuming from it repeats none of them.
+	def __init__(self, feed, position):
+		self.feed = feed
+		self.position = position
+		self.seq = None
+		self.source = None
+		self.source_end = None
+		self.pending = collections.deque()
+		self.pending_pos = None
+
+	def __del__(self):
+		self.close()
+
+	def __iter__(self):
+		return self
+
+	def close(self):
+		if self.feed is None:
+			return
+		self.feed.unsubscribe()
+		self.feed = None
+
+	def next_txn(self):
+		feed = self.feed
+		while True:
+			if self.source is not None:
+				try:
+					return self.source.next()
+				except StopIteration:
+					# everything up to its end returned
+					self.position = self.source_end
+					self.source = None
+					self.seq = None
+
+			if self.seq is None or self.seq < feed.first_seq:
+				# fell behind the ring
+				if self.position < feed.start:
+					self.source_end = feed.start
+					self.source = feed.read_logs(self.position,
+								     feed.start)
+					continue
+				self.seq = feed.seq_after(self.position)
+
+			idx = self.seq - feed.first_seq
+			if idx >= len(feed.ring):
+				return None
+			self.seq += 1
+			return feed.ring[idx]
+
+	def next(self):
+		if self.feed is None:
+			raise StopIteration
+
+		while len(self.pending) == 0:
+			tup = self.next_txn()
+			if tup is None:
+				raise StopIteration
+			(self.pending_pos, r) = tup
+			self.pending.extend(r)
+			if len(r) == 0:
+				self.position = self.pending_pos
+
+		change = self.pending.popleft()
+		if len(self.pending) == 0:
+			self.position = self.pending_pos
+		return change
+
@@ -0,0 +1,115 @@
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import sys
+import struct
+import array
+import bisect
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+# uint64 keys are stored as 8-byte big-endian strings, which sort
+# as the integers do
+KEY_LEN = 8
+
+def array_typecode():
+	# 'Q' is not available before Python 3.3
+	for tc in ('Q', 'L'):
+		try:
+			if array.array(tc).itemsize == 8:
+				return tc
+		except ValueError:
+			pass
+	return None
+
+TYPECODE = array_typecode()
+
+
+def key_int(k):
+	return struct.unpack('>Q', k)[0]
+
+def key_ints(keys):
+	return struct.unpack('>%dQ' % (len(keys),), ''.join(keys))
+
+def key_str(n):
+	return struct.pack('>Q', n)
+
+def pack(keys):
+	# stored form: little-endian uint64s
+	return struct.pack('<%dQ' % (len(keys),), *key_ints(keys))
+
+def from_keys(keys):
+	# a KeyArray of sorted keys, or None if any is not a uint64 key
+	for k in keys:
+		if len(k) != KEY_LEN:
+			return None
+	return KeyArray(pack(keys))
+
+
+class KeyArray(object):
+	# sorted uint64 keys, held as a NumPy array where available and
+	# searched a whole batch at a time; else as an array.array
+	def __init__(self, data):
+		if numpy is not None:
+			# copied: string data is not 8-byte aligned, and
+			# searches would otherwise align it on every call
+			self.arr = numpy.frombuffer(data, dtype='<u8').copy()
+		else:
+			self.arr = array.array(TYPECODE)
+			self.arr.fromstring(data)
+			if sys.byteorder == 'big':
+				self.arr.byteswap()
+
+	def __len__(self):
+		return len(self.arr)
+
+	def get(self, idx):
+		return int(self.arr[idx])
+
+	def find(self, n, lo=0):
+		# index of the first key >= n
+		if numpy is not None:
+			if lo == 0:
+				return int(self.arr.searchsorted(numpy.uint64(n)))
+			return lo + int(self.arr[lo:].searchsorted(
+						numpy.uint64(n)))
+		return bisect.bisect_left(self.arr, n, lo)
+
+	def find_many(self, ns):
+		# for each of ns, sorted, the index of the first key >= it
+		if numpy is not None:
+			return [int(i) for i in numpy.searchsorted(self.arr,
+				numpy.array(ns, dtype=numpy.uint64))]
+
+		ret = []
+		lo = 0
+		for n in ns:
+			lo = bisect.bisect_left(self.arr, n, lo)
+			ret.append(lo)
+		return ret
+
+	def match_many(self, ns):
+		# for each of ns, sorted, its index, or None if absent
+		if numpy is not None:
+			q = numpy.array(ns, dtype=numpy.uint64)
+			idx = numpy.searchsorted(self.arr, q)
+			found = idx < len(self.arr)
+			found[found] = self.arr[idx[found]] == q[found]
+			return [int(i) if f else None
+				for i, f in zip(idx, found)]
+
+		ret = self.find_many(ns)
+		n_keys = len(self.arr)
+		for j, i in enumerate(ret):
+			if i >= n_keys or self.arr[i] != ns[j]:
+				ret[j] = None
+		return ret
+
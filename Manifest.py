@@ -0,0 +1,125 @@
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import os
+import google.protobuf
+
+import PDcodec_pb2
+import Stats
+from util import tryread, trywrite, readrec, writepb, fsync_dir
+
+
+# fold the manifest back into a full superblock snapshot, and start a
+# new manifest, once it grows past this size
+MANIFEST_MAX_SZ = 4 * 1024 * 1024
+
+
+class Manifest(object):
+	def __init__(self, dbdir, manifest_id, stats=None):
+		self.dbdir = dbdir
+		self.manifest_id = manifest_id
+		self.fd = None
+
+		# end of the last complete record
+		self.size = 0
+
+		if stats is None:
+			stats = Stats.Stats(False)
+		self.stats = stats
+
+	def __del__(self):
+		self.close()
+
+	def filename(self):
+		return self.dbdir + "/manifest.%x" % (self.manifest_id,)
+
+	def close(self):
+		if self.fd is None:
+			return
+		os.close(self.fd)
+		self.fd = None
+
+	def create(self):
+		try:
+			fd = os.open(self.filename(),
+				     os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0666)
+		except OSError:
+			return False
+
+		try:
+			ok = trywrite(fd, 'MANIFEST')
+			os.fsync(fd)
+		except OSError:
+			ok = False
+		if not ok or not fsync_dir(self.dbdir):
+			os.close(fd)
+			return False
+
+		self.fd = fd
+		self.size = 8
+		return True
+
+	def read(self):
+		# yields each VersionEdit in order.  replay stops at the
+		# first incomplete record, which is a torn append.
+		try:
+			fd = os.open(self.filename(), os.O_RDONLY)
+		except OSError:
+			return
+
+		try:
+			if tryread(fd, 8) != 'MANIFEST':
+				return
+			self.size = 8
+
+			while True:
+				tup = readrec(fd)
+				if tup is None or tup[0] != 'MEDT':
+					return
+
+				edit = PDcodec_pb2.VersionEdit()
+				try:
+					edit.ParseFromString(tup[1])
+				except google.protobuf.message.DecodeError:
+					return
+
+				self.size += 8 + len(tup[1]) + 4
+				yield edit
+		finally:
+			os.close(fd)
+
+	def open(self):
+		# reopen for append, dropping any torn tail left behind
+		# by a crash
+		try:
+			fd = os.open(self.filename(), os.O_WRONLY)
+			os.ftruncate(fd, self.size)
+			os.lseek(fd, self.size, os.SEEK_SET)
+		except OSError:
+			return False
+
+		self.fd = fd
+		return True
+
+	def append(self, edit):
+		if self.fd is None and not self.open():
+			return False
+
+		if not writepb(self.fd, 'MEDT', edit):
+			return False
+		try:
+			os.fsync(self.fd)
+		except OSError:
+			return False
+
+		n = 8 + edit.ByteSize() + 4
+		self.size += n
+		self.stats.inc('manifest.edits')
+		self.stats.inc('manifest.bytes', n)
+
+		return True
+
@@ -0,0 +1,193 @@
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import os
+import struct
+import google.protobuf
+
+import PDcodec_pb2
+import RangeSet
+from util import trywrite, readrecstr, writerecstr, fsync_dir
+
+
+# memtable entries per 'MKVS' record
+CHUNK_SZ = 1024 * 1024
+
+MKV_DELETE = (1 << 0)
+
+# flags, key length, value length
+MKV_HDR = struct.Struct('<BII')
+
+# range start length, end length
+MRNG_HDR = struct.Struct('<II')
+
+
+class MemSnapshot(object):
+	# the committed-but-not-checkpointed state of a database, as of
+	# a given position in its log, saved on clean shutdown
+	def __init__(self, dbdir):
+		self.dbdir = dbdir
+		self.hdr = PDcodec_pb2.MemSnapshot()
+
+		# table name -> (log_cache, log_del_cache)
+		self.tables = {}
+
+		# table name -> RangeSet of range deletions
+		self.range_dels = {}
+
+	def filename(self):
+		return self.dbdir + '/memtable'
+
+	def serialize_table(self, name, log_cache, log_del_cache):
+		# sorted, deletions interleaved, split into records
+		name = str(name)
+		keys = sorted(set(log_cache.keys()) | log_del_cache)
+		r = []
+		chunk = [struct.pack('<H', len(name)), name]
+		chunk_sz = 0
+		for k in keys:
+			if k in log_cache:
+				v = log_cache[k]
+				chunk.append(MKV_HDR.pack(0, len(k), len(v)))
+				chunk.append(k)
+				chunk.append(v)
+				chunk_sz += MKV_HDR.size + len(k) + len(v)
+			else:
+				chunk.append(MKV_HDR.pack(MKV_DELETE, len(k), 0))
+				chunk.append(k)
+				chunk_sz += MKV_HDR.size + len(k)
+
+			if chunk_sz > CHUNK_SZ:
+				r.append(writerecstr('MKVS', ''.join(chunk)))
+				chunk = [struct.pack('<H', len(name)), name]
+				chunk_sz = 0
+		if chunk_sz > 0:
+			r.append(writerecstr('MKVS', ''.join(chunk)))
+
+		return r
+
+	def deserialize_kvs(self, data):
+		name_len = struct.unpack('<H', data[:2])[0]
+		name = data[2:2 + name_len]
+		if name not in self.tables:
+			self.tables[name] = ({}, set())
+		(log_cache, log_del_cache) = self.tables[name]
+
+		pos = 2 + name_len
+		while pos < len(data):
+			(flags, k_len, v_len) = MKV_HDR.unpack_from(data, pos)
+			pos += MKV_HDR.size
+			k = data[pos:pos + k_len]
+			pos += k_len
+			if flags & MKV_DELETE:
+				log_del_cache.add(k)
+			else:
+				log_cache[k] = data[pos:pos + v_len]
+				pos += v_len
+
+		return pos == len(data)
+
+	def serialize_ranges(self, name, range_dels):
+		name = str(name)
+		data = [struct.pack('<H', len(name)), name]
+		for start, end in range_dels:
+			data.append(MRNG_HDR.pack(len(start), len(end)))
+			data.append(start)
+			data.append(end)
+		return writerecstr('MRNG', ''.join(data))
+
+	def deserialize_ranges(self, data):
+		name_len = struct.unpack('<H', data[:2])[0]
+		name = data[2:2 + name_len]
+		range_dels = self.range_dels.setdefault(name,
+							 RangeSet.RangeSet())
+
+		pos = 2 + name_len
+		while pos < len(data):
+			(s_len, e_len) = MRNG_HDR.unpack_from(data, pos)
+			pos += MRNG_HDR.size
+			start = data[pos:pos + s_len]
+			pos += s_len
+			range_dels.add(start, data[pos:pos + e_len])
+			pos += e_len
+
+		return pos == len(data)
+
+	def dump(self):
+		data = ['MEMTABLE', writerecstr('MEMH',
+						 self.hdr.SerializeToString())]
+		for name, (log_cache, log_del_cache) in self.tables.iteritems():
+			data.extend(self.serialize_table(name, log_cache,
+							 log_del_cache))
+		for name, range_dels in self.range_dels.iteritems():
+			data.append(self.serialize_ranges(name, range_dels))
+		data.append(writerecstr('MEND', ''))
+		data = ''.join(data)
+
+		tmpname = self.filename() + '.tmp'
+		try:
+			fd = os.open(tmpname,
+				     os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+			ok = trywrite(fd, data)
+			os.fsync(fd)
+			os.close(fd)
+			if not ok:
+				os.unlink(tmpname)
+				return False
+			os.rename(tmpname, self.filename())
+		except OSError:
+			return False
+
+		return fsync_dir(self.dbdir)
+
+	def load(self):
+		# the whole file in one read, then parsed in memory
+		try:
+			fd = os.open(self.filename(), os.O_RDONLY)
+		except OSError:
+			return False
+		try:
+			data = os.read(fd, os.fstat(fd).st_size)
+		except OSError:
+			return False
+		finally:
+			os.close(fd)
+
+		if data[:8] != 'MEMTABLE':
+			return False
+
+		pos = 8
+		while True:
+			tup = readrecstr(buffer(data, pos))
+			if tup is None:
+				return False
+			(recname, rec) = tup
+			pos += 8 + len(rec) + 4
+
+			if recname == 'MEMH':
+				try:
+					self.hdr.ParseFromString(rec)
+				except google.protobuf.message.DecodeError:
+					return False
+			elif recname == 'MKVS':
+				if not self.deserialize_kvs(rec):
+					return False
+			elif recname == 'MRNG':
+				if not self.deserialize_ranges(rec):
+					return False
+			elif recname == 'MEND':
+				# only a complete snapshot is usable
+				return self.hdr.IsInitialized()
+			else:
+				return False
+
+	def remove(self):
+		try:
+			os.unlink(self.filename())
+		except OSError:
+			return False
+		return True
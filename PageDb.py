@@ -10,15 +10,132 @@ import struct
 import json
 import re
 import os
+import time
 import os.path
 import mmap
 import uuid
+import multiprocessing
 
 from TableRoot import TableRoot
+import Backup
 import Block
+import BufferPool
+import ChangeFeed
+import Manifest
+import MemSnapshot
 import PDcodec_pb2
+import RangeSet
 import RecLogger
-from util import trywrite, isstr, readrecstr, writerecstr
+import RowCache
+import SlowLog
+import Stats
+import ValueLog
+from util import trywrite, isstr, readrecstr, writerecstr, fsync_dir
+
+
+# memory held by a memtable entry beyond its key and value: the
+# dict or set slot, and string object headers
+MEM_ENT_OVERHEAD = 64
+
+# parallel_scan partitions per worker process: more, smaller
+# partitions even out the work, and return results sooner
+SCAN_PARTS_PER_WORKER = 4
+
+# commit delay at the memtable stall limit; it rises linearly from
+# zero at the memtable budget
+MEM_MAX_DELAY = 0.01
+
+COMPRESSION = {
+	'none' : PDcodec_pb2.TableOptions.NONE,
+	'zlib' : PDcodec_pb2.TableOptions.ZLIB,
+}
+
+KEY_ENCODING = {
+	'bytes' : PDcodec_pb2.TableOptions.BYTES,
+	'uint64' : PDcodec_pb2.TableOptions.UINT64,
+}
+
+def table_options(d):
+	# TableOptions from a dict of create_table options, or None
+	# if any is unknown or out of range
+	opts = PDcodec_pb2.TableOptions()
+	for name, val in d.iteritems():
+		if name == 'target_blk_sz':
+			if (val < Block.MIN_BLK_SZ or
+			    val > Block.MAX_BLK_SZ // 2):
+				return None
+			opts.target_blk_sz = val
+		elif name == 'compression':
+			if val not in COMPRESSION:
+				return None
+			opts.compression = COMPRESSION[val]
+		elif name == 'bloom_bits':
+			if val < 0 or val > 64:
+				return None
+			opts.bloom_bits = val
+		elif name == 'key_encoding':
+			if val not in KEY_ENCODING:
+				return None
+			opts.key_encoding = KEY_ENCODING[val]
+		else:
+			return None
+	return opts
+
+def scan_partition(task):
+	# parallel_scan worker: fn's results for the blocks' keys and
+	# the memtable snapshot's, merged as in PageTable.scan, opening
+	# the immutable files afresh.  None results are dropped.
+	# unreadable blocks or values raise IOError, which Pool.imap
+	# passes on to the caller.
+	(dbdir, name, file_ids, overlay, ranges, fn) = task
+	range_dels = RangeSet.RangeSet()
+	for start, end in ranges:
+		range_dels.add(start, end)
+	vlog = ValueLog.ValueLog(PDSuper(dbdir))
+
+	ret = []
+	def emit(k, v):
+		r = fn(k, v)
+		if r is not None:
+			ret.append(r)
+
+	ovl_idx = 0
+	for file_id in file_ids:
+		block = Block.Block(dbdir, file_id)
+		if not block.open():
+			raise IOError("block %x open failed" % (file_id,))
+		n_keys = 0
+		for k, v in block.iterate():
+			n_keys += 1
+			while (ovl_idx < len(overlay) and
+			       overlay[ovl_idx][0] <= k):
+				(ok, ov) = overlay[ovl_idx]
+				ovl_idx += 1
+				if ov is not None:
+					emit(ok, ov)
+
+			if ((ovl_idx > 0 and overlay[ovl_idx - 1][0] == k) or
+			    range_dels.contains(k)):
+				continue
+			if isinstance(v, ValueLog.ValuePtr):
+				ptr = v
+				v = vlog.read(ptr, name, k)
+				if v is None:
+					raise IOError("value log %x read failed" %
+						      (ptr.file_id,))
+			emit(k, v)
+		if n_keys != block.n_keys:
+			raise IOError("block %x read failed" % (file_id,))
+		block.close()
+
+	while ovl_idx < len(overlay):
+		(ok, ov) = overlay[ovl_idx]
+		ovl_idx += 1
+		if ov is not None:
+			emit(ok, ov)
+
+	vlog.close()
+	return ret
 
 
 class PDTableMeta(object):
@@ -27,6 +144,8 @@ class PDTableMeta(object):
 		self.name = ''
 		self.uuid = uuid.uuid4()
 		self.root_id = -1
+		self.table_id = 0
+		self.options = PDcodec_pb2.TableOptions()
 
 		# only used at runtime
 		self.super = super
@@ -34,6 +153,151 @@ class PDTableMeta(object):
 		self.log_cache = {}
 		self.log_del_cache = set()
 
+		# approximate bytes held by log_cache, log_del_cache and
+		# range_dels
+		self.mem_bytes = 0
+
+		# committed range deletions, applied to block data at the
+		# next checkpoint.  keys in log_cache postdate them.
+		self.range_dels = RangeSet.RangeSet()
+
+		# fence key of the last block examined by compact_blocks
+		self.compact_pos = None
+
+		# state as of the last superblock commit: whether the
+		# table is known to the superblock or manifest, and its
+		# root entries (None if unchanged since)
+		self.committed = False
+		self.committed_root = None
+
+	def target_blk_sz(self):
+		return self.options.target_blk_sz or Block.TARGET_BLK_SZ
+
+	def valid_key(self, k):
+		if self.options.key_encoding == PDcodec_pb2.TableOptions.UINT64:
+			return len(k) == 8
+		return True
+
+	def mem_put(self, k, v):
+		if k in self.log_cache:
+			self.mem_bytes -= len(k) + len(self.log_cache[k]) + \
+					  MEM_ENT_OVERHEAD
+		elif k in self.log_del_cache:
+			self.log_del_cache.discard(k)
+			self.mem_bytes -= len(k) + MEM_ENT_OVERHEAD
+		self.log_cache[k] = v
+		self.mem_bytes += len(k) + len(v) + MEM_ENT_OVERHEAD
+
+	def mem_delete(self, k):
+		if k in self.log_cache:
+			self.mem_bytes -= len(k) + len(self.log_cache[k]) + \
+					  MEM_ENT_OVERHEAD
+			del self.log_cache[k]
+		if k not in self.log_del_cache:
+			self.log_del_cache.add(k)
+			self.mem_bytes += len(k) + MEM_ENT_OVERHEAD
+
+	def mem_range_del(self, start, end):
+		# point entries within the range are superseded by it;
+		# later writes to the range land in log_cache again
+		if start >= end:
+			return
+		for k in self.log_cache.keys():
+			if start <= k < end:
+				self.mem_bytes -= len(k) + len(self.log_cache[k]) + \
+						  MEM_ENT_OVERHEAD
+				del self.log_cache[k]
+		for k in list(self.log_del_cache):
+			if start <= k < end:
+				self.log_del_cache.discard(k)
+				self.mem_bytes -= len(k) + MEM_ENT_OVERHEAD
+
+		# ranges touching the new one merge with it
+		ranges = self.range_dels
+		(i, j) = ranges.touching(start, end)
+		for idx in xrange(i, j):
+			self.mem_bytes -= len(ranges.starts[idx]) + \
+					  len(ranges.ends[idx]) + MEM_ENT_OVERHEAD
+		ranges.add(start, end)
+		self.mem_bytes += len(ranges.starts[i]) + len(ranges.ends[i]) + \
+				  MEM_ENT_OVERHEAD
+
+	def mem_recount(self):
+		n = 0
+		for k, v in self.log_cache.iteritems():
+			n += len(k) + len(v)
+		for k in self.log_del_cache:
+			n += len(k)
+		for start, end in self.range_dels:
+			n += len(start) + len(end)
+		n_ents = len(self.log_cache) + len(self.log_del_cache) + \
+			 len(self.range_dels)
+		self.mem_bytes = n + n_ents * MEM_ENT_OVERHEAD
+
+	def new_root(self):
+		root = TableRoot(self.super.dbdir, self.root_id)
+		root.int_keys = (self.options.key_encoding ==
+				 PDcodec_pb2.TableOptions.UINT64)
+		return root
+
+	def load_root(self):
+		if self.root is not None:
+			return True
+
+		root = self.new_root()
+		if not root.load():
+			return False
+		self.root = root
+
+		return True
+
+	def set_root_v(self, v):
+		if self.committed_root is None:
+			self.committed_root = self.root.v
+		self.root.v = v
+		self.root.dirty = True
+
+	def root_edit(self, te):
+		# describe the root changes since the last commit, as
+		# block file ids removed and root entries added
+		if self.committed_root is None:
+			return
+
+		old_ents = set((ent.key, ent.file_id)
+			       for ent in self.committed_root)
+		new_ents = set((ent.key, ent.file_id) for ent in self.root.v)
+
+		for ent in self.committed_root:
+			if (ent.key, ent.file_id) not in new_ents:
+				te.del_file_ids.append(ent.file_id)
+		for ent in self.root.v:
+			if (ent.key, ent.file_id) not in old_ents:
+				rootent = te.add_entries.add()
+				rootent.key = ent.key
+				rootent.file_id = ent.file_id
+
+	def apply_root_edit(self, te):
+		if len(te.del_file_ids) == 0 and len(te.add_entries) == 0:
+			return True
+		if not self.load_root():
+			return False
+
+		del_ids = set(te.del_file_ids)
+		v = [ent for ent in self.root.v if ent.file_id not in del_ids]
+		for rootent in te.add_entries:
+			ent = PDcodec_pb2.RootEnt()
+			ent.CopyFrom(rootent)
+			v.append(ent)
+		v.sort(key=lambda ent: ent.key)
+
+		# the root file no longer matches; the next manifest
+		# compaction writes a new one
+		self.root.v = v
+		self.root.dirty = True
+		self.committed_root = None
+
+		return True
+
 	def flush_rootidx(self):
 		if not self.root.dirty:
 			return True
@@ -52,8 +316,9 @@ class PDTableMeta(object):
 
 		return True
 
-	def checkpoint_initial(self):
-		writer = Block.BlockWriter(self.super)
+	def checkpoint_initial(self, stats):
+		writer = Block.BlockWriter(self.super, self.name,
+					    self.options)
 
 		keys = sorted(self.log_cache.keys())
 		for key in keys:
@@ -61,46 +326,78 @@ class PDTableMeta(object):
 				return False
 		if not writer.flush():
 			return False
+		stats.inc('checkpoint.blocks_written', len(writer.root_v))
 
-		self.root.v = writer.root_v
-		self.root.dirty = True
-
-		if not self.flush_rootidx():
-			return False
+		# written out by the next superblock commit
+		self.set_root_v(writer.root_v)
 
 		return True
 
-	def checkpoint_block(self, blkent, add_recs, del_recs):
-		# read old block data
-		block = Block.Block(self.super.dbdir, blkent.file_id)
+	def block_holds_any(self, blkent, keys):
+		# whether the block holds any of the sorted keys, from its
+		# index alone; None on I/O errors
+		block = Block.Block(self.super.dbdir, blkent.file_id,
+				    self.super.stats, self.super.access_hints)
 		if not block.open():
 			return None
-		blkvals = block.readall()
-		if blkvals is None:
+		blkents = block.lookup_many(keys)
+		if blkents is None:
 			return None
+		for blkidx in blkents:
+			if blkidx is not None:
+				return True
+		return False
+
+	def checkpoint_block(self, blkent, add_recs, del_recs):
+		# read old block data; None if the whole block is covered
+		# by a range deletion
+		if blkent is None:
+			blkvals = []
+		else:
+			block = Block.Block(self.super.dbdir, blkent.file_id,
+					    self.super.stats,
+					    self.super.access_hints)
+			if not block.open():
+				return None
+			blkvals = block.readall()
+			if blkvals is None:
+				return None
 
 		# merge old block data (blkvals), new block data (add_recs),
 		# and block data deletion notations (del_recs)
 		# into a single sorted stream of key/value pairs
-		writer = Block.BlockWriter(self.super)
+		writer = Block.BlockWriter(self.super, self.name,
+					    self.options)
 		idx_old = 0
 		idx_new = 0
 		idx_del = 0
-		while (idx_old < len(blkvals) and
+		while (idx_old < len(blkvals) or
 		       idx_new < len(add_recs)):
 			have_old = idx_old < len(blkvals)
 			have_new = idx_new < len(add_recs)
-			have_del = idx_del < len(del_recs)
+			if (have_old and have_new and
+			    blkvals[idx_old][0] == add_recs[idx_new][0]):
+				# new record overwrites old record
+				idx_old += 1
+				continue
+
 			if (have_old and
 			    ((not have_new) or
-			     (blkvals[idx_old][0] <= add_recs[idx_new][0]))):
+			     (blkvals[idx_old][0] < add_recs[idx_new][0]))):
 				tup = blkvals[idx_old]
 				idx_old += 1
+				if self.range_dels.contains(tup[0]):
+					continue
 			else:
 				tup = add_recs[idx_new]
 				idx_new += 1
 
-			if have_del and (tup[0] == del_recs[idx_del]):
+			while (idx_del < len(del_recs) and
+			       del_recs[idx_del] < tup[0]):
+				idx_del += 1
+
+			if (idx_del < len(del_recs) and
+			    tup[0] == del_recs[idx_del]):
 				idx_del += 1
 			else:
 				if not writer.push(tup[0], tup[1]):
@@ -111,9 +408,17 @@ class PDTableMeta(object):
 
 		return writer.root_v
 
-	def checkpoint(self):
-		if len(self.root.v) == 0:
-			return self.checkpoint_initial()
+	def checkpoint(self, stats):
+		# leave untouched roots unread, which may be paged
+		if (len(self.log_cache) == 0 and
+		    len(self.log_del_cache) == 0 and
+		    len(self.range_dels) == 0):
+			return True
+		if not self.load_root():
+			return False
+
+		if len(self.root) == 0:
+			return self.checkpoint_initial(stats)
 
 		keys = sorted(self.log_cache.keys())
 		del_keys = sorted(self.log_del_cache)
@@ -145,51 +450,199 @@ class PDTableMeta(object):
 				del_recs.append(del_keys[del_keyidx])
 				del_keyidx += 1
 
+			# the block's keys lie after the previous fence key
+			if blockidx == 0:
+				lo = ''
+			else:
+				lo = self.root.v[blockidx - 1].key + '\0'
+			overlaps = self.range_dels.overlaps(lo, ent.key)
+
+			# tombstones matching nothing are discarded, rather
+			# than rewriting the block unchanged
+			if (len(add_recs) == 0 and len(del_recs) > 0 and
+			    not overlaps):
+				found = self.block_holds_any(ent, del_recs)
+				if found is None:
+					return False
+				if not found:
+					stats.inc('checkpoint.tombstones_dropped',
+						  len(del_recs))
+					del_recs = []
+
+			# entirely range-deleted blocks are dropped unread
+			if self.range_dels.covers(lo, ent.key):
+				stats.inc('checkpoint.blocks_dropped')
+				root_dirty = True
+				if len(add_recs) > 0:
+					entlist = self.checkpoint_block(None,
+							add_recs, [])
+					if entlist is None:
+						return False
+					new_root_v.extend(entlist)
+					stats.inc('checkpoint.blocks_written',
+						  len(entlist))
+
 			# update block, or split into multiple blocks
-			if len(add_recs) > 0 or len(del_recs) > 0:
+			elif len(add_recs) > 0 or len(del_recs) > 0 or overlaps:
 				entlist = self.checkpoint_block(ent,
 							add_recs, del_recs)
 				if entlist is None:
 					return False
+				stats.inc('checkpoint.blocks_read')
 
 				if (len(entlist) == 1 and
 				    entlist[0].key == ent.key and
 				    entlist[0].file_id == ent.file_id):
 					new_root_v.append(ent)
+					stats.inc('checkpoint.blocks_reused')
 				else:
 					new_root_v.extend(entlist)
 					root_dirty = True
+					stats.inc('checkpoint.blocks_written',
+						  len(entlist))
 			else:
 				new_root_v.append(ent)
+				stats.inc('checkpoint.blocks_reused')
 
 			blockidx += 1
 
+		# tombstones past the last block match nothing
+		if del_keyidx < len(del_keys):
+			stats.inc('checkpoint.tombstones_dropped',
+				  len(del_keys) - del_keyidx)
+
+		# written out by the next superblock commit
 		if root_dirty:
-			self.root.v = new_root_v
-			self.root.dirty = True
-			if not self.flush_rootidx():
+			self.set_root_v(new_root_v)
+
+		return True
+
+	def block_size(self, file_id):
+		try:
+			st = os.stat(self.super.dbdir + "/block.%x" % (file_id,))
+		except OSError:
+			return None
+		return st.st_size
+
+	def merge_blocks(self, ents):
+		# rewrite adjacent blocks as one sorted stream; empty
+		# results vanish from the root
+		writer = Block.BlockWriter(self.super, self.name,
+					    self.options)
+		for ent in ents:
+			block = Block.Block(self.super.dbdir, ent.file_id,
+					    self.super.stats,
+					    self.super.access_hints)
+			if not block.open():
+				return None
+			blkvals = block.readall()
+			block.close()
+			if blkvals is None:
+				return None
+			for tup in blkvals:
+				if not writer.push(tup[0], tup[1]):
+					return None
+		if not writer.flush():
+			return None
+
+		return writer.root_v
+
+	def compact_blocks(self, budget, fill, stats):
+		# merge runs of adjacent underfilled blocks, reading at
+		# most budget blocks, resuming after the last block examined
+		# by the previous pass.  block sizes come from the file
+		# system, so blocks left alone are never read.
+		if budget < 2 or not self.load_root() or len(self.root) < 2:
+			return True
+
+		v = self.root.v
+		idx = 0
+		if self.compact_pos is not None:
+			idx = self.root.lookup_pos(self.compact_pos)
+			if idx is None or idx >= len(v):
+				idx = 0
+
+		max_sz = int(self.target_blk_sz() * fill)
+		new_v = v[:idx]
+		n_read = 0
+		n_seen = 0
+		while (idx < len(v) and n_read + 2 <= budget and
+		       n_seen < budget * 4):
+			# the run of underfilled blocks starting at idx
+			run = []
+			run_sz = 0
+			while (idx + len(run) < len(v) and
+			       n_read + len(run) < budget and
+			       run_sz < self.target_blk_sz()):
+				ent = v[idx + len(run)]
+				size = self.block_size(ent.file_id)
+				n_seen += 1
+				if size is None:
+					return False
+				if size >= max_sz:
+					break
+				run.append(ent)
+				run_sz += size
+
+			if len(run) < 2:
+				n = max(len(run), 1)
+				new_v.extend(v[idx:idx + n])
+				idx += n
+				continue
+
+			entlist = self.merge_blocks(run)
+			if entlist is None:
 				return False
+			new_v.extend(entlist)
+			idx += len(run)
+			n_read += len(run)
+			stats.inc('compact.blocks_read', len(run))
+			stats.inc('compact.blocks_written', len(entlist))
+
+		if 0 < idx < len(v):
+			self.compact_pos = v[idx - 1].key + '\0'
+		else:
+			self.compact_pos = None
 
-		return False
+		if n_read > 0:
+			new_v.extend(v[idx:])
+			self.set_root_v(new_v)
+
+		return True
 
 	def checkpoint_flush(self):
 		self.log_cache = {}
 		self.log_del_cache = set()
+		self.range_dels = RangeSet.RangeSet()
+		self.mem_bytes = 0
 
 
 class PDSuper(object):
-	def __init__(self, dbdir):
+	def __init__(self, dbdir, stats=None):
 		self.version = 1
 		self.uuid = uuid.uuid4()
 		self.log_id = 1L
 		self.next_txn_id = 1L
 		self.next_file_id = 2L
 		self.tables = {}
+		self.vlog_ids = []
+		self.manifest_id = 0
 		self.dirty = False
 
 		# only used at runtime
 		self.dbdir = dbdir
 		self.garbage_fileids = []
+		self.vlog = None
+		self.manifest = None
+		self.manifest_max_sz = Manifest.MANIFEST_MAX_SZ
+		self.committed_vlog_ids = []
+		self.table_ids = {}
+		if stats is None:
+			stats = Stats.Stats(False)
+		self.stats = stats
+
+		# madvise/fadvise hints for the blocks read at checkpoints
+		self.access_hints = False
 
 	def load(self):
 		try:
@@ -203,6 +656,170 @@ class PDSuper(object):
 		except OSError:
 			return False
 
+		for tablemeta in self.tables.itervalues():
+			tablemeta.committed = True
+
+		# replay version edits made since the snapshot
+		if self.manifest_id:
+			self.manifest = Manifest.Manifest(self.dbdir,
+							  self.manifest_id,
+							  self.stats)
+			for edit in self.manifest.read():
+				if not self.apply_edit(edit):
+					return False
+
+		self.committed_vlog_ids = list(self.vlog_ids)
+
+		return True
+
+	def apply_edit(self, edit):
+		if edit.HasField('log_id'):
+			self.log_id = edit.log_id
+		if edit.HasField('next_txn_id'):
+			self.next_txn_id = edit.next_txn_id
+		if edit.HasField('next_file_id'):
+			self.next_file_id = edit.next_file_id
+
+		self.vlog_ids.extend(edit.add_vlog_ids)
+		for file_id in edit.del_vlog_ids:
+			try:
+				self.vlog_ids.remove(file_id)
+			except ValueError:
+				return False
+
+		for te in edit.tables:
+			tablemeta = self.tables.get(te.name)
+			if tablemeta is None:
+				if not te.HasField('uuid'):
+					return False
+				tablemeta = PDTableMeta(self)
+				tablemeta.name = te.name
+				try:
+					tablemeta.uuid = uuid.UUID(te.uuid)
+				except ValueError:
+					return False
+				if te.HasField('table_id'):
+					tablemeta.table_id = te.table_id
+				else:
+					tablemeta.table_id = self.new_table_id()
+				if te.HasField('options'):
+					tablemeta.options.CopyFrom(te.options)
+				tablemeta.committed = True
+				self.tables[tablemeta.name] = tablemeta
+
+			if te.HasField('root_id'):
+				tablemeta.root_id = te.root_id
+				tablemeta.root = None
+				tablemeta.committed_root = None
+
+			if not tablemeta.apply_root_edit(te):
+				return False
+
+		return True
+
+	def version_edit(self):
+		edit = PDcodec_pb2.VersionEdit()
+		edit.log_id = self.log_id
+		edit.next_txn_id = self.next_txn_id
+		edit.next_file_id = self.next_file_id
+
+		for file_id in self.vlog_ids:
+			if file_id not in self.committed_vlog_ids:
+				edit.add_vlog_ids.append(file_id)
+		for file_id in self.committed_vlog_ids:
+			if file_id not in self.vlog_ids:
+				edit.del_vlog_ids.append(file_id)
+
+		for tablemeta in self.tables.itervalues():
+			te = PDcodec_pb2.TableEdit()
+			te.name = unicode(tablemeta.name)
+			if not tablemeta.committed:
+				te.uuid = tablemeta.uuid.hex
+				te.root_id = tablemeta.root_id
+				te.table_id = tablemeta.table_id
+				if tablemeta.options.ListFields():
+					te.options.CopyFrom(tablemeta.options)
+
+			# edits to a paged root would have every open read it
+			# in full, to apply them; such roots are written
+			# out afresh instead
+			root = tablemeta.root
+			if (root is not None and root.paged() and
+			    (root.dirty or tablemeta.committed_root is not None)):
+				if not tablemeta.flush_rootidx():
+					return None
+				te.root_id = tablemeta.root_id
+			else:
+				tablemeta.root_edit(te)
+
+			if (te.HasField('root_id') or
+			    len(te.del_file_ids) > 0 or
+			    len(te.add_entries) > 0):
+				edit.tables.add().CopyFrom(te)
+
+		return edit
+
+	def mark_committed(self):
+		self.committed_vlog_ids = list(self.vlog_ids)
+		for tablemeta in self.tables.itervalues():
+			tablemeta.committed = True
+			tablemeta.committed_root = None
+		self.dirty = False
+
+	def commit(self):
+		# make the in-memory superblock state durable.  normally
+		# a single version edit, appended to the manifest; the
+		# manifest is periodically folded into a full snapshot.
+		if (self.manifest is None or
+		    self.manifest.size > self.manifest_max_sz):
+			return self.compact()
+
+		edit = self.version_edit()
+		if edit is None:
+			return False
+
+		# new block, root and log files must be reachable by
+		# name before the edit referencing them is durable
+		if not fsync_dir(self.dbdir):
+			return False
+
+		if not self.manifest.append(edit):
+			return False
+
+		self.mark_committed()
+
+		return True
+
+	def compact(self):
+		# write full roots and superblock, pointing at a new,
+		# empty manifest
+		for tablemeta in self.tables.itervalues():
+			if tablemeta.root is None:
+				continue
+			if not tablemeta.flush_rootidx():
+				return False
+
+		manifest = Manifest.Manifest(self.dbdir, self.new_fileid(),
+					     self.stats)
+		if not manifest.create():
+			self.garbage_fileids.append(manifest.manifest_id)
+			return False
+
+		old_manifest_id = self.manifest_id
+		self.manifest_id = manifest.manifest_id
+		if not self.dump():
+			self.manifest_id = old_manifest_id
+			self.garbage_fileids.append(manifest.manifest_id)
+			return False
+
+		if self.manifest is not None:
+			self.manifest.close()
+			self.garbage_fileids.append(old_manifest_id)
+		self.manifest = manifest
+
+		self.mark_committed()
+		self.stats.inc('manifest.compactions')
+
 		return True
 
 	def dump(self):
@@ -226,6 +843,9 @@ class PDSuper(object):
 			os.unlink(self.dbdir + '/super.tmp')
 			return False
 
+		if not fsync_dir(self.dbdir):
+			return False
+
 		self.dirty = False
 
 		return True
@@ -272,23 +892,55 @@ class PDSuper(object):
 				tablemeta.uuid = uuid.UUID(tm.uuid)
 			except ValueError:
 				return False
+			tablemeta.table_id = tm.table_id
+			if tm.HasField('options'):
+				tablemeta.options.CopyFrom(tm.options)
 
 			self.tables[tablemeta.name] = tablemeta
 
+		# tables from before numeric ids; assigned in name order,
+		# so that replay of logs referencing them is repeatable
+		for name in sorted(self.tables.iterkeys()):
+			tablemeta = self.tables[name]
+			if tablemeta.table_id == 0:
+				tablemeta.table_id = self.new_table_id()
+
+		self.vlog_ids = list(obj.vlog_ids)
+		self.manifest_id = obj.manifest_id
+
 		return True
 
-	def serialize(self):
+	def serialize(self, root_ids=None, next_file_id=None):
+		# with root_ids (table name -> root file id, overriding
+		# the table's own), a standalone superblock for a backup:
+		# no manifest, and no tables that log replay will create.
+		# next_file_id overrides the database's, for root ids the
+		# backup reserved itself
 		obj = PDcodec_pb2.Superblock()
 		obj.uuid = self.uuid.hex
 		obj.log_id = self.log_id
 		obj.next_txn_id = self.next_txn_id
-		obj.next_file_id = self.next_file_id
+		if next_file_id is None:
+			next_file_id = self.next_file_id
+		obj.next_file_id = next_file_id
 
 		for tablemeta in self.tables.itervalues():
+			if root_ids is not None and not tablemeta.committed:
+				continue
 			tm = obj.tables.add()
 			tm.name = unicode(tablemeta.name)
 			tm.uuid = tablemeta.uuid.hex
 			tm.root_id = tablemeta.root_id
+			if root_ids is not None:
+				tm.root_id = root_ids.get(tablemeta.name,
+							  tablemeta.root_id)
+			tm.table_id = tablemeta.table_id
+			if tablemeta.options.ListFields():
+				tm.options.CopyFrom(tablemeta.options)
+
+		obj.vlog_ids.extend(self.vlog_ids)
+		if self.manifest_id and root_ids is None:
+			obj.manifest_id = self.manifest_id
 
 		r = 'SUPER   '
 		r += writerecstr('SUPR', obj.SerializeToString())
@@ -301,6 +953,22 @@ class PDSuper(object):
 		self.dirty = True
 		return rv
 
+	def new_table_id(self):
+		n = 0
+		for tablemeta in self.tables.itervalues():
+			n = max(n, tablemeta.table_id)
+		return n + 1
+
+	def table_by_id(self, table_id):
+		# ids are never reused, so the cache need only be rebuilt
+		# on a miss
+		tablemeta = self.table_ids.get(table_id)
+		if tablemeta is None:
+			self.table_ids = dict((tm.table_id, tm)
+					      for tm in self.tables.itervalues())
+			tablemeta = self.table_ids.get(table_id)
+		return tablemeta
+
 	def new_txnid(self):
 		rv = self.next_txn_id
 		self.next_txn_id += 1
@@ -313,21 +981,28 @@ class PageTxn(object):
 		self.id = id
 		self.log = []
 
-	def get(self, k):
+	def find(self, k, table=None):
+		# newest record for k, including range deletions holding k;
+		# of the given table, if any
 		for dr in reversed(self.log):
-			if dr.key == k:
-				if dr.recmask & RecLogger.LOGR_DELETE:
-					return None
-				return dr.v
+			if table is not None and dr.table != table:
+				continue
+			if dr.recmask & RecLogger.LOGR_DELETE_RANGE:
+				if dr.key <= k < dr.value:
+					return dr
+			elif dr.key == k:
+				return dr
 		return None
 
-	def exists(self, k):
-		for dr in reversed(self.log):
-			if dr.key == k:
-				if dr.recmask & RecLogger.LOGR_DELETE:
-					return False
-				return True
-		return False
+	def get(self, k, table=None):
+		dr = self.find(k, table)
+		if dr is None or dr.recmask & (RecLogger.LOGR_DELETE |
+					       RecLogger.LOGR_DELETE_RANGE):
+			return None
+		return dr.value
+
+	def exists(self, k, table=None):
+		return self.get(k, table) is not None
 
 
 class PageTable(object):
@@ -336,71 +1011,568 @@ class PageTable(object):
 		self.tablemeta = tablemeta
 
 	def put(self, txn, k, v):
+		if not self.tablemeta.valid_key(k):
+			return False
+
+		t0 = self.db.metrics.now()
+		trace = self.db.slowlog.start('put')
+
 		dr = self.db.logger.data(self.tablemeta, txn, k, v)
+		trace.phase('log_append')
 		if dr is None:
 			return False
 
 		txn.log.append(dr)
 
+		self.db.slowlog.finish(trace, self.tablemeta.name, k)
+		self.db.metrics.timing('table.put', t0)
 		return True
 
-	def delete(self, txn, k):
-		if not self.exists(txn, k):
+	def delete(self, txn, k, check=False):
+		# log a tombstone for k without reading it first; with
+		# check, return False, logging nothing, if k is absent
+		t0 = self.db.metrics.now()
+		trace = self.db.slowlog.start('delete')
+
+		if check and not self.lookup_exists(txn, k, trace):
+			self.db.slowlog.finish(trace, self.tablemeta.name, k)
 			return False
 
 		dr = self.db.logger.data(self.tablemeta, txn, k, None, True)
+		trace.phase('log_append')
 		if dr is None:
 			return False
 
 		txn.log.append(dr)
 
+		self.db.slowlog.finish(trace, self.tablemeta.name, k)
+		self.db.metrics.timing('table.delete', t0)
 		return True
 
-	def get(self, txn, k):
+	def delete_range(self, txn, start, end):
+		# delete all keys k, start <= k < end, with a single log
+		# record, whether or not any exist
+		if start >= end:
+			return False
+		if not (self.tablemeta.valid_key(start) and
+			self.tablemeta.valid_key(end)):
+			return False
 
-		if txn and txn.exists(k):
-			return txn.get(k)
-		if k in self.tablemeta.log_del_cache:
-			return None
-		if k in self.tablemeta.log_cache:
-			return self.tablemeta.log_cache[k]
+		t0 = self.db.metrics.now()
+		dr = self.db.logger.data(self.tablemeta, txn, start, end,
+					 delete_range=True)
+		if dr is None:
+			return False
+
+		txn.log.append(dr)
+
+		self.db.metrics.timing('table.delete_range', t0)
+		return True
+
+	def get(self, txn, k):
+		t0 = self.db.metrics.now()
+		trace = self.db.slowlog.start('get')
+		v = self.lookup(txn, k, trace)
+		self.db.slowlog.finish(trace, self.tablemeta.name, k)
+		self.db.metrics.timing('table.get', t0)
+		return v
+
+	def get_view(self, txn, k):
+		# returns (read-only memoryview of the value, lease), or
+		# None if k is absent.  values stored in blocks are not
+		# copied; the lease keeps the block open until released.
+		t0 = self.db.metrics.now()
+		trace = self.db.slowlog.start('get_view')
+		r = self.lookup_view(txn, k, trace)
+		self.db.slowlog.finish(trace, self.tablemeta.name, k)
+		self.db.metrics.timing('table.get_view', t0)
+		return r
 
+	def exists(self, txn, k):
+		t0 = self.db.metrics.now()
+		trace = self.db.slowlog.start('exists')
+		rc = self.lookup_exists(txn, k, trace)
+		self.db.slowlog.finish(trace, self.tablemeta.name, k)
+		self.db.metrics.timing('table.exists', t0)
+		return rc
+
+	def get_many(self, txn, keys, parallel=False):
+		t0 = self.db.metrics.now()
+		ret = [None] * len(keys)
+
+		# the transaction's own writes to this table, newest wins
+		txn_vals = {}
+		if txn:
+			for dr in txn.log:
+				if dr.table != self.tablemeta.name:
+					continue
+				if dr.recmask & RecLogger.LOGR_DELETE_RANGE:
+					for k in keys:
+						if dr.key <= k < dr.value:
+							txn_vals[k] = None
+				elif dr.recmask & RecLogger.LOGR_DELETE:
+					txn_vals[dr.key] = None
+				else:
+					txn_vals[dr.key] = dr.value
+
+		# resolve from txn and memtable; collect the rest,
+		# remembering each key's positions in the input
+		pending = {}
+		for i in xrange(len(keys)):
+			k = keys[i]
+			if k in txn_vals:
+				ret[i] = txn_vals[k]
+			elif k in self.tablemeta.log_del_cache:
+				pass
+			elif k in self.tablemeta.log_cache:
+				ret[i] = self.tablemeta.log_cache[k]
+			elif self.tablemeta.range_dels.contains(k):
+				pass
+			else:
+				pending.setdefault(k, []).append(i)
+
+		name = self.tablemeta.name
+		rowcache = self.db.rowcache
+		if rowcache is not None:
+			for k in pending.keys():
+				v = rowcache.get(name, k)
+				if v is RowCache.MISS:
+					continue
+				for i in pending.pop(k):
+					ret[i] = v
+
+		# partition sorted keys by root fence ranges
+		root = self.tablemeta.root
+		groups = []
+		pending_keys = sorted(pending.iterkeys())
+		if len(root) == 0:
+			pending_keys = []
+		for k, ent in zip(pending_keys, root.lookup_many(pending_keys)):
+			if ent is None:
+				break
+			file_id = ent.file_id
+			if len(groups) == 0 or groups[-1][0] != file_id:
+				groups.append((file_id, []))
+			groups[-1][1].append(k)
+
+		blocks = self.db.blockmgr.get_many([g[0] for g in groups],
+						   parallel)
+
+		for file_id, blk_keys in groups:
+			block = blocks.get(file_id)
+			if block is None:
+				continue
+			blkents = block.lookup_many(blk_keys)
+			if blkents is None:
+				continue
+			for k, blkent in zip(blk_keys, blkents):
+				if blkent is None:
+					if rowcache is not None:
+						rowcache.put(name, k, None)
+					continue
+				v = block.read_value(blkent)
+				if isinstance(v, ValueLog.ValuePtr):
+					ptr = v
+					v = self.db.vlog.read(ptr, name, k)
+					if v is None:
+						raise IOError("value log %x read "
+							      "failed" %
+							      (ptr.file_id,))
+				if rowcache is not None:
+					rowcache.put(name, k, v)
+				for i in pending[k]:
+					ret[i] = v
+
+		self.db.metrics.inc('table.get_many_keys', len(keys))
+		self.db.metrics.timing('table.get_many', t0)
+		return ret
+
+	def lookup_block(self, k, trace):
 		ent = self.tablemeta.root.lookup(k)
+		trace.phase('root_lookup')
 		if ent is None:
-			return None
+			return (None, None)
 
 		block = self.db.blockmgr.get(ent.file_id)
+		trace.phase('block_open')
 		if block is None:
-			return None
+			return (None, None)
 
 		blkent = block.lookup(k)
+		trace.phase('didx_search')
+
+		return (block, blkent)
+
+	def lookup_disk(self, k, trace):
+		# returns (ok, value); ok is False on I/O errors, so
+		# those are never cached as absent keys
+		if len(self.tablemeta.root) == 0:
+			return (True, None)
+
+		block, blkent = self.lookup_block(k, trace)
+		if block is None:
+			return (False, None)
 		if blkent is None:
+			return (True, None)
+
+		v = block.read_value(blkent)
+		trace.phase('value_copy')
+
+		if isinstance(v, ValueLog.ValuePtr):
+			ptr = v
+			v = self.db.vlog.read(ptr, self.tablemeta.name, k)
+			trace.phase('vlog_read')
+			if v is None:
+				raise IOError("value log %x read failed" %
+					      (ptr.file_id,))
+
+		return (True, v)
+
+	def lookup_cached(self, k, trace):
+		rowcache = self.db.rowcache
+		if rowcache is not None:
+			v = rowcache.get(self.tablemeta.name, k)
+			trace.phase('rowcache')
+			if v is not RowCache.MISS:
+				return v
+
+		ok, v = self.lookup_disk(k, trace)
+		if ok and rowcache is not None:
+			rowcache.put(self.tablemeta.name, k, v)
+
+		return v
+
+	def lookup_mem(self, txn, k, trace):
+		# the transaction's own writes, then the memtable;
+		# RowCache.MISS if neither holds k
+		dr = txn and txn.find(k, self.tablemeta.name)
+		trace.phase('txn')
+		if dr:
+			return txn.get(k, self.tablemeta.name)
+
+		if k in self.tablemeta.log_del_cache:
+			trace.phase('memtable')
+			return None
+		if k in self.tablemeta.log_cache:
+			trace.phase('memtable')
+			return self.tablemeta.log_cache[k]
+		in_range = self.tablemeta.range_dels.contains(k)
+		trace.phase('memtable')
+		if in_range:
 			return None
 
-		return block.read_value(blkent)
+		return RowCache.MISS
+
+	def lookup(self, txn, k, trace=SlowLog.NULL_TRACE):
+		v = self.lookup_mem(txn, k, trace)
+		if v is not RowCache.MISS:
+			return v
+
+		return self.lookup_cached(k, trace)
+
+	def lookup_view(self, txn, k, trace):
+		v = self.lookup_mem(txn, k, trace)
+		rowcache = self.db.rowcache
+		if v is RowCache.MISS and rowcache is not None:
+			v = rowcache.get(self.tablemeta.name, k)
+			trace.phase('rowcache')
+		if v is not RowCache.MISS:
+			if v is None:
+				return None
+			return (memoryview(v), Block.NULL_LEASE)
+
+		if len(self.tablemeta.root) == 0:
+			return None
+		block, blkent = self.lookup_block(k, trace)
+		if blkent is None:
+			return None
+
+		v = block.read_view(blkent)
+		trace.phase('value_view')
+
+		# value log values are copied out
+		if isinstance(v, ValueLog.ValuePtr):
+			ptr = v
+			v = self.db.vlog.read(ptr, self.tablemeta.name, k)
+			trace.phase('vlog_read')
+			if v is None:
+				raise IOError("value log %x read failed" %
+					      (ptr.file_id,))
+			return (memoryview(v), Block.NULL_LEASE)
+
+		return (v, Block.BlockLease(block))
+
+	def lookup_exists(self, txn, k, trace=SlowLog.NULL_TRACE):
+		dr = txn and txn.find(k, self.tablemeta.name)
+		trace.phase('txn')
+		if dr:
+			return txn.exists(k, self.tablemeta.name)
 
-	def exists(self, txn, k):
-		if txn and txn.exists(k):
-			return True
 		if k in self.tablemeta.log_del_cache:
+			trace.phase('memtable')
 			return False
 		if k in self.tablemeta.log_cache:
+			trace.phase('memtable')
 			return True
-
-		ent = self.tablemeta.root.lookup(k)
-		if ent is None:
+		in_range = self.tablemeta.range_dels.contains(k)
+		trace.phase('memtable')
+		if in_range:
 			return False
 
-		block = self.db.blockmgr.get(ent.file_id)
-		if block is None:
-			return False
+		rowcache = self.db.rowcache
+		if rowcache is not None:
+			v = rowcache.get(self.tablemeta.name, k)
+			trace.phase('rowcache')
+			if v is not RowCache.MISS:
+				return v is not None
 
-		blkent = block.lookup(k)
+		block, blkent = self.lookup_block(k, trace)
 		if blkent is None:
 			return False
 
 		return True
 
+	def scan_blocks(self, start, ranges=None):
+		# blocks entirely within ranges are skipped unread
+		# while one block is read, the next is prefetched
+		lo = start or ''
+		ents = self.tablemeta.root.iterate(start)
+		next_ent = next(ents, None)
+		while next_ent is not None:
+			ent = next_ent
+			next_ent = next(ents, None)
+			if ranges is not None and ranges.covers(lo, ent.key):
+				lo = ent.key + '\0'
+				continue
+			lo = ent.key + '\0'
+			if next_ent is not None and self.db.blockmgr.hints:
+				self.db.blockmgr.prefetch([next_ent.file_id])
+
+			block = self.db.blockmgr.get(ent.file_id)
+			if block is None:
+				return
+
+			if start is None:
+				idx = 0
+			else:
+				idx = block.lookup_pos(start)
+				if idx is None:
+					return
+
+			for tup in block.iterate(idx):
+				if isinstance(tup[1], ValueLog.ValuePtr):
+					ptr = tup[1]
+					v = self.db.vlog.read(ptr,
+							self.tablemeta.name,
+							tup[0])
+					if v is None:
+						raise IOError("value log %x "
+							      "read failed" %
+							      (ptr.file_id,))
+					tup = (tup[0], v)
+				yield tup
+
+	def scan(self, txn, start=None, end=None):
+		# overlay committed-but-not-checkpointed data, and the
+		# transaction's own changes, on top of block data
+		overlay = dict(self.tablemeta.log_cache)
+		for k in self.tablemeta.log_del_cache:
+			overlay[k] = None
+		ranges = self.tablemeta.range_dels
+		if txn:
+			for dr in txn.log:
+				if dr.table != self.tablemeta.name:
+					continue
+				if dr.recmask & RecLogger.LOGR_DELETE_RANGE:
+					if ranges is self.tablemeta.range_dels:
+						ranges = ranges.copy()
+					ranges.add(dr.key, dr.value)
+					for k in overlay.keys():
+						if dr.key <= k < dr.value:
+							overlay[k] = None
+				elif dr.recmask & RecLogger.LOGR_DELETE:
+					overlay[dr.key] = None
+				else:
+					overlay[dr.key] = dr.value
+
+		ovl_keys = []
+		for k in overlay.iterkeys():
+			if start is not None and k < start:
+				continue
+			if end is not None and k >= end:
+				continue
+			ovl_keys.append(k)
+		ovl_keys.sort()
+
+		# merge the two sorted streams, overlay wins
+		ovl_idx = 0
+		for tup in self.scan_blocks(start, ranges):
+			if end is not None and tup[0] >= end:
+				break
+
+			while (ovl_idx < len(ovl_keys) and
+			       ovl_keys[ovl_idx] <= tup[0]):
+				k = ovl_keys[ovl_idx]
+				ovl_idx += 1
+				if overlay[k] is not None:
+					yield (k, overlay[k])
+
+			if tup[0] not in overlay and not ranges.contains(tup[0]):
+				yield tup
+
+		while ovl_idx < len(ovl_keys):
+			k = ovl_keys[ovl_idx]
+			ovl_idx += 1
+			if overlay[k] is not None:
+				yield (k, overlay[k])
+
+	def prefetch(self, start=None, end=None):
+		# start reading the blocks holding keys in [start, end)
+		# into the page cache; returns the number of blocks
+		file_ids = []
+		for ent in self.tablemeta.root.iterate(start):
+			file_ids.append(ent.file_id)
+			if end is not None and ent.key >= end:
+				break
+		return self.db.blockmgr.prefetch(file_ids)
+
+	def approximate(self, start, end):
+		# (keys, bytes) in [start, end), from root and block
+		# metadata alone.  interior blocks count whole, from their
+		# trailers; the two boundary blocks in proportion to their
+		# keys in the range, found by key search.  unreadable
+		# blocks are left out.  committed data not yet
+		# checkpointed is added, but overwrites and range
+		# deletions are not netted out.
+		t0 = self.db.metrics.now()
+		blockmgr = self.db.blockmgr
+		n_keys = 0
+		n_bytes = 0
+		first = True
+		for ent in self.tablemeta.root.iterate(start):
+			last = (end is not None and ent.key >= end)
+			search_lo = (first and start is not None)
+			first = False
+
+			if search_lo or last:
+				block = blockmgr.get(ent.file_id)
+				if block is None or block.n_keys == 0:
+					if last:
+						break
+					continue
+				(size, blk_keys) = (block.st.st_size, block.n_keys)
+				lo = 0
+				hi = blk_keys
+				if search_lo:
+					lo = block.lookup_pos(start)
+				if last:
+					hi = block.lookup_pos(end)
+				if lo is None or hi is None:
+					lo = hi = 0
+			else:
+				meta = blockmgr.block_meta(ent.file_id)
+				if meta is None or meta[1] == 0:
+					continue
+				(size, blk_keys) = meta
+				lo = 0
+				hi = blk_keys
+
+			if hi > lo:
+				n_keys += hi - lo
+				n_bytes += size * (hi - lo) // blk_keys
+			if last:
+				break
+
+		for k, v in self.tablemeta.log_cache.iteritems():
+			if ((start is None or k >= start) and
+			    (end is None or k < end)):
+				n_keys += 1
+				n_bytes += len(k) + len(v)
+		for k in self.tablemeta.log_del_cache:
+			if ((start is None or k >= start) and
+			    (end is None or k < end)):
+				n_keys -= 1
+
+		self.db.metrics.timing('table.approximate', t0)
+		return (max(0, n_keys), n_bytes)
+
+	def scan_partitions(self, fn, n_parts):
+		# parallel_scan tasks: runs of root entries of about equal
+		# block bytes, each with the memtable entries in its range
+		tablemeta = self.tablemeta
+		ents = list(tablemeta.root.iterate())
+		sizes = [tablemeta.block_size(ent.file_id) or 0
+			 for ent in ents]
+		total = sum(sizes)
+
+		groups = [[]]
+		acc = 0
+		for ent, size in zip(ents, sizes):
+			if (len(groups[-1]) > 0 and len(groups) < n_parts and
+			    acc >= total * len(groups) // n_parts):
+				groups.append([])
+			groups[-1].append(ent)
+			acc += size
+
+		overlay = dict(tablemeta.log_cache)
+		for k in tablemeta.log_del_cache:
+			overlay[k] = None
+		overlay = sorted(overlay.iteritems())
+		ranges = list(tablemeta.range_dels)
+
+		tasks = []
+		ovl_idx = 0
+		for i, group in enumerate(groups):
+			# keys up to the group's last fence; the last group
+			# takes any beyond
+			ovl_end = ovl_idx
+			while (ovl_end < len(overlay) and
+			       (i == len(groups) - 1 or
+				overlay[ovl_end][0] <= group[-1].key)):
+				ovl_end += 1
+			tasks.append((self.db.dbdir, tablemeta.name,
+				      [ent.file_id for ent in group],
+				      overlay[ovl_idx:ovl_end], ranges, fn))
+			ovl_idx = ovl_end
+
+		return tasks
+
+	def parallel_scan(self, fn, workers=None):
+		# fn(key, value) for each key, in key order, as scan(None)
+		# would return them, spread over worker processes; returns
+		# an iterator over fn's results, less any None.  fn must
+		# be picklable, e.g. a module-level function.  the
+		# memtable is read as of the call.
+		if workers is None:
+			workers = multiprocessing.cpu_count()
+		workers = max(1, workers)
+		tasks = self.scan_partitions(fn, workers * SCAN_PARTS_PER_WORKER)
+		self.db.metrics.inc('table.parallel_scans')
+		self.db.metrics.inc('table.parallel_scan_parts', len(tasks))
+		return self.run_partitions(tasks, workers)
+
+	def run_partitions(self, tasks, workers):
+		if workers == 1 or len(tasks) == 1:
+			for task in tasks:
+				for r in scan_partition(task):
+					yield r
+			return
+
+		pool = multiprocessing.Pool(min(workers, len(tasks)))
+		try:
+			for results in pool.imap(scan_partition, tasks):
+				for r in results:
+					yield r
+		finally:
+			pool.terminate()
+			pool.join()
+
+	def approximate_size(self, start=None, end=None):
+		return self.approximate(start, end)[1]
+
+	def approximate_count(self, start=None, end=None):
+		return self.approximate(start, end)[0]
+
 
 class PageDb(object):
 	def __init__(self):
@@ -408,22 +1580,46 @@ class PageDb(object):
 		self.super = None
 		self.logger = None
 		self.blockmgr = None
+		self.vlog = None
+		self.rowcache = None
+		self.compact_log = True
+		self.readonly = False
+		self.merge_budget = 0
+		self.merge_fill = Block.MERGE_FILL
+
+		# memtable limits in bytes, 0 for none.  past mem_budget
+		# or log_limit, a checkpoint runs once no transaction is
+		# open; until then commits slow down, and past mem_stall
+		# new transactions are refused.
+		self.mem_budget = 0
+		self.log_limit = 0
+		self.mem_stall = 0
+		self.mem_max_delay = MEM_MAX_DELAY
+
+		self.metrics = Stats.Stats()
+		self.slowlog = SlowLog.SlowLog()
+		self.changes = ChangeFeed.ChangeFeed(self)
 
 	def open(self, dbdir):
 		self.dbdir = dbdir
 
-		self.super = PDSuper(dbdir)
+		self.super = PDSuper(dbdir, self.metrics)
 		if not self.super.load():
 			return False
 
 		if not self.read_logs():
 			return False
 
-		self.logger = RecLogger.RecLogger(dbdir, self.super.log_id)
+		self.logger = RecLogger.RecLogger(dbdir, self.super.log_id,
+						  self.metrics)
+		self.logger.compact = self.compact_log
 		if not self.logger.open():
 			return False
 
-		self.blockmgr = Block.BlockManager(dbdir)
+		self.blockmgr = Block.BlockManager(dbdir, self.metrics)
+
+		self.vlog = ValueLog.ValueLog(self.super, None, self.metrics)
+		self.super.vlog = self.vlog
 
 		return True
 
@@ -433,15 +1629,24 @@ class PageDb(object):
 		except KeyError:
 			return False
 
+		if obj.recmask & RecLogger.LOGR_DELETE_RANGE:
+			return self.apply_range_del(tablemeta, obj.key, obj.value)
+
+		if self.rowcache is not None:
+			self.rowcache.invalidate(obj.table, obj.key)
+
 		if obj.recmask & RecLogger.LOGR_DELETE:
-			tablemeta.log_del_cache.add(obj.key)
-			try:
-				del tablemeta.log_cache[obj.key]
-			except KeyError:
-				pass
+			tablemeta.mem_delete(obj.key)
 		else:
-			tablemeta.log_cache[obj.key] = obj.value
-			tablemeta.log_del_cache.discard(obj.key)
+			tablemeta.mem_put(obj.key, obj.value)
+
+		return True
+
+	def apply_range_del(self, tablemeta, start, end):
+		tablemeta.mem_range_del(start, end)
+
+		if self.rowcache is not None:
+			self.rowcache.invalidate_range(tablemeta.name, start, end)
 
 		return True
 
@@ -456,7 +1661,14 @@ class PageDb(object):
 		tablemeta = PDTableMeta(self.super)
 		tablemeta.name = obj.tabname
 		tablemeta.root_id = obj.root_id
-		tablemeta.root = TableRoot(self.dbdir, tablemeta.root_id)
+		if obj.HasField('table_id'):
+			tablemeta.table_id = obj.table_id
+		else:
+			tablemeta.table_id = self.super.new_table_id()
+		if obj.HasField('options'):
+			tablemeta.options.CopyFrom(obj.options)
+		tablemeta.root = tablemeta.new_root()
+		tablemeta.committed_root = []
 
 		self.super.tables[obj.tabname] = tablemeta
 		self.super.dirty = True
@@ -538,6 +1750,14 @@ class PageDb(object):
 				if not self.read_logdata(txns, obj):
 					return False
 
+			elif recname == RecLogger.LOGR_ID_DATA_COMPACT:
+				tablemeta = self.super.table_by_id(obj.table_id)
+				if tablemeta is None:
+					return False
+				obj.table = tablemeta.name
+				if not self.read_logdata(txns, obj):
+					return False
+
 			elif recname == RecLogger.LOGR_ID_TABLE:
 				if not self.read_logtable(obj):
 					return False
@@ -546,8 +1766,96 @@ class PageDb(object):
 				if not self.read_superop(obj):
 					return False
 
+	def load_memtable(self):
+		# returns the position in the current log from which to
+		# replay: past the saved memtable, if there is a valid one
+		snap = MemSnapshot.MemSnapshot(self.dbdir)
+		if not os.path.exists(snap.filename()):
+			return None
+		if not snap.load() or snap.hdr.log_id != self.super.log_id:
+			snap.remove()
+			return None
+
+		# the log must still hold everything the snapshot covers
+		try:
+			st = os.stat(self.dbdir + "/log.%x" % (snap.hdr.log_id,))
+		except OSError:
+			return None
+		if st.st_size < snap.hdr.log_pos:
+			snap.remove()
+			return None
+
+		new_tables = {}
+		for tm in snap.hdr.tables:
+			if tm.name in self.super.tables:
+				continue
+			tablemeta = PDTableMeta(self.super)
+			tablemeta.name = tm.name
+			try:
+				tablemeta.uuid = uuid.UUID(tm.uuid)
+			except ValueError:
+				return None
+			tablemeta.root_id = tm.root_id
+			tablemeta.table_id = tm.table_id
+			if tm.HasField('options'):
+				tablemeta.options.CopyFrom(tm.options)
+			tablemeta.root = tablemeta.new_root()
+			tablemeta.committed_root = []
+			new_tables[tablemeta.name] = tablemeta
+
+		for name in snap.tables.keys() + snap.range_dels.keys():
+			if (name not in self.super.tables and
+			    name not in new_tables):
+				return None
+		self.super.tables.update(new_tables)
+
+		n_keys = 0
+		for name, (log_cache, log_del_cache) in snap.tables.iteritems():
+			tablemeta = self.super.tables[name]
+			tablemeta.log_cache = log_cache
+			tablemeta.log_del_cache = log_del_cache
+			n_keys += len(log_cache) + len(log_del_cache)
+		for name, range_dels in snap.range_dels.iteritems():
+			self.super.tables[name].range_dels = range_dels
+		for name in snap.tables.keys() + snap.range_dels.keys():
+			self.super.tables[name].mem_recount()
+
+		self.super.next_txn_id = snap.hdr.next_txn_id
+		self.super.next_file_id = snap.hdr.next_file_id
+		self.super.dirty = True
+
+		self.metrics.inc('memsnap.loads')
+		self.metrics.inc('memsnap.keys', n_keys)
+
+		return snap.hdr.log_pos
+
+	def save_memtable(self):
+		snap = MemSnapshot.MemSnapshot(self.dbdir)
+		snap.hdr.log_id = self.logger.log_id
+		snap.hdr.log_pos = self.logger.tell()
+		snap.hdr.next_txn_id = self.super.next_txn_id
+		snap.hdr.next_file_id = self.super.next_file_id
+
+		for tablemeta in self.super.tables.itervalues():
+			if not tablemeta.committed:
+				tm = snap.hdr.tables.add()
+				tm.name = unicode(tablemeta.name)
+				tm.uuid = tablemeta.uuid.hex
+				tm.root_id = tablemeta.root_id
+				tm.table_id = tablemeta.table_id
+				if tablemeta.options.ListFields():
+					tm.options.CopyFrom(tablemeta.options)
+			snap.tables[tablemeta.name] = (tablemeta.log_cache,
+						       tablemeta.log_del_cache)
+			if len(tablemeta.range_dels) > 0:
+				snap.range_dels[tablemeta.name] = \
+					tablemeta.range_dels
+
+		return snap.dump()
+
 	def read_logs(self):
 		log_id = self.super.log_id
+		pos = self.load_memtable()
 		while True:
 			logger = RecLogger.RecLogger(self.dbdir, log_id)
 			if not logger.open(True):
@@ -556,6 +1864,10 @@ class PageDb(object):
 				return True
 			if not logger.readreset():
 				return False
+			if pos is not None:
+				if not logger.readseek(pos):
+					return False
+				pos = None
 			if not self.read_log(logger):
 				return False
 			log_id += 1
@@ -566,15 +1878,20 @@ class PageDb(object):
 
 		self.dbdir = dbdir
 
-		self.super = PDSuper(dbdir)
-		if not self.super.dump():
+		self.super = PDSuper(dbdir, self.metrics)
+		if not self.super.commit():
 			return False
 
-		self.logger = RecLogger.RecLogger(dbdir, self.super.log_id)
+		self.logger = RecLogger.RecLogger(dbdir, self.super.log_id,
+						  self.metrics)
+		self.logger.compact = self.compact_log
 		if not self.logger.open():
 			return False
 
-		self.blockmgr = Block.BlockManager(dbdir)
+		self.blockmgr = Block.BlockManager(dbdir, self.metrics)
+
+		self.vlog = ValueLog.ValueLog(self.super, None, self.metrics)
+		self.super.vlog = self.vlog
 
 		return True
 
@@ -584,15 +1901,18 @@ class PageDb(object):
 		except KeyError:
 			return None
 
-		if tablemeta.root is None:
-			root = TableRoot(self.dbdir, tablemeta.root_id)
-			if not root.load():
-				return None
-			tablemeta.root = root
+		if not tablemeta.load_root():
+			return None
 
 		return PageTable(self, tablemeta)
 
-	def create_table(self, name):
+	def create_table(self, name, options=None):
+		# options: a dict of target_blk_sz (bytes), compression
+		# ('none' or 'zlib'), bloom_bits (per key, 0 for none) and
+		# key_encoding ('bytes' or 'uint64')
+		if self.readonly:
+			return False
+
 		m = re.search('^\w+$', name)
 		if m is None:
 			return False
@@ -600,12 +1920,19 @@ class PageDb(object):
 		if name in self.super.tables:
 			return False
 
+		opts = table_options(options or {})
+		if opts is None:
+			return False
+
 		tablemeta = PDTableMeta(self.super)
 		tablemeta.name = name
+		tablemeta.options = opts
 		tablemeta.root_id = self.super.new_fileid()
-		tablemeta.root = TableRoot(self.dbdir, tablemeta.root_id)
+		tablemeta.table_id = self.super.new_table_id()
+		tablemeta.root = tablemeta.new_root()
 		if not tablemeta.root.dump():
 			return False
+		tablemeta.committed_root = []
 
 		if not self.logger.superop(self.super,
 					   PDcodec_pb2.LogSuperOp.INC_FILE):
@@ -619,6 +1946,22 @@ class PageDb(object):
 		return True
 
 	def txn_begin(self):
+		# None if no transaction can be started: on a replication
+		# follower, which takes changes from its primary, on log
+		# write errors, or while the memtable is at its stall limit
+		# (see set_memtable_limits).  stalled() tells the last
+		# apart: it clears once a checkpoint succeeds, which waits
+		# for open transactions to end, so the caller should end
+		# those and retry.
+		if self.readonly:
+			return None
+
+		if self.stalled():
+			self.auto_checkpoint()
+			if self.stalled():
+				self.metrics.inc('memtable.stalls')
+				return None
+
 		if not self.logger.superop(self.super,
 					   PDcodec_pb2.LogSuperOp.INC_TXN):
 			return None
@@ -629,38 +1972,112 @@ class PageDb(object):
 		return txn
 
 	def txn_commit(self, txn, sync=True):
+		trace = self.slowlog.start('txn_commit')
+
+		self.throttle()
+
 		if not self.logger.txn_end(txn, True):
 			return False
-		if sync and not self.logger.sync():
-			return False
+		position = (self.logger.log_id, self.logger.tell())
+		trace.phase('log_append')
+		if sync:
+			if not self.logger.sync():
+				return False
+			trace.phase('fsync')
 
 		for dr in txn.log:
 			if not self.apply_logdata(dr):
 				return False
+		trace.phase('apply')
+
+		self.changes.publish(txn.id, position, txn.log)
+
+		self.auto_checkpoint()
+
+		self.slowlog.finish(trace)
 
 		return True
 
 	def txn_abort(self, txn):
 		if not self.logger.txn_end(txn, False):
 			return False
+		self.auto_checkpoint()
 		return True
 
+	def stalled(self):
+		# whether the memtable is at its stall limit, refusing
+		# new transactions
+		return bool(self.mem_stall and
+			    self.mem_bytes() >= self.mem_stall)
+
+	def mem_bytes(self):
+		n = 0
+		for tablemeta in self.super.tables.itervalues():
+			n += tablemeta.mem_bytes
+		return n
+
+	def auto_checkpoint(self):
+		# checkpoint if past a memtable limit.  a transaction must
+		# not span logs, so this waits until none is open; failure
+		# leaves the limits to throttle and stall writers.
+		if self.readonly or len(self.logger.open_txns) > 0:
+			return
+		if not ((self.mem_budget and
+			 self.mem_bytes() >= self.mem_budget) or
+			(self.log_limit and
+			 self.logger.tell() >= self.log_limit)):
+			return
+
+		self.metrics.inc('memtable.auto_checkpoints')
+		if not self.checkpoint():
+			self.metrics.inc('memtable.checkpoint_failures')
+
+	def throttle(self):
+		# delay a commit in proportion to how far the memtable is
+		# past its budget, on the way to the stall limit
+		if not self.mem_budget:
+			return
+		n = self.mem_bytes()
+		if n <= self.mem_budget:
+			return
+		stall = self.mem_stall or 2 * self.mem_budget
+		frac = min(1.0, float(n - self.mem_budget) /
+				max(1, stall - self.mem_budget))
+
+		t0 = self.metrics.now()
+		time.sleep(self.mem_max_delay * frac)
+		self.metrics.timing('memtable.slowdowns', t0)
+
 	def checkpoint(self):
+		t0 = self.metrics.now()
 		for tablemeta in self.super.tables.itervalues():
-			if not tablemeta.checkpoint():
+			if not tablemeta.checkpoint(self.metrics):
+				return False
+			if (self.merge_budget and
+			    not tablemeta.compact_blocks(self.merge_budget,
+							 self.merge_fill,
+							 self.metrics)):
 				return False
 
 		# alloc new log id, open new log
 		new_log_id = self.super.new_fileid()
-		new_logger = RecLogger.RecLogger(self.dbdir, new_log_id)
+		new_logger = RecLogger.RecLogger(self.dbdir, new_log_id,
+						 self.metrics)
+		new_logger.compact = self.compact_log
 		if not new_logger.open():
 			self.super.garbage_fileids.append(new_log_id)
 			return False
 
-		# swap in new log id into superblock, write superblock
+		# values moved to the value log must be durable before
+		# the superblock references blocks pointing at them
+		if not self.vlog.sync():
+			self.super.garbage_fileids.append(new_log_id)
+			return False
+
+		# swap in new log id into superblock, commit superblock
 		old_log_id = self.super.log_id
 		self.super.log_id = new_log_id
-		if not self.super.dump():
+		if not self.super.commit():
 			self.super.log_id = old_log_id
 			self.super.garbage_fileids.append(new_log_id)
 			return False
@@ -669,12 +2086,295 @@ class PageDb(object):
 		# data, flush cached log data just written to storage
 		for tablemeta in self.super.tables.itervalues():
 			tablemeta.checkpoint_flush()
+		if self.rowcache is not None:
+			self.rowcache.clear()
 
 		# overwrite old logger, closing old log file
 		self.super.garbage_fileids.append(old_log_id)
 		self.logger = new_logger
 
+		# a saved memtable now refers to a retired log
+		MemSnapshot.MemSnapshot(self.dbdir).remove()
+
 		# TODO: delete super.garbage_fileids
 
+		self.metrics.timing('checkpoint.runs', t0)
+
+		return True
+
+	def close(self, checkpoint=False):
+		# clean shutdown.  either checkpoint, or save the memtable
+		# so that the next open replays only log written after it.
+		if checkpoint:
+			ok = self.checkpoint()
+		else:
+			ok = self.logger.sync() and self.save_memtable()
+
+		self.logger.close()
+		self.vlog.close()
+		self.blockmgr.close()
+		if self.super.manifest is not None:
+			self.super.manifest.close()
+
+		return ok
+
+	def backup(self, dest, incremental_from=None):
+		# a standalone copy of the database in dest, holding every
+		# committed transaction, taken while it stays open.  block
+		# and root files are immutable, so are hard-linked (from
+		# incremental_from, a previous backup, if it has them)
+		# where possible, and skipped if already in dest.  the log
+		# is copied up to the current position, with transactions
+		# still open there aborted.
+		t0 = self.metrics.now()
+		bk = Backup.Backup(self.dbdir, dest, incremental_from,
+				   self.metrics)
+		if not bk.open():
+			return False
+
+		# roots changed by manifest edits since their file was
+		# written go to dest under file ids counted on from the
+		# database's next one, in dest's superblock only; the
+		# database itself is not written to
+		root_ids = {}
+		next_file_id = self.super.next_file_id
+		for tablemeta in self.super.tables.itervalues():
+			if not tablemeta.load_root():
+				return False
+			root = tablemeta.root
+			if tablemeta.committed and root.dirty:
+				root_id = next_file_id
+				next_file_id += 1
+				try:
+					# left by an earlier backup
+					os.unlink(dest + "/root.%x" % (root_id,))
+				except OSError:
+					pass
+				bk_root = TableRoot(dest, root_id)
+				bk_root.v = list(root.v)
+				try:
+					if not bk_root.dump():
+						return False
+				except OSError:
+					return False
+				root_ids[tablemeta.name] = root_id
+			elif not bk.add("root.%x" % (tablemeta.root_id,), True):
+				return False
+
+			for ent in root.v:
+				if not bk.add("block.%x" % (ent.file_id,)):
+					return False
+
+		for file_id in self.super.vlog_ids:
+			name = "vlog.%x" % (file_id,)
+			if file_id == self.vlog.file_id:
+				ok = bk.add_prefix(name, self.vlog.pos)
+			else:
+				ok = bk.add(name)
+			if not ok:
+				return False
+
+		if not self.logger.sync():
+			return False
+		log_pos = self.logger.tell()
+		if log_pos is None:
+			return False
+		aborts = []
+		for txn_id in sorted(self.logger.open_txns):
+			r = PDcodec_pb2.LogTxnOp()
+			r.txn_id = txn_id
+			aborts.append(writerecstr(RecLogger.LOGR_ID_TXN_ABORT,
+						  r.SerializeToString()))
+		if not bk.add_prefix("log.%x" % (self.super.log_id,), log_pos,
+				     ''.join(aborts)):
+			return False
+
+		if not bk.write_super(self.super.serialize(root_ids,
+							   next_file_id)):
+			return False
+
+		self.metrics.timing('backup.runs', t0)
+
 		return True
 
+	def subscribe(self, from_position=None):
+		# an iterator over changes committed after from_position,
+		# a (log id, log position) pair as found in each change;
+		# ChangeFeed.START for all logs, or None for changes
+		# committed from now on
+		return self.changes.subscribe(from_position)
+
+	def set_access_hints(self, enable):
+		# madvise/fadvise hints for block reads: random for point
+		# lookups, sequential for scans and checkpoints, and the
+		# next block prefetched during scans.  off by default: they
+		# cut page cache use and disk reads, but where the disk is
+		# itself cached, as on many VMs, the smaller reads are
+		# slower.
+		self.super.access_hints = enable
+		self.blockmgr.set_hints(enable)
+
+	def set_change_ring(self, max_changes):
+		self.changes.max_changes = max_changes
+
+	def set_log_format(self, compact):
+		# compact binary data records (the default), or LogData
+		# protobufs.  replay reads either.
+		self.compact_log = compact
+		if self.logger is not None:
+			self.logger.compact = compact
+
+	def use_buffer_pool(self, size, page_size=BufferPool.DEF_PAGE_SZ):
+		# read blocks with pread through a buffer pool of size
+		# bytes, rather than mapping whole block files.  size
+		# None returns to mmap.
+		pool = None
+		if size is not None:
+			pool = BufferPool.BufferPool(max(size // page_size, 1),
+						     page_size, self.metrics)
+		self.blockmgr.close()
+		self.blockmgr = Block.BlockManager(self.dbdir, self.metrics,
+						   pool, self.blockmgr.hints)
+
+	def set_row_cache(self, max_bytes):
+		# cache decoded values, and known-absent keys, up to
+		# max_bytes; None disables
+		if max_bytes is None:
+			self.rowcache = None
+		else:
+			self.rowcache = RowCache.RowCache(max_bytes,
+							  self.metrics)
+
+	def set_block_merge(self, budget, fill=Block.MERGE_FILL):
+		# at each checkpoint, merge adjacent blocks smaller than
+		# fill times the table's target block size (its
+		# target_blk_sz option, else Block.TARGET_BLK_SZ), reading
+		# at most budget blocks per table.  off by default; None
+		# or 0 disables
+		self.merge_budget = budget or 0
+		self.merge_fill = fill
+
+	def set_memtable_limits(self, budget, log_limit=0, stall=None,
+				max_delay=MEM_MAX_DELAY):
+		# budget and stall bound memtable bytes, log_limit the
+		# current log's size; stall defaults to twice the budget.
+		# at the stall limit, txn_begin returns None and stalled()
+		# is true.
+		if stall is None:
+			stall = 2 * budget
+		self.mem_budget = budget
+		self.log_limit = log_limit
+		self.mem_stall = stall
+		self.mem_max_delay = max_delay
+
+	def set_value_log(self, threshold):
+		# values of threshold bytes or more are moved to the value
+		# log at checkpoint time; None stores all values inline
+		self.vlog.threshold = threshold
+
+	def vlog_gc(self, file_id):
+		# relocate live values out of a value log file, then delete
+		# it.  live values are rewritten through a transaction, so
+		# that the checkpoint below repoints their blocks at the
+		# current value log file.
+		if file_id not in self.super.vlog_ids:
+			return False
+		if file_id == self.vlog.file_id:
+			self.vlog.roll()
+
+		txn = self.txn_begin()
+		if txn is None:
+			return False
+
+		n_live = 0
+		n_dead = 0
+		for tabname, key, ptr in self.vlog.iterate(file_id):
+			table = self.open_table(tabname)
+			if table is None:
+				n_dead += 1
+				continue
+
+			# superseded by not-yet-checkpointed data?
+			tablemeta = table.tablemeta
+			if (key in tablemeta.log_cache or
+			    key in tablemeta.log_del_cache or
+			    tablemeta.range_dels.contains(key)):
+				n_dead += 1
+				continue
+
+			block, blkent = table.lookup_block(key,
+							  SlowLog.NULL_TRACE)
+			if blkent is None or block.read_value(blkent) != ptr:
+				n_dead += 1
+				continue
+
+			v = self.vlog.read(ptr, tabname, key)
+			if v is None or not table.put(txn, key, v):
+				self.txn_abort(txn)
+				return False
+			n_live += 1
+
+		if not self.txn_commit(txn):
+			return False
+
+		self.super.vlog_ids.remove(file_id)
+		if not self.checkpoint():
+			self.super.vlog_ids.append(file_id)
+			return False
+
+		self.vlog.remove(file_id)
+
+		self.metrics.inc('vlog.gc_files')
+		self.metrics.inc('vlog.gc_live', n_live)
+		self.metrics.inc('vlog.gc_dead', n_dead)
+
+		return True
+
+	def enable_histograms(self, enable=True):
+		self.metrics.histograms = enable
+
+	def set_slowlog(self, threshold, sink=None):
+		# trace operations slower than threshold seconds;
+		# threshold None disables tracing
+		self.slowlog = SlowLog.SlowLog(threshold, sink)
+
+	def dump_slowlog(self):
+		if not hasattr(self.slowlog.sink, 'dump'):
+			return None
+		return self.slowlog.sink.dump()
+
+	def stats(self):
+		r = self.metrics.snapshot()
+
+		tables = {}
+		for tablemeta in self.super.tables.itervalues():
+			ts = {
+				'log_keys' : len(tablemeta.log_cache),
+				'log_del_keys' : len(tablemeta.log_del_cache),
+				'range_dels' : len(tablemeta.range_dels),
+				'mem_bytes' : tablemeta.mem_bytes,
+			}
+			if tablemeta.root is not None:
+				ts['blocks'] = len(tablemeta.root)
+			tables[tablemeta.name] = ts
+		r['tables'] = tables
+
+		r.setdefault('blockmgr', {})['cached'] = len(self.blockmgr.cache)
+		r.setdefault('memtable', {}).update({
+			'bytes' : self.mem_bytes(),
+			'log_bytes' : self.logger.tell(),
+			'budget' : self.mem_budget,
+			'log_limit' : self.log_limit,
+			'stall' : self.mem_stall,
+		})
+		r.setdefault('cdc', {}).update({
+			'subscribers' : self.changes.n_subs,
+			'ring_txns' : len(self.changes.ring),
+			'ring_changes' : self.changes.n_changes,
+		})
+		if self.rowcache is not None:
+			r.setdefault('rowcache', {}).update(
+				self.rowcache.snapshot())
+
+		return r
+
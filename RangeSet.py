@@ -0,0 +1,66 @@
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import bisect
+
+
+class RangeSet(object):
+	# a set of half-open key ranges [start, end), kept sorted and
+	# disjoint; overlapping and adjacent ranges are merged
+	def __init__(self):
+		self.starts = []
+		self.ends = []
+
+	def __len__(self):
+		return len(self.starts)
+
+	def __iter__(self):
+		return iter(zip(self.starts, self.ends))
+
+	def copy(self):
+		r = RangeSet()
+		r.starts = list(self.starts)
+		r.ends = list(self.ends)
+		return r
+
+	def touching(self, start, end):
+		# indexes [i, j) of the ranges add(start, end) merges
+		return (bisect.bisect_left(self.ends, start),
+			bisect.bisect_right(self.starts, end))
+
+	def add(self, start, end):
+		if start >= end:
+			return
+
+		# ranges [i, j) touch the new one
+		(i, j) = self.touching(start, end)
+		if i < j:
+			start = min(start, self.starts[i])
+			end = max(end, self.ends[j - 1])
+		self.starts[i:j] = [start]
+		self.ends[i:j] = [end]
+
+	def find(self, k):
+		# index of the range holding k, or -1
+		i = bisect.bisect_right(self.starts, k) - 1
+		if i >= 0 and k < self.ends[i]:
+			return i
+		return -1
+
+	def contains(self, k):
+		return self.find(k) >= 0
+
+	def covers(self, lo, hi):
+		# whether one range holds every key k, lo <= k <= hi
+		i = self.find(lo)
+		return i >= 0 and hi < self.ends[i]
+
+	def overlaps(self, lo, hi):
+		# whether any range holds some key k, lo <= k <= hi
+		i = bisect.bisect_right(self.ends, lo)
+		return i < len(self.starts) and self.starts[i] <= hi
+
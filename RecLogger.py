@@ -11,10 +11,12 @@ import struct
 import google.protobuf
 
 import PDcodec_pb2
-from util import writepb, tryread, trywrite, readrec
+import Stats
+from util import writepb, writerecstr, tryread, trywrite, readrec, varint
 
 
 LOGR_ID_DATA = 'LOGR'
+LOGR_ID_DATA_COMPACT = 'LOGC'
 LOGR_ID_TXN_START = 'TXN '
 LOGR_ID_TXN_COMMIT = 'TXNC'
 LOGR_ID_TXN_ABORT = 'TXNA'
@@ -22,14 +24,121 @@ LOGR_ID_TABLE = 'LTBL'
 LOGR_ID_SUPER = 'LSPR'
 LOGR_DELETE = (1 << 0)
 
+# range deletion: key is the range start, value the (exclusive) end
+LOGR_DELETE_RANGE = (1 << 1)
+
+# compact data records: version and recmask; varint table id, txn id
+# and key length; the key, and the value filling the rest
+LOGC_VERSION = 1
+LOGC_HDR = struct.Struct('<BB')
+
+
+class LogRec(object):
+	# a data record, from either log encoding.  table is the table
+	# name; compact records carry only table_id, and the name is
+	# filled in during replay.
+	__slots__ = ('table', 'table_id', 'txn_id', 'recmask', 'key',
+		     'value')
+
+	def __init__(self, table, table_id, txn_id, recmask, key, value):
+		self.table = table
+		self.table_id = table_id
+		self.txn_id = txn_id
+		self.recmask = recmask
+		self.key = key
+		self.value = value
+
+
+def encode_compact(table_id, txn_id, recmask, k, v):
+	data = LOGC_HDR.pack(LOGC_VERSION, recmask) + varint(table_id) + \
+	       varint(txn_id) + varint(len(k)) + k
+	if v is not None:
+		data += v
+	return data
+
+def decode_compact(data):
+	# varints decoded inline: this is the replay hot path
+	try:
+		(version, recmask) = LOGC_HDR.unpack_from(data, 0)
+		if version != LOGC_VERSION:
+			return None
+
+		vals = []
+		pos = LOGC_HDR.size
+		for i in (0, 1, 2):
+			b = ord(data[pos])
+			pos += 1
+			n = b & 0x7f
+			shift = 7
+			while b >= 0x80:
+				b = ord(data[pos])
+				pos += 1
+				n |= (b & 0x7f) << shift
+				shift += 7
+			vals.append(n)
+	except (IndexError, struct.error):
+		return None
+
+	(table_id, txn_id, k_len) = vals
+	if pos + k_len > len(data):
+		return None
+
+	k = data[pos:pos + k_len]
+	if recmask & LOGR_DELETE:
+		v = None
+	else:
+		v = data[pos + k_len:]
+
+	return LogRec(None, table_id, txn_id, recmask, k, v)
+
+def decode(recname, data):
+	# the object held by a log record, or None if it is corrupt
+	if recname == LOGR_ID_DATA_COMPACT:
+		return decode_compact(data)
+
+	if recname == LOGR_ID_DATA:
+		obj = PDcodec_pb2.LogData()
+
+	elif (recname == LOGR_ID_TXN_START or
+	      recname == LOGR_ID_TXN_COMMIT or
+	      recname == LOGR_ID_TXN_ABORT):
+		obj = PDcodec_pb2.LogTxnOp()
+
+	elif recname == LOGR_ID_TABLE:
+		obj = PDcodec_pb2.LogTable()
+
+	elif recname == LOGR_ID_SUPER:
+		obj = PDcodec_pb2.LogSuperOp()
+
+	else:
+		raise RuntimeError
+
+	try:
+		obj.ParseFromString(data)
+	except google.protobuf.message.DecodeError:
+		return None
+
+	return obj
+
 
 class RecLogger(object):
-	def __init__(self, dbdir, log_id):
+	def __init__(self, dbdir, log_id, stats=None):
 		self.dbdir = dbdir
 		self.log_id = log_id
 		self.fd = None
 		self.readonly = False
 
+		# write data records in the compact encoding, rather than
+		# as LogData protobufs
+		self.compact = True
+
+		# ids of transactions begun, but not yet ended, in this log
+		self.open_txns = set()
+
+		if stats is None:
+			stats = Stats.Stats(False)
+		self.stats = stats
+
 	def __del__(self):
 		self.close()
 
@@ -66,17 +175,39 @@ class RecLogger(object):
 		self.fd = None
 
 	def sync(self):
+		t0 = self.stats.now()
 		try:
 			os.fsync(self.fd)
 		except OSError:
 			return False
+		self.stats.timing('log.fsync', t0)
+		return True
+
+	def writerec(self, recname, obj):
+		if not writepb(self.fd, recname, obj):
+			return False
+
+		# record header, data, and CRC trailer
+		self.stats.inc('log.records')
+		self.stats.inc('log.bytes', 4 + 4 + obj.ByteSize() + 4)
+
+		return True
+
+	def writeraw(self, rec_data):
+		# an already framed record, as read from another log
+		if not trywrite(self.fd, rec_data):
+			return False
+
+		self.stats.inc('log.records')
+		self.stats.inc('log.bytes', len(rec_data))
+
 		return True
 
 	def superop(self, super, op):
 		sr = PDcodec_pb2.LogSuperOp()
 		sr.op = op
 
-		if not writepb(self.fd, LOGR_ID_SUPER, sr):
+		if not self.writerec(LOGR_ID_SUPER, sr):
 			return False
 
 		return True
@@ -92,33 +223,65 @@ class RecLogger(object):
 		if delete:
 			tr.recmask |= LOGR_DELETE
 		tr.root_id = tablemeta.root_id
+		tr.table_id = tablemeta.table_id
+		if tablemeta.options.ListFields():
+			tr.options.CopyFrom(tablemeta.options)
 
-		if not writepb(self.fd, LOGR_ID_TABLE, tr):
+		if not self.writerec(LOGR_ID_TABLE, tr):
 			return False
 
 		return True
 
-	def data(self, tablemeta, txn, k, v, delete=False):
+	def data(self, tablemeta, txn, k, v, delete=False, delete_range=False):
+		if self.compact:
+			return self.data_compact(tablemeta, txn, k, v, delete,
+						 delete_range)
+
 		dr = PDcodec_pb2.LogData()
 		dr.table = tablemeta.name
 		dr.txn_id = txn.id
 		dr.recmask = 0
 		if delete:
 			dr.recmask |= LOGR_DELETE
+		if delete_range:
+			dr.recmask |= LOGR_DELETE_RANGE
 		dr.key = k
 		if not delete:
 			dr.value = v
 
-		if not writepb(self.fd, LOGR_ID_DATA, dr):
+		if not self.writerec(LOGR_ID_DATA, dr):
 			return None
 
 		return dr
 
+	def data_compact(self, tablemeta, txn, k, v, delete, delete_range):
+		recmask = 0
+		if delete:
+			recmask |= LOGR_DELETE
+			v = None
+		if delete_range:
+			recmask |= LOGR_DELETE_RANGE
+
+		rec_data = writerecstr(LOGR_ID_DATA_COMPACT,
+				       encode_compact(tablemeta.table_id, txn.id,
+						      recmask, k, v))
+		if not trywrite(self.fd, rec_data):
+			return None
+
+		self.stats.inc('log.records')
+		self.stats.inc('log.bytes', len(rec_data))
+
+		return LogRec(tablemeta.name, tablemeta.table_id, txn.id,
+			      recmask, k, v)
+
 	def txn_begin(self, txn):
 		r = PDcodec_pb2.LogTxnOp()
 		r.txn_id = txn.id
 
-		return writepb(self.fd, LOGR_ID_TXN_START, r)
+		if not self.writerec(LOGR_ID_TXN_START, r):
+			return False
+		self.open_txns.add(txn.id)
+		return True
 
 	def txn_end(self, txn, commit):
 		r = PDcodec_pb2.LogTxnOp()
@@ -127,7 +290,8 @@ class RecLogger(object):
 			op = LOGR_ID_TXN_COMMIT
 		else:
 			op = LOGR_ID_TXN_ABORT
-		return writepb(self.fd, op, r)
+		self.open_txns.discard(txn.id)
+		return self.writerec(op, r)
 
 	def readreset(self):
 		try:
@@ -140,33 +304,28 @@ class RecLogger(object):
 
 		return True
 
+	def tell(self):
+		try:
+			return os.lseek(self.fd, 0, os.SEEK_CUR)
+		except OSError:
+			return None
+
+	def readseek(self, pos):
+		try:
+			os.lseek(self.fd, pos, os.SEEK_SET)
+		except OSError:
+			return False
+
+		return True
+
 	def read(self):
 		tup = readrec(self.fd)
 		if tup is None:
 			return None
 		recname = tup[0]
-		data = tup[1]
-
-		if recname == LOGR_ID_DATA:
-			obj = PDcodec_pb2.LogData()
 
-		elif (recname == LOGR_ID_TXN_START or
-		      recname == LOGR_ID_TXN_COMMIT or
-		      recname == LOGR_ID_TXN_ABORT):
-			obj = PDcodec_pb2.LogTxnOp()
-
-		elif recname == LOGR_ID_TABLE:
-			obj = PDcodec_pb2.LogTable()
-
-		elif recname == LOGR_ID_SUPER:
-			obj = PDcodec_pb2.LogSuperOp()
-
-		else:
-			raise RuntimeError
-
-		try:
-			obj.ParseFromString(data)
-		except google.protobuf.message.DecodeError:
+		obj = decode(recname, tup[1])
+		if obj is None:
 			return None
 
 		return (recname, obj)
@@ -0,0 +1,477 @@
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import os
+import re
+import errno
+import select
+import struct
+import collections
+
+import PDcodec_pb2
+import RecLogger
+from TableRoot import TableRoot
+from util import trypread, trywrite, readrecstr, writerecstr, fsync_dir
+
+
+# a committed transaction, or one record outside any transaction:
+# source log id and position after it, then its framed log records
+REPL_GROUP = 'RGRP'
+
+# checkpoint boundary: the source moved on to the given log id
+REPL_NEXT_LOG = 'RNXT'
+
+REPL_POS = struct.Struct('<QQ')
+
+# follower state file: the source position applied through, one
+# 'RPOS' record holding a REPL_POS
+REPL_STATE = 'replpos'
+REPL_STATE_REC = 'RPOS'
+
+LOG_RE = re.compile(r'^log\.([0-9a-f]+)$')
+
+DATA_RECS = (RecLogger.LOGR_ID_DATA, RecLogger.LOGR_ID_DATA_COMPACT)
+
+
+def read_position(dbdir):
+	# a follower's saved position, or None
+	try:
+		f = open(dbdir + '/' + REPL_STATE, 'rb')
+		data = f.read()
+		f.close()
+	except IOError:
+		return None
+	tup = readrecstr(data)
+	if (tup is None or tup[0] != REPL_STATE_REC or
+	    len(tup[1]) != REPL_POS.size):
+		return None
+	return REPL_POS.unpack(tup[1])
+
+def write_position(dbdir, position):
+	# written once the follower's log holds everything up to
+	# position
+	name = dbdir + '/' + REPL_STATE
+	data = writerecstr(REPL_STATE_REC, REPL_POS.pack(*position))
+	try:
+		fd = os.open(name + '.tmp',
+			     os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+		ok = trywrite(fd, data)
+		os.fsync(fd)
+		os.close(fd)
+		if not ok:
+			os.unlink(name + '.tmp')
+			return False
+		os.rename(name + '.tmp', name)
+	except OSError:
+		return False
+	return fsync_dir(dbdir)
+
+def split_records(data):
+	# framed records, concatenated, back into a list
+	r = []
+	pos = 0
+	while pos < len(data):
+		n = struct.unpack('<I', data[pos + 4:pos + 8])[0]
+		r.append(data[pos:pos + 8 + n + 4])
+		pos += 8 + n + 4
+	return r
+
+
+class QueueTransport(object):
+	# both ends in one process
+	def __init__(self):
+		self.q = collections.deque()
+
+	def send(self, recname, data):
+		self.q.append((recname, data))
+		return True
+
+	def recv(self):
+		if len(self.q) == 0:
+			return None
+		return self.q.popleft()
+
+
+class FdTransport(object):
+	# a pipe, socket or other byte stream, carrying one framed
+	# record per message.  recv does not wait for a message to start.
+	def __init__(self, rfd=None, wfd=None):
+		self.rfd = rfd
+		self.wfd = wfd
+
+	def send(self, recname, data):
+		msg = writerecstr(recname, data)
+		while msg:
+			try:
+				n = os.write(self.wfd, msg)
+			except OSError:
+				return False
+			msg = msg[n:]
+		return True
+
+	def readn(self, n):
+		r = []
+		while n > 0:
+			try:
+				data = os.read(self.rfd, n)
+			except OSError, e:
+				if e.errno == errno.EINTR:
+					continue
+				return None
+			if not data:
+				return None
+			r.append(data)
+			n -= len(data)
+		return ''.join(r)
+
+	def recv(self):
+		try:
+			ready = select.select([self.rfd], [], [], 0)[0]
+		except select.error:
+			return None
+		if not ready:
+			return None
+
+		hdr = self.readn(8)
+		if hdr is None:
+			return None
+		n = struct.unpack('<I', hdr[4:])[0]
+		rest = self.readn(n + 4)
+		if rest is None:
+			return None
+		return readrecstr(hdr + rest)
+
+
+class LogTailer(object):
+	# primary side: reads the database's log files as they are
+	# written, and ships each transaction once its commit is in the
+	# log.  aborted transactions are never shipped.
+	def __init__(self, db, transport, log_id=None, pos=None):
+		self.db = db
+		self.transport = transport
+		self.stats = db.metrics
+		self.fd = None
+
+		# position reached in the source log
+		if log_id is None:
+			log_id = db.super.log_id
+			pos = db.logger.tell()
+		self.log_id = log_id
+		self.pos = pos or 8
+
+		# txn id -> framed records, awaiting commit
+		self.txns = {}
+
+	def __del__(self):
+		self.close()
+
+	def close(self):
+		if self.fd is None:
+			return
+		os.close(self.fd)
+		self.fd = None
+
+	def open(self):
+		# transactions still open at the starting position began
+		# earlier in the log; their records are picked up without
+		# shipping anything
+		end = self.pos
+		self.pos = 8
+		if not self.open_log():
+			return False
+		while self.pos < end:
+			tup = self.read_rec()
+			if tup is None:
+				return False
+			if not self.track(tup, False):
+				return False
+		return True
+
+	def open_log(self):
+		self.close()
+		name = "/log.%x" % (self.log_id,)
+		try:
+			self.fd = os.open(self.db.dbdir + name, os.O_RDONLY)
+		except OSError:
+			return False
+		return True
+
+	def read_rec(self):
+		# (recname, data, framed record) at pos, or None if the
+		# log does not yet hold a complete one
+		hdr = trypread(self.fd, 8, self.pos)
+		if hdr is None or len(hdr) < 8:
+			return None
+		n = struct.unpack('<I', hdr[4:])[0]
+		rest = trypread(self.fd, n + 4, self.pos + 8)
+		if rest is None or len(rest) < n + 4:
+			return None
+		tup = readrecstr(hdr + rest)
+		if tup is None:
+			return None
+		self.pos += 8 + n + 4
+		return (tup[0], tup[1], hdr + rest)
+
+	def following_log(self, log_id):
+		# log ids only increase; the next log is the next id
+		# found, once the database has moved past log_id
+		if log_id == self.db.super.log_id:
+			return None
+		ids = []
+		for name in os.listdir(self.db.dbdir):
+			m = LOG_RE.match(name)
+			if m is not None and int(m.group(1), 16) > log_id:
+				ids.append(int(m.group(1), 16))
+		if len(ids) == 0:
+			return None
+		return min(ids)
+
+	def ship(self, recs):
+		data = REPL_POS.pack(self.log_id, self.pos) + ''.join(recs)
+		if not self.transport.send(REPL_GROUP, data):
+			return False
+		self.stats.inc('repl.shipped_groups')
+		self.stats.inc('repl.shipped_records', len(recs))
+		self.stats.inc('repl.shipped_bytes', len(data))
+		return True
+
+	def track(self, tup, ship):
+		(recname, data, rec) = tup
+		if recname not in (RecLogger.LOGR_ID_TXN_START,
+				   RecLogger.LOGR_ID_TXN_COMMIT,
+				   RecLogger.LOGR_ID_TXN_ABORT) + DATA_RECS:
+			return not ship or self.ship([rec])
+
+		obj = RecLogger.decode(recname, data)
+		if obj is None:
+			return False
+
+		if recname == RecLogger.LOGR_ID_TXN_START:
+			self.txns[obj.txn_id] = [rec]
+		elif recname in DATA_RECS:
+			if obj.txn_id in self.txns:
+				self.txns[obj.txn_id].append(rec)
+		elif recname == RecLogger.LOGR_ID_TXN_ABORT:
+			self.txns.pop(obj.txn_id, None)
+		else:
+			recs = self.txns.pop(obj.txn_id, None)
+			if recs is not None and ship:
+				recs.append(rec)
+				return self.ship(recs)
+
+		return True
+
+	def pump(self):
+		# ship everything committed to the log so far; returns
+		# the number of records read, or None on error
+		if self.fd is None and not self.open():
+			return None
+
+		n = 0
+		while True:
+			tup = self.read_rec()
+			if tup is None:
+				log_id = self.following_log(self.log_id)
+				if log_id is None:
+					return n
+
+				# checkpoint boundary
+				if not self.transport.send(REPL_NEXT_LOG,
+						struct.pack('<Q', log_id)):
+					return None
+				self.log_id = log_id
+				self.pos = 8
+				if not self.open_log():
+					return None
+				continue
+
+			if not self.track(tup, True):
+				return None
+			n += 1
+
+	def lag(self):
+		# records and bytes in the log not yet shipped: unread, or
+		# awaiting their transaction's commit
+		records = 0
+		n_bytes = 0
+		for recs in self.txns.itervalues():
+			records += len(recs)
+			n_bytes += sum(len(rec) for rec in recs)
+
+		log_id = self.log_id
+		pos = self.pos
+		while log_id is not None:
+			try:
+				fd = os.open(self.db.dbdir + "/log.%x" % (log_id,),
+					     os.O_RDONLY)
+			except OSError:
+				break
+			size = os.fstat(fd).st_size
+			while True:
+				hdr = trypread(fd, 8, pos)
+				if hdr is None or len(hdr) < 8:
+					break
+				n = 8 + struct.unpack('<I', hdr[4:])[0] + 4
+				if size < pos + n:
+					break
+				records += 1
+				n_bytes += n
+				pos += n
+			os.close(fd)
+
+			log_id = self.following_log(log_id)
+			pos = 8
+
+		return { 'records' : records, 'bytes' : n_bytes }
+
+
+def start(db, dest, transport):
+	# back up db into dest, to be opened for a Follower, and return
+	# the LogTailer feeding it from there on; None on failure
+	if not db.backup(dest):
+		return None
+	tailer = LogTailer(db, transport)
+	if not tailer.open():
+		return None
+	if not write_position(dest, (tailer.log_id, tailer.pos)):
+		return None
+	return tailer
+
+def resume(db, transport, position):
+	# the LogTailer feeding a restarted Follower from its
+	# position(); None on failure
+	tailer = LogTailer(db, transport, position[0], position[1])
+	if not tailer.open():
+		return None
+	return tailer
+
+
+class RecordList(object):
+	# framed log records, read as from a RecLogger
+	def __init__(self, recs):
+		self.recs = recs
+		self.idx = 0
+
+	def read(self):
+		if self.idx >= len(self.recs):
+			return None
+		tup = readrecstr(self.recs[self.idx])
+		self.idx += 1
+		if tup is None:
+			return None
+		obj = RecLogger.decode(tup[0], tup[1])
+		if obj is None:
+			return None
+		return (tup[0], obj)
+
+
+class Follower(object):
+	# standby side: applies shipped records to a database opened
+	# on a backup of the primary, taken just before its LogTailer
+	# was created.  records are appended to the follower's own log
+	# and replayed through PageDb.read_log; each checkpoint boundary
+	# is a checkpoint here too.  the database serves reads only.
+	# the position applied through is kept in the database
+	# directory, so that a restarted follower may resume from it.
+	def __init__(self, db, transport):
+		self.db = db
+		self.transport = transport
+		self.stats = db.metrics
+		db.readonly = True
+
+		# source log id and position applied through
+		self.log_id = None
+		self.pos = None
+		self.load_position()
+
+	def position(self):
+		# (source log id, position) applied through, or None
+		if self.log_id is None:
+			return None
+		return (self.log_id, self.pos)
+
+	def load_position(self):
+		position = read_position(self.db.dbdir)
+		if position is not None:
+			(self.log_id, self.pos) = position
+
+	def apply_table(self, rec):
+		# file ids are allocated independently on either side,
+		# so the new table's root gets one of ours
+		tup = readrecstr(rec)
+		obj = RecLogger.decode(tup[0], tup[1])
+		if obj is None:
+			return False
+		db = self.db
+
+		# shipped again, to a follower restarted after applying
+		# it but before saving its position
+		if obj.tabname in db.super.tables:
+			return True
+		obj.root_id = db.super.new_fileid()
+		if not db.logger.superop(db.super,
+					 PDcodec_pb2.LogSuperOp.INC_FILE):
+			return False
+		if not TableRoot(db.dbdir, obj.root_id).dump():
+			return False
+		if not db.logger.writerec(RecLogger.LOGR_ID_TABLE, obj):
+			return False
+		return db.read_logtable(obj)
+
+	def apply_group(self, data):
+		(log_id, pos) = REPL_POS.unpack_from(data, 0)
+		recs = split_records(data[REPL_POS.size:])
+
+		if (len(recs) == 1 and
+		    recs[0][:4] == RecLogger.LOGR_ID_TABLE):
+			if not self.apply_table(recs[0]):
+				return False
+		else:
+			for rec in recs:
+				if not self.db.logger.writeraw(rec):
+					return False
+			if not self.db.read_log(RecordList(recs)):
+				return False
+
+		self.log_id = log_id
+		self.pos = pos
+		self.stats.inc('repl.applied_groups')
+		self.stats.inc('repl.applied_records', len(recs))
+		self.stats.inc('repl.applied_bytes', len(data))
+		return True
+
+	def poll(self, max_msgs=None):
+		# apply messages already received; returns how many, or
+		# None on error
+		n = 0
+		while max_msgs is None or n < max_msgs:
+			tup = self.transport.recv()
+			if tup is None:
+				break
+			(recname, data) = tup
+
+			if recname == REPL_GROUP:
+				if not self.apply_group(data):
+					return None
+			elif recname == REPL_NEXT_LOG:
+				if not self.db.checkpoint():
+					return None
+				self.log_id = struct.unpack('<Q', data)[0]
+				self.pos = 8
+				self.stats.inc('repl.checkpoints')
+			else:
+				return None
+			n += 1
+
+		if n > 0 and not self.db.logger.sync():
+			return None
+		if (n > 0 and self.log_id is not None and
+		    not write_position(self.db.dbdir, self.position())):
+			return None
+
+		return n
+
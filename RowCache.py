@@ -0,0 +1,94 @@
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import collections
+
+import Stats
+
+
+# returned by RowCache.get for keys not in the cache
+MISS = object()
+
+# approximate per-entry bookkeeping cost, charged against the budget
+ENTRY_OVERHEAD = 64
+
+
+class RowCache(object):
+	def __init__(self, max_bytes, stats=None):
+		self.max_bytes = max_bytes
+		self.bytes = 0
+
+		# (table, key) -> value, or None for known-absent keys,
+		# in LRU order
+		self.entries = collections.OrderedDict()
+
+		if stats is None:
+			stats = Stats.Stats(False)
+		self.stats = stats
+
+	def entry_size(self, ck, v):
+		n = ENTRY_OVERHEAD + len(ck[1])
+		if v is not None:
+			n += len(v)
+		return n
+
+	def get(self, table, k):
+		ck = (table, k)
+		try:
+			v = self.entries.pop(ck)
+		except KeyError:
+			self.stats.inc('rowcache.misses')
+			return MISS
+
+		self.entries[ck] = v
+		self.stats.inc('rowcache.hits')
+		return v
+
+	def put(self, table, k, v):
+		ck = (table, k)
+		size = self.entry_size(ck, v)
+		if size > self.max_bytes:
+			return
+
+		self.invalidate(table, k)
+		while self.bytes + size > self.max_bytes:
+			old_ck, old_v = self.entries.popitem(last=False)
+			self.bytes -= self.entry_size(old_ck, old_v)
+			self.stats.inc('rowcache.evictions')
+
+		self.entries[ck] = v
+		self.bytes += size
+
+	def invalidate(self, table, k):
+		ck = (table, k)
+		try:
+			v = self.entries.pop(ck)
+		except KeyError:
+			return
+		self.bytes -= self.entry_size(ck, v)
+
+	def invalidate_range(self, table, start, end):
+		for ck in [ck for ck in self.entries
+			   if ck[0] == table and start <= ck[1] < end]:
+			self.invalidate(table, ck[1])
+
+	def clear(self):
+		self.entries.clear()
+		self.bytes = 0
+
+	def snapshot(self):
+		hits = self.stats.counters.get('rowcache.hits', 0)
+		misses = self.stats.counters.get('rowcache.misses', 0)
+		r = {
+			'entries' : len(self.entries),
+			'bytes' : self.bytes,
+			'max_bytes' : self.max_bytes,
+			'hit_rate' : 0.0,
+		}
+		if hits + misses > 0:
+			r['hit_rate'] = float(hits) / (hits + misses)
+		return r
@@ -0,0 +1,98 @@
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import time
+import json
+import collections
+
+
+# longest key prefix stored in a slow-op record, hex-encoded:
+# keys are binary
+KEY_TRACE_MAX = 64
+
+
+class RingSink(object):
+	def __init__(self, size=256):
+		self.recs = collections.deque(maxlen=size)
+
+	def emit(self, rec):
+		self.recs.append(rec)
+
+	def dump(self):
+		return list(self.recs)
+
+	def clear(self):
+		self.recs.clear()
+
+
+class FileSink(object):
+	def __init__(self, f):
+		self.f = f
+
+	def emit(self, rec):
+		self.f.write(json.dumps(rec, sort_keys=True) + "\n")
+		self.f.flush()
+
+
+class OpTrace(object):
+	def __init__(self, op):
+		self.op = op
+		self.start = time.time()
+		self.last = self.start
+		self.phases = []
+
+	def phase(self, name):
+		# close the phase that began at the previous mark
+		now = time.time()
+		self.phases.append((name, now - self.last))
+		self.last = now
+
+
+class NullTrace(object):
+	def phase(self, name):
+		pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class SlowLog(object):
+	def __init__(self, threshold=None, sink=None):
+		# threshold in seconds; None disables tracing entirely
+		self.threshold = threshold
+		if sink is None:
+			sink = RingSink()
+		self.sink = sink
+
+	def start(self, op):
+		if self.threshold is None:
+			return NULL_TRACE
+		return OpTrace(op)
+
+	def finish(self, trace, table=None, key=None):
+		if trace is NULL_TRACE:
+			return False
+
+		total = time.time() - trace.start
+		if total < self.threshold:
+			return False
+
+		rec = {
+			'op' : trace.op,
+			'time' : trace.start,
+			'total_us' : total * 1e6,
+			'phases' : [(name, secs * 1e6)
+				    for name, secs in trace.phases],
+		}
+		if table is not None:
+			rec['table'] = table
+		if key is not None:
+			rec['key'] = str(key[:KEY_TRACE_MAX]).encode('hex')
+
+		self.sink.emit(rec)
+
+		return True
@@ -0,0 +1,114 @@
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import time
+
+
+# bucket N holds latencies of [2^(N-1), 2^N) microseconds
+HIST_BUCKETS = 32
+
+HIST_PERCENTILES = [ 50.0, 90.0, 99.0, 99.9 ]
+
+
+class Histogram(object):
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.min = None
+		self.max = 0.0
+		self.buckets = [0] * HIST_BUCKETS
+
+	def add(self, secs):
+		us = secs * 1e6
+		b = int(us).bit_length()
+		if b >= HIST_BUCKETS:
+			b = HIST_BUCKETS - 1
+		self.buckets[b] += 1
+
+		self.count += 1
+		self.total += us
+		if self.min is None or us < self.min:
+			self.min = us
+		if us > self.max:
+			self.max = us
+
+	def percentile(self, p):
+		if self.count == 0:
+			return 0.0
+
+		want = (p / 100.0) * self.count
+		seen = 0
+		for b in xrange(HIST_BUCKETS):
+			seen += self.buckets[b]
+			if seen >= want:
+				# upper bound of bucket, clamped to observed max
+				return min(float(1 << b), self.max)
+
+		return self.max
+
+	def snapshot(self):
+		r = {
+			'count' : self.count,
+			'min_us' : self.min or 0.0,
+			'max_us' : self.max,
+			'avg_us' : 0.0,
+		}
+		if self.count > 0:
+			r['avg_us'] = self.total / self.count
+		for p in HIST_PERCENTILES:
+			r['p%g_us' % (p,)] = self.percentile(p)
+
+		return r
+
+
+class Stats(object):
+	def __init__(self, histograms=True):
+		self.histograms = histograms
+		self.counters = {}
+		self.hists = {}
+
+	def reset(self):
+		self.counters = {}
+		self.hists = {}
+
+	def inc(self, name, n=1):
+		try:
+			self.counters[name] += n
+		except KeyError:
+			self.counters[name] = n
+
+	def now(self):
+		if not self.histograms:
+			return 0.0
+		return time.time()
+
+	def timing(self, name, t0):
+		# count the operation, and record its latency if enabled;
+		# t0 is a value previously returned by now()
+		self.inc(name)
+
+		if not self.histograms:
+			return
+		try:
+			hist = self.hists[name]
+		except KeyError:
+			hist = Histogram()
+			self.hists[name] = hist
+		hist.add(time.time() - t0)
+
+	def snapshot(self):
+		# nest 'group.name' counters as r[group][name]
+		r = {}
+		for name, val in self.counters.iteritems():
+			group, sep, key = name.partition('.')
+			r.setdefault(group, {})[key] = val
+		for name, hist in self.hists.iteritems():
+			group, sep, key = name.partition('.')
+			r.setdefault(group, {})[key + '_latency'] = \
+				hist.snapshot()
+
+		return r
@@ -8,22 +8,289 @@
 
 import struct
 import os
+import collections
 
+import KeyArray
 import PDcodec_pb2
-from util import readrec, writepb, tryread, trywrite
+from util import readrec, writepb, tryread, trywrite, trypread, updcrc
+
+
+# roots with at least this many entries are written in the paged
+# format, and are read lazily, a page at a time
+PAGED_MIN_ENTS = 4096
+
+ROOT_PAGE_SZ = 4096
+
+# decoded pages kept per open root
+ROOT_CACHE_PAGES = 64
+
+# page header: crc32 of the rest of the page, level (0 = leaf), count
+PAGE_HDR = struct.Struct('<IHH')
+
+# leaf entry: key length, block file id; internal entry: key length,
+# child page number.  the key follows.
+LEAF_ENT = struct.Struct('<HQ')
+NODE_ENT = struct.Struct('<HI')
+
+# header page: page size, levels, root page, leaf page count, entries
+TREE_HDR = struct.Struct('<IIIIQ')
+
+
+def pack_pages(level, ents, ent_fmt):
+	# ents is a list of (key, int) in key order; returns a list of
+	# (max key, page data), or None if a key does not fit in a page
+	max_sz = ROOT_PAGE_SZ - PAGE_HDR.size
+	groups = []
+	body = []
+	body_sz = 0
+	for key, n in ents:
+		ent = ent_fmt.pack(len(key), n) + key
+		if len(ent) > max_sz:
+			return None
+		if body_sz + len(ent) > max_sz:
+			groups.append((last_key, body))
+			body = []
+			body_sz = 0
+		body.append(ent)
+		body_sz += len(ent)
+		last_key = key
+	if len(body) > 0:
+		groups.append((last_key, body))
+
+	pages = []
+	for last_key, body in groups:
+		data = struct.pack('<HH', level, len(body)) + ''.join(body)
+		data += '\0' * (ROOT_PAGE_SZ - 4 - len(data))
+		pages.append((last_key,
+			      struct.pack('<I', updcrc(data, 0)) + data))
+	return pages
+
+
+class RootTree(object):
+	# read-only B+tree of root entries.  page 0 holds the file
+	# header; leaves are pages 1..n_leaves, in key order, followed
+	# by the interior levels, ending with the single top page.
+	def __init__(self, fd):
+		self.fd = fd
+		self.depth = 0
+		self.root_page = 0
+		self.n_leaves = 0
+		self.n_ents = 0
+		self.cache = collections.OrderedDict()
+
+	def __del__(self):
+		self.close()
+
+	def close(self):
+		if self.fd is None:
+			return
+		os.close(self.fd)
+		self.fd = None
+
+	def open(self):
+		data = trypread(self.fd, ROOT_PAGE_SZ, 0)
+		if data is None or len(data) != ROOT_PAGE_SZ:
+			return False
+		if data[:8] != 'ROOTTREE':
+			return False
+
+		end = 8 + TREE_HDR.size
+		crc = struct.unpack('<I', data[end:end + 4])[0]
+		if crc != updcrc(data[:end], 0):
+			return False
+
+		(page_sz, self.depth, self.root_page, self.n_leaves,
+		 self.n_ents) = TREE_HDR.unpack(data[8:end])
+		if page_sz != ROOT_PAGE_SZ:
+			return False
+
+		return True
+
+	def page(self, page_no):
+		try:
+			pg = self.cache.pop(page_no)
+			self.cache[page_no] = pg
+			return pg
+		except KeyError:
+			pass
+
+		data = trypread(self.fd, ROOT_PAGE_SZ, page_no * ROOT_PAGE_SZ)
+		if data is None or len(data) != ROOT_PAGE_SZ:
+			return None
+		(crc, level, count) = PAGE_HDR.unpack(data[:PAGE_HDR.size])
+		if crc != updcrc(data[4:], 0):
+			return None
+
+		# leaf pages decode to RootEnt objects, interior pages
+		# to (max key, child page) tuples
+		ents = []
+		pos = PAGE_HDR.size
+		for i in xrange(count):
+			if level == 0:
+				(klen, fid) = LEAF_ENT.unpack_from(data, pos)
+				pos += LEAF_ENT.size
+				ent = PDcodec_pb2.RootEnt()
+				ent.key = data[pos:pos + klen]
+				ent.file_id = fid
+			else:
+				(klen, child) = NODE_ENT.unpack_from(data, pos)
+				pos += NODE_ENT.size
+				ent = (data[pos:pos + klen], child)
+			pos += klen
+			ents.append(ent)
+
+		pg = (level, ents)
+		self.cache[page_no] = pg
+		if len(self.cache) > ROOT_CACHE_PAGES:
+			self.cache.popitem(last=False)
+
+		return pg
+
+	def find(self, k):
+		# returns (leaf page number, index) of the first entry
+		# with key >= k, (None, None) if there is none, or None
+		# on read errors
+		page_no = self.root_page
+		while True:
+			pg = self.page(page_no)
+			if pg is None:
+				return None
+			(level, ents) = pg
+
+			lo = 0
+			hi = len(ents)
+			while lo < hi:
+				mid = (lo + hi) // 2
+				if level == 0:
+					key = ents[mid].key
+				else:
+					key = ents[mid][0]
+				if key < k:
+					lo = mid + 1
+				else:
+					hi = mid
+
+			if lo == len(ents):
+				return (None, None)
+			if level == 0:
+				return (page_no, lo)
+			page_no = ents[lo][1]
+
+	def iterate(self, page_no=1, idx=0):
+		while page_no <= self.n_leaves:
+			pg = self.page(page_no)
+			if pg is None:
+				raise IOError("root page read failed")
+			ents = pg[1]
+			while idx < len(ents):
+				yield ents[idx]
+				idx += 1
+			page_no += 1
+			idx = 0
+
+	def first(self):
+		pg = self.page(1)
+		if pg is None:
+			return None
+		return pg[1][0]
+
+	def last(self):
+		pg = self.page(self.n_leaves)
+		if pg is None:
+			return None
+		return pg[1][-1]
+
+
+def write_tree(fd, v):
+	# returns None, having written nothing, if some key is too
+	# long for a page
+	leaves = pack_pages(0, [(ent.key, ent.file_id) for ent in v],
+			    LEAF_ENT)
+	if leaves is None:
+		return None
+	if len(leaves) == 0:
+		return False
+
+	# number pages as written: leaves first, then each level up
+	pages = []
+	level_ents = []
+	for last_key, data in leaves:
+		pages.append(data)
+		level_ents.append((last_key, len(pages)))
+	depth = 1
+	while len(level_ents) > 1:
+		nodes = pack_pages(depth, level_ents, NODE_ENT)
+		if nodes is None:
+			return None
+		level_ents = []
+		for last_key, data in nodes:
+			pages.append(data)
+			level_ents.append((last_key, len(pages)))
+		depth += 1
+
+	hdr = 'ROOTTREE' + TREE_HDR.pack(ROOT_PAGE_SZ, depth, len(pages),
+					 len(leaves), len(v))
+	hdr += struct.pack('<I', updcrc(hdr, 0))
+	hdr += '\0' * (ROOT_PAGE_SZ - len(hdr))
+
+	return trywrite(fd, hdr + ''.join(pages))
 
 
 class TableRoot(object):
 	def __init__(self, dbdir, root_id):
 		self.dbdir = dbdir
 		self.root_id = root_id
-		self.v = []
+		self.ents = []
 		self.dirty = False
 
+		# paged roots are searched in place, until the full entry
+		# list is needed
+		self.tree = None
+
+		# uint64 tables' fence keys, as a KeyArray built on demand
+		self.int_keys = False
+		self.fences = None
+
+	def get_v(self):
+		if self.tree is not None:
+			self.ents = list(self.tree.iterate())
+			self.tree.close()
+			self.tree = None
+		return self.ents
+
+	def set_v(self, v):
+		if self.tree is not None:
+			self.tree.close()
+			self.tree = None
+		self.ents = v
+		self.fences = None
+
+	v = property(get_v, set_v)
+
+	def __len__(self):
+		if self.tree is not None:
+			return self.tree.n_ents
+		return len(self.ents)
+
+	def paged(self):
+		# whether dump writes the paged format
+		return len(self) >= PAGED_MIN_ENTS
+
 	def load(self):
 		name = "/root.%x" % (self.root_id,)
 		fd = os.open(self.dbdir + name, os.O_RDONLY)
 
+		if tryread(fd, 8) == 'ROOTTREE':
+			tree = RootTree(fd)
+			if not tree.open():
+				tree.close()
+				return False
+			self.v = []
+			self.tree = tree
+			self.dirty = False
+			return True
+		os.lseek(fd, 0, os.SEEK_SET)
+
 		rc = self.deserialize(fd)
 
 		os.close(fd)
@@ -39,7 +306,11 @@ class TableRoot(object):
 		fd = os.open(self.dbdir + name,
 			     os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0666)
 
-		rc = self.serialize(fd)
+		rc = None
+		if len(self.v) >= PAGED_MIN_ENTS:
+			rc = write_tree(fd, self.v)
+		if rc is None:
+			rc = self.serialize(fd)
 
 		os.close(fd)
 
@@ -88,34 +359,119 @@ class TableRoot(object):
 		return True
 
 	def first(self):
-		if len(self.v) == 0:
+		if self.tree is not None:
+			return self.tree.first()
+		if len(self.ents) == 0:
 			return None
-		return self.v[0]
+		return self.ents[0]
 
 	def last(self):
-		if len(self.v) == 0:
+		if self.tree is not None:
+			return self.tree.last()
+		if len(self.ents) == 0:
 			return None
-		return self.v[-1]
+		return self.ents[-1]
 
-	def lookup_pos(self, k):
-		for idx in xrange(len(self.v)):
-			if k <= self.v[idx].key:
-				return idx
+	def fence_keys(self):
+		if not self.int_keys or self.tree is not None:
+			return None
+		if self.fences is None:
+			self.fences = KeyArray.from_keys([ent.key
+							  for ent in self.ents])
+		return self.fences
 
-		return None
+	def lookup_pos(self, k):
+		# binary search, index of first fence key >= ours
+		v = self.v
+		fences = self.fence_keys()
+		if fences is not None and len(k) == KeyArray.KEY_LEN:
+			lo = fences.find(KeyArray.key_int(k))
+			if lo == len(v):
+				return None
+			return lo
+
+		lo = 0
+		hi = len(v)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if v[mid].key < k:
+				lo = mid + 1
+			else:
+				hi = mid
+
+		if lo == len(v):
+			return None
+		return lo
 
 	def lookup(self, k):
+		if self.tree is not None:
+			pos = self.tree.find(k)
+			if pos is None:
+				return None
+			(page_no, idx) = pos
+			if page_no is None:
+				return self.tree.last()
+			pg = self.tree.page(page_no)
+			if pg is None:
+				return None
+			return pg[1][idx]
+
 		idx = self.lookup_pos(k)
 		if idx is None:
 			return self.last()
 		return self.v[idx]
 
+	def lookup_many(self, keys):
+		# lookup for each of keys, which must be sorted
+		fences = self.fence_keys()
+		if (fences is not None and len(fences) > 0 and
+		    all(len(k) == KeyArray.KEY_LEN for k in keys)):
+			v = self.ents
+			last = v[-1]
+			return [v[idx] if idx < len(v) else last
+				for idx in fences.find_many(
+					KeyArray.key_ints(keys))]
+
+		ret = []
+		ent = None
+		for k in keys:
+			if ent is None or k > ent.key:
+				ent = self.lookup(k)
+			ret.append(ent)
+		return ret
+
+	def iterate(self, start=None):
+		# entries in key order, from the one whose block may
+		# hold start
+		if self.tree is not None:
+			if start is None:
+				pos = (1, 0)
+			else:
+				pos = self.tree.find(start)
+				if pos is None or pos[0] is None:
+					return
+			for ent in self.tree.iterate(pos[0], pos[1]):
+				yield ent
+			return
+
+		v = self.ents
+		if start is None:
+			idx = 0
+		else:
+			idx = self.lookup_pos(start)
+			if idx is None:
+				return
+		while idx < len(v):
+			yield v[idx]
+			idx += 1
+
 	def delete(self, n):
 		if n >= len(self.v):
 			return False
 
 		del self.v[n]
 		self.dirty = True
+		self.fences = None
 
 		return True
 
@@ -126,4 +482,5 @@ class TableRoot(object):
 		else:
 			self.v.insert(idx, ent)
 		self.dirty = True
+		self.fences = None
 
@@ -0,0 +1,227 @@
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import os
+import mmap
+import struct
+
+import Stats
+from util import trywrite, tryread, readrec, readrecstr, writerecstr
+
+
+# start a new value log file once the current one passes this size
+VLOG_MAX_SZ = 64 * 1024 * 1024
+
+VPTR_SZ = 8 + 8 + 4
+
+
+class ValuePtr(object):
+	def __init__(self, file_id=0, offset=0, length=0):
+		self.file_id = file_id
+		self.offset = offset
+		self.length = length
+
+	def __eq__(self, other):
+		return (isinstance(other, ValuePtr) and
+			self.file_id == other.file_id and
+			self.offset == other.offset and
+			self.length == other.length)
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def deserialize(self, s):
+		(self.file_id, self.offset, self.length) = \
+			struct.unpack('<QQI', s)
+		return True
+
+	def serialize(self):
+		return struct.pack('<QQI', self.file_id, self.offset,
+				   self.length)
+
+
+class ValueLog(object):
+	def __init__(self, super, threshold=None, stats=None):
+		# values of threshold bytes or larger are stored in the
+		# value log during checkpoint; None disables
+		self.super = super
+		self.dbdir = super.dbdir
+		self.threshold = threshold
+		self.fd = None
+		self.file_id = None
+		self.pos = 0
+		self.maps = {}
+		if stats is None:
+			stats = Stats.Stats(False)
+		self.stats = stats
+
+	def __del__(self):
+		self.close()
+
+	def close(self):
+		self.roll()
+		for file_id in self.maps.keys():
+			self.unmap(file_id)
+
+	def filename(self, file_id):
+		return self.dbdir + "/vlog.%x" % (file_id,)
+
+	def want(self, value):
+		return (self.threshold is not None and
+			len(value) >= self.threshold)
+
+	def roll(self):
+		# stop appending to the current file
+		if self.fd is None:
+			return
+		try:
+			os.close(self.fd)
+		except OSError:
+			pass
+		self.fd = None
+		self.file_id = None
+
+	def create(self):
+		file_id = self.super.new_fileid()
+		try:
+			fd = os.open(self.filename(file_id),
+				     os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0666)
+		except OSError:
+			return False
+
+		if not trywrite(fd, 'VALUELOG'):
+			os.close(fd)
+			return False
+
+		self.fd = fd
+		self.file_id = file_id
+		self.pos = 8
+		self.super.vlog_ids.append(file_id)
+
+		return True
+
+	def append(self, table, key, value):
+		if self.fd is None or self.pos > VLOG_MAX_SZ:
+			self.roll()
+			if not self.create():
+				return None
+
+		# the owning table and key are stored alongside the value,
+		# so that GC can tell whether the value is still live
+		table = str(table)
+		hdr = struct.pack('<II', len(table), len(key))
+		rec_data = writerecstr('VREC', hdr + table + key + value)
+		if not trywrite(self.fd, rec_data):
+			return None
+
+		ptr = ValuePtr(self.file_id,
+			       self.pos + 8 + len(hdr) + len(table) + len(key),
+			       len(value))
+		self.pos += len(rec_data)
+
+		self.stats.inc('vlog.appends')
+		self.stats.inc('vlog.bytes', len(rec_data))
+
+		return ptr
+
+	def sync(self):
+		if self.fd is None:
+			return True
+		try:
+			os.fsync(self.fd)
+		except OSError:
+			return False
+		return True
+
+	def unmap(self, file_id):
+		try:
+			(fd, map) = self.maps.pop(file_id)
+		except KeyError:
+			return
+		map.close()
+		os.close(fd)
+
+	def getmap(self, file_id, end):
+		if file_id in self.maps:
+			map = self.maps[file_id][1]
+			if end <= len(map):
+				return map
+
+			# file grew since it was mapped
+			self.unmap(file_id)
+
+		try:
+			fd = os.open(self.filename(file_id), os.O_RDONLY)
+			map = mmap.mmap(fd, 0, mmap.MAP_SHARED, mmap.PROT_READ)
+		except (OSError, mmap.error):
+			return None
+
+		self.maps[file_id] = (fd, map)
+		if end > len(map):
+			return None
+		return map
+
+	def read(self, ptr, table, key):
+		# the value's whole VREC record is checked: its crc, and
+		# that it belongs to table and key.  None if the file is
+		# missing or the record does not check out
+		table = str(table)
+		start = ptr.offset - 16 - len(table) - len(key)
+		end = ptr.offset + ptr.length + 4
+		if start < 8:
+			return None
+		map = self.getmap(ptr.file_id, end)
+		if map is None:
+			return None
+
+		self.stats.inc('vlog.reads')
+		tup = readrecstr(map[start : end])
+		hdr = struct.pack('<II', len(table), len(key)) + table + key
+		if (tup is None or tup[0] != 'VREC' or
+		    len(tup[1]) != len(hdr) + ptr.length or
+		    tup[1][:len(hdr)] != hdr):
+			self.stats.inc('vlog.read_errors')
+			return None
+		return tup[1][len(hdr):]
+
+	def iterate(self, file_id):
+		# yields (table, key, ValuePtr) for each record in the file
+		try:
+			fd = os.open(self.filename(file_id), os.O_RDONLY)
+		except OSError:
+			return
+
+		try:
+			if tryread(fd, 8) != 'VALUELOG':
+				return
+			pos = 8
+			while True:
+				tup = readrec(fd)
+				if tup is None:
+					return
+				data = tup[1]
+				(t_len, k_len) = struct.unpack('<II', data[:8])
+				table = data[8 : 8 + t_len]
+				key = data[8 + t_len : 8 + t_len + k_len]
+				v_off = pos + 8 + 8 + t_len + k_len
+				v_len = len(data) - (8 + t_len + k_len)
+
+				yield (table, key, ValuePtr(file_id, v_off, v_len))
+
+				pos += 8 + len(data) + 4
+		finally:
+			os.close(fd)
+
+	def remove(self, file_id):
+		if file_id == self.file_id:
+			self.roll()
+		self.unmap(file_id)
+		try:
+			os.unlink(self.filename(file_id))
+		except OSError:
+			return False
+		return True
@@ -0,0 +1,551 @@
+#!/usr/bin/python
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import sys
+import os
+import shutil
+import time
+import json
+import random
+import argparse
+
+import PageDb
+import KeyArray
+import Advise
+
+DBTABLE = 'bench'
+
+ALL_BENCHMARKS = [
+	'fillseq',
+	'fillrandom',
+	'overwrite',
+	'readrandom',
+	'readview',
+	'readmissing',
+	'readmany',
+	'readseq',
+	'deleterandom',
+	'deletemissing',
+	'checkpoint',
+	'replay',
+	'restart',
+]
+
+PERCENTILES = [ 50.0, 75.0, 90.0, 99.0, 99.9 ]
+
+
+class Latency(object):
+	def __init__(self):
+		self.v = []
+
+	def add(self, secs):
+		self.v.append(secs)
+
+	def percentile(self, p):
+		if len(self.v) == 0:
+			return 0.0
+		idx = int(round((p / 100.0) * (len(self.v) - 1)))
+		return self.v[idx]
+
+	def summary(self):
+		self.v.sort()
+		r = {}
+		for p in PERCENTILES:
+			r['p%g' % (p,)] = self.percentile(p) * 1e6
+		if len(self.v) > 0:
+			r['min'] = self.v[0] * 1e6
+			r['max'] = self.v[-1] * 1e6
+			r['avg'] = (sum(self.v) / len(self.v)) * 1e6
+		return r
+
+
+class ValueGen(object):
+	def __init__(self, rnd, size):
+		# slices of a pre-generated random buffer, so that value
+		# generation does not dominate the timings
+		self.size = size
+		self.data = ''.join(chr(rnd.randint(0, 255))
+				    for i in xrange(max(size * 4, 1024 * 1024)))
+		self.pos = 0
+
+	def next(self):
+		if self.pos + self.size > len(self.data):
+			self.pos = 0
+		v = self.data[self.pos : self.pos + self.size]
+		self.pos += self.size
+		return v
+
+
+class Bench(object):
+	def __init__(self, args):
+		self.args = args
+		self.rnd = random.Random(args.seed)
+		self.valgen = ValueGen(self.rnd, args.value_size)
+		self.db = None
+		self.table = None
+
+	def key(self, i):
+		if self.args.key_encoding == 'uint64':
+			return KeyArray.key_str(2 * i)
+		return '%0*d' % (self.args.key_size, i)
+
+	def missing_key(self, i):
+		# sorts among the real keys, but never written
+		if self.args.key_encoding == 'uint64':
+			return KeyArray.key_str(2 * i + 1)
+		return self.key(i) + '.'
+
+	def fresh_db(self):
+		dbdir = self.args.dbdir
+		if os.path.isdir(dbdir):
+			shutil.rmtree(dbdir)
+		os.mkdir(dbdir)
+
+		self.db = PageDb.PageDb()
+		self.db.compact_log = (self.args.log_format == 'compact')
+		if not self.db.create(dbdir):
+			raise RuntimeError("db create failed")
+		opts = {}
+		if self.args.block_size:
+			opts['target_blk_sz'] = self.args.block_size
+		if self.args.compression != 'none':
+			opts['compression'] = self.args.compression
+		if self.args.bloom_bits:
+			opts['bloom_bits'] = self.args.bloom_bits
+		if self.args.key_encoding != 'bytes':
+			opts['key_encoding'] = self.args.key_encoding
+		if not self.db.create_table(DBTABLE, opts):
+			raise RuntimeError("table create failed")
+		self.open_table()
+
+	def reopen_db(self):
+		self.db = None
+		self.table = None
+		if self.args.cold:
+			self.drop_cache()
+		self.db = PageDb.PageDb()
+		self.db.compact_log = (self.args.log_format == 'compact')
+		if not self.db.open(self.args.dbdir):
+			raise RuntimeError("db open failed")
+		self.open_table()
+
+	def drop_cache(self):
+		# written back, then dropped from the page cache, so that
+		# reads come from disk
+		dbdir = self.args.dbdir
+		for name in os.listdir(dbdir):
+			fd = os.open(dbdir + '/' + name, os.O_RDONLY)
+			os.fsync(fd)
+			os.close(fd)
+			if not Advise.evict(dbdir + '/' + name):
+				raise RuntimeError("page cache eviction failed")
+
+	def resident_kb(self):
+		# block file data in the page cache
+		dbdir = self.args.dbdir
+		n = 0
+		for name in os.listdir(dbdir):
+			if name.startswith('block.'):
+				n += Advise.file_resident(dbdir + '/' + name)
+		return n // 1024
+
+	def open_table(self):
+		self.db.set_access_hints(self.args.hints)
+		if self.args.buffer_pool:
+			self.db.use_buffer_pool(self.args.buffer_pool *
+						1024 * 1024,
+						self.args.page_size)
+		if self.args.mem_budget:
+			self.db.set_memtable_limits(self.args.mem_budget *
+						    1024 * 1024)
+		self.table = self.db.open_table(DBTABLE)
+		if self.table is None:
+			raise RuntimeError("table open failed")
+
+	def checkpoint(self):
+		if not self.db.checkpoint():
+			raise RuntimeError("checkpoint failed")
+
+	def write_keys(self, keys, delete=False, lat=None):
+		batch = self.args.batch
+		txn = None
+		n_bytes = 0
+		for i in xrange(len(keys)):
+			t0 = time.time()
+
+			if txn is None:
+				txn = self.db.txn_begin()
+				if txn is None and self.db.stalled():
+					self.checkpoint()
+					txn = self.db.txn_begin()
+				if txn is None:
+					raise RuntimeError("txn begin failed")
+
+			k = keys[i]
+			if delete:
+				self.table.delete(txn, k,
+						  self.args.check_deletes)
+				n_bytes += len(k)
+			else:
+				v = self.valgen.next()
+				if not self.table.put(txn, k, v):
+					raise RuntimeError("put failed")
+				n_bytes += len(k) + len(v)
+
+			if ((i + 1) % batch) == 0 or i == len(keys) - 1:
+				if not self.db.txn_commit(txn,
+							  self.args.sync):
+					raise RuntimeError("commit failed")
+				txn = None
+
+			if lat is not None:
+				lat.add(time.time() - t0)
+
+		return n_bytes
+
+	def seq_keys(self):
+		return [self.key(i) for i in xrange(self.args.num)]
+
+	def random_keys(self, n):
+		return [self.key(self.rnd.randint(0, self.args.num - 1))
+			for i in xrange(n)]
+
+	def shuffled_keys(self):
+		keys = self.seq_keys()
+		self.rnd.shuffle(keys)
+		return keys
+
+	def prefill(self):
+		self.fresh_db()
+		self.write_keys(self.seq_keys())
+		self.checkpoint()
+
+	def timed_writes(self, keys, delete=False):
+		lat = Latency()
+		t0 = time.time()
+		n_bytes = self.write_keys(keys, delete, lat)
+		return (len(keys), n_bytes, time.time() - t0, lat)
+
+	def bench_fillseq(self):
+		self.fresh_db()
+		return self.timed_writes(self.seq_keys())
+
+	def bench_fillrandom(self):
+		self.fresh_db()
+		return self.timed_writes(self.shuffled_keys())
+
+	def bench_overwrite(self):
+		self.prefill()
+		return self.timed_writes(self.random_keys(self.args.num))
+
+	def bench_deleterandom(self):
+		self.prefill()
+		return self.timed_writes(self.shuffled_keys(), True)
+
+	def bench_deletemissing(self):
+		# purge of keys already gone
+		self.prefill()
+		self.reopen_db()
+		keys = [self.missing_key(i) for i in xrange(self.args.num)]
+		self.rnd.shuffle(keys)
+		return self.timed_writes(keys, True)
+
+	def timed_reads(self, keys, expect, view=False):
+		lat = Latency()
+		n_bytes = 0
+		found = 0
+		t_start = time.time()
+		for k in keys:
+			t0 = time.time()
+			if view:
+				v = self.table.get_view(None, k)
+				if v is not None:
+					v[1].release()
+					v = v[0]
+			else:
+				v = self.table.get(None, k)
+			lat.add(time.time() - t0)
+			if v is not None:
+				found += 1
+				n_bytes += len(v)
+		secs = time.time() - t_start
+
+		if expect and found != len(keys):
+			raise RuntimeError("%d of %d keys not found" %
+					   (len(keys) - found, len(keys)))
+		if not expect and found != 0:
+			raise RuntimeError("%d missing keys found" % (found,))
+
+		return (len(keys), n_bytes, secs, lat)
+
+	def bench_readrandom(self):
+		self.prefill()
+		self.reopen_db()
+		return self.timed_reads(self.random_keys(self.args.reads),
+					True)
+
+	def bench_readview(self):
+		# as readrandom, through zero-copy views
+		self.prefill()
+		self.reopen_db()
+		return self.timed_reads(self.random_keys(self.args.reads),
+					True, True)
+
+	def bench_readmissing(self):
+		self.prefill()
+		self.reopen_db()
+		keys = [self.missing_key(self.rnd.randint(0, self.args.num - 1))
+			for i in xrange(self.args.reads)]
+		return self.timed_reads(keys, False)
+
+	def bench_readmany(self):
+		# random reads, --batch keys to a get_many call
+		self.prefill()
+		self.reopen_db()
+		keys = self.random_keys(self.args.reads)
+		batch = self.args.batch
+
+		lat = Latency()
+		n_bytes = 0
+		found = 0
+		t_start = time.time()
+		for i in xrange(0, len(keys), batch):
+			t0 = time.time()
+			vals = self.table.get_many(None, keys[i:i + batch])
+			lat.add(time.time() - t0)
+			for v in vals:
+				if v is not None:
+					found += 1
+					n_bytes += len(v)
+		secs = time.time() - t_start
+
+		if found != len(keys):
+			raise RuntimeError("%d of %d keys not found" %
+					   (len(keys) - found, len(keys)))
+
+		return (len(keys), n_bytes, secs, lat)
+
+	def bench_readseq(self):
+		self.prefill()
+		self.reopen_db()
+
+		lat = Latency()
+		n_ops = 0
+		n_bytes = 0
+		t_start = time.time()
+		t0 = t_start
+		for k, v in self.table.scan(None):
+			t1 = time.time()
+			lat.add(t1 - t0)
+			t0 = t1
+			n_ops += 1
+			n_bytes += len(k) + len(v)
+		secs = time.time() - t_start
+
+		if n_ops != self.args.num:
+			raise RuntimeError("scan returned %d of %d keys" %
+					   (n_ops, self.args.num))
+
+		return (n_ops, n_bytes, secs, lat)
+
+	def bench_checkpoint(self):
+		self.fresh_db()
+		n_bytes = self.write_keys(self.shuffled_keys())
+
+		lat = Latency()
+		t0 = time.time()
+		self.checkpoint()
+		secs = time.time() - t0
+		lat.add(secs)
+
+		# reopen, to prove the checkpoint is readable
+		self.reopen_db()
+
+		return (self.args.num, n_bytes, secs, lat)
+
+	def bench_replay(self):
+		self.fresh_db()
+		n_bytes = self.write_keys(self.shuffled_keys())
+		self.db = None
+		self.table = None
+
+		lat = Latency()
+		t0 = time.time()
+		self.reopen_db()
+		secs = time.time() - t0
+		lat.add(secs)
+
+		return (self.args.num, n_bytes, secs, lat)
+
+	def bench_restart(self):
+		# as replay, after a clean close saved the memtable
+		self.fresh_db()
+		n_bytes = self.write_keys(self.shuffled_keys())
+		if not self.db.close():
+			raise RuntimeError("close failed")
+		self.db = None
+		self.table = None
+
+		lat = Latency()
+		t0 = time.time()
+		self.reopen_db()
+		secs = time.time() - t0
+		lat.add(secs)
+
+		return (self.args.num, n_bytes, secs, lat)
+
+	def run(self, name):
+		fn = getattr(self, 'bench_' + name)
+		(n_ops, n_bytes, secs, lat) = fn()
+		self.db = None
+		self.table = None
+		resident = None
+		if self.args.cold:
+			resident = self.resident_kb()
+
+		r = {
+			'name' : name,
+			'ops' : n_ops,
+			'bytes' : n_bytes,
+			'secs' : secs,
+			'latency_us' : lat.summary(),
+		}
+		if secs > 0:
+			r['ops_per_sec'] = n_ops / secs
+			r['mb_per_sec'] = (n_bytes / (1024.0 * 1024.0)) / secs
+		else:
+			r['ops_per_sec'] = 0.0
+			r['mb_per_sec'] = 0.0
+		if resident is not None:
+			r['resident_kb'] = resident
+
+		return r
+
+
+def parse_args(argv):
+	p = argparse.ArgumentParser(description='pagedb benchmarks')
+	p.add_argument('--benchmarks', default=','.join(ALL_BENCHMARKS),
+		       help='comma-separated list of benchmarks to run')
+	p.add_argument('--num', type=int, default=10000,
+		       help='number of keys written')
+	p.add_argument('--reads', type=int, default=None,
+		       help='number of read operations (default: num)')
+	p.add_argument('--key-size', type=int, default=16,
+		       help='key size in bytes')
+	p.add_argument('--value-size', type=int, default=100,
+		       help='value size in bytes')
+	p.add_argument('--batch', type=int, default=1,
+		       help='writes per transaction, and keys per get_many')
+	p.add_argument('--sync', dest='sync', action='store_true',
+		       default=True, help='fsync log on commit (default)')
+	p.add_argument('--no-sync', dest='sync', action='store_false',
+		       help='do not fsync log on commit')
+	p.add_argument('--check-deletes', action='store_true',
+		       default=False,
+		       help='read each key before deleting it')
+	p.add_argument('--buffer-pool', type=int, default=0,
+		       help='read blocks through a buffer pool of this many '
+			    'MB, rather than mmap')
+	p.add_argument('--page-size', type=int, default=16384,
+		       help='buffer pool page size')
+	p.add_argument('--log-format', default='compact',
+		       choices=['compact', 'protobuf'],
+		       help='log data record encoding')
+	p.add_argument('--block-size', type=int, default=0,
+		       help='table target block size (default: Block.py)')
+	p.add_argument('--compression', default='none',
+		       choices=['none', 'zlib'],
+		       help='table value compression')
+	p.add_argument('--key-encoding', default='bytes',
+		       choices=['bytes', 'uint64'],
+		       help='table key type; uint64 ignores --key-size')
+	p.add_argument('--bloom-bits', type=int, default=0,
+		       help='table Bloom filter bits per key')
+	p.add_argument('--mem-budget', type=int, default=0,
+		       help='checkpoint automatically past this many MB of '
+			    'memtable')
+	p.add_argument('--cold', action='store_true', default=False,
+		       help='drop database files from the page cache '
+			    'before each read benchmark')
+	p.add_argument('--hints', dest='hints', action='store_true',
+		       default=False,
+		       help='madvise/fadvise block access patterns')
+	p.add_argument('--no-hints', dest='hints', action='store_false',
+		       help='leave block readahead to the kernel (default)')
+	p.add_argument('--dbdir', default='/tmp/pagedb-bench',
+		       help='scratch database directory')
+	p.add_argument('--seed', type=int, default=301,
+		       help='random seed')
+	p.add_argument('--output', default=None,
+		       help='write JSON report to file, rather than stdout')
+
+	args = p.parse_args(argv)
+	if args.reads is None:
+		args.reads = args.num
+	if args.num < 1 or args.batch < 1:
+		p.error('--num and --batch must be positive')
+
+	return args
+
+
+def main(argv):
+	args = parse_args(argv)
+
+	names = [s for s in args.benchmarks.split(',') if s]
+	for name in names:
+		if name not in ALL_BENCHMARKS:
+			sys.stderr.write("unknown benchmark: %s\n" % (name,))
+			return 1
+
+	bench = Bench(args)
+	results = []
+	for name in names:
+		r = bench.run(name)
+		sys.stderr.write("%-12s : %10.1f ops/sec  p99 %.1f us\n" %
+				 (name, r['ops_per_sec'],
+				  r['latency_us']['p99']))
+		results.append(r)
+
+	report = {
+		'time' : time.time(),
+		'config' : {
+			'num' : args.num,
+			'reads' : args.reads,
+			'key_size' : args.key_size,
+			'value_size' : args.value_size,
+			'batch' : args.batch,
+			'sync' : args.sync,
+			'seed' : args.seed,
+			'buffer_pool' : args.buffer_pool,
+			'page_size' : args.page_size,
+			'log_format' : args.log_format,
+			'check_deletes' : args.check_deletes,
+			'block_size' : args.block_size,
+			'compression' : args.compression,
+			'bloom_bits' : args.bloom_bits,
+			'key_encoding' : args.key_encoding,
+			'mem_budget' : args.mem_budget,
+			'cold' : args.cold,
+			'hints' : args.hints,
+		},
+		'results' : results,
+	}
+
+	data = json.dumps(report, indent=2, sort_keys=True)
+	if args.output:
+		f = open(args.output, 'w')
+		f.write(data + "\n")
+		f.close()
+	else:
+		sys.stdout.write(data + "\n")
+
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -3,8 +3,9 @@
 import os
 import sys
 import struct
+import zlib
 
-import TableRoot, PageDb, PDcodec_pb2, Block
+import TableRoot, PageDb, PDcodec_pb2, Block, ValueLog, MemSnapshot
 from util import tryread, readrec
 
 
@@ -20,7 +21,7 @@ def dblock(fd):
 
 		recstr = "%s(%d)" % (recname, fpos)
 
-		if recname == 'DATA':
+		if recname in ('DATA', 'DATZ', 'VPTR'):
 			hdr = data[:8]
 			data = data[8:]
 
@@ -32,7 +33,22 @@ def dblock(fd):
 
 			print recstr, blkent.k_len, blkent.v_len
 			print blkent.k
-			print blkent.v, "\n"
+			if recname == 'VPTR':
+				ptr = ValueLog.ValuePtr()
+				ptr.deserialize(blkent.v)
+				print "-> vlog.%x @%d len %d\n" % \
+					(ptr.file_id, ptr.offset, ptr.length)
+			elif recname == 'DATZ':
+				print zlib.decompress(blkent.v), "\n"
+			else:
+				print blkent.v, "\n"
+
+		elif recname == 'BLOM':
+			print recstr, ord(data[0]), "probes,", \
+				(len(data) - 1) * 8, "bits"
+
+		elif recname == 'KU64':
+			print recstr, len(data) // 8, "keys"
 
 		elif recname == 'DTRL':
 			(arrpos, n_vals) = struct.unpack('<II', data)
@@ -90,6 +106,23 @@ def dtableroot(fd):
 
 	return True
 
+def droottree(fd):
+	tree = TableRoot.RootTree(fd)
+	if not tree.open():
+		print "RootTree header failed"
+		return False
+
+	print "depth %d, %d leaf pages, %d entries" % (tree.depth,
+		tree.n_leaves, tree.n_ents)
+	try:
+		for ent in tree.iterate():
+			print "%d %s" % (ent.file_id, ent.key)
+	except IOError:
+		print "RootTree page failed"
+		return False
+
+	return True
+
 def dlogger(fd):
 	while True:
 		tup = readrec(fd)
@@ -101,6 +134,78 @@ def dlogger(fd):
 
 		print recname
 
+def dvaluelog(fd):
+	while True:
+		fpos = os.lseek(fd, 0, os.SEEK_CUR)
+		tup = readrec(fd)
+		if tup is None:
+			return True
+
+		recname = tup[0]
+		data = tup[1]
+
+		(t_len, k_len) = struct.unpack('<II', data[:8])
+		table = data[8 : 8 + t_len]
+		key = data[8 + t_len : 8 + t_len + k_len]
+		print "%s(%d) %s %s %d" % (recname, fpos, table, key,
+					   len(data) - (8 + t_len + k_len))
+
+def dmanifest(fd):
+	while True:
+		tup = readrec(fd)
+		if tup is None:
+			return True
+
+		recname = tup[0]
+		data = tup[1]
+
+		obj = PDcodec_pb2.VersionEdit()
+		try:
+			obj.ParseFromString(data)
+		except google.protobuf.message.DecodeError:
+			print "VersionEdit deser failed"
+			return False
+
+		print recname
+		print str(obj)
+
+def dmemtable(fd):
+	while True:
+		tup = readrec(fd)
+		if tup is None:
+			return True
+
+		recname = tup[0]
+		data = tup[1]
+
+		if recname == 'MEMH':
+			obj = PDcodec_pb2.MemSnapshot()
+			try:
+				obj.ParseFromString(data)
+			except google.protobuf.message.DecodeError:
+				print "MemSnapshot deser failed"
+				return False
+			print str(obj)
+		elif recname == 'MKVS':
+			snap = MemSnapshot.MemSnapshot(None)
+			if not snap.deserialize_kvs(data):
+				print "MKVS deser failed"
+				return False
+			for name, (log_cache, log_del_cache) in \
+			    snap.tables.iteritems():
+				print "MKVS %s %d keys, %d deleted" % (name,
+					len(log_cache), len(log_del_cache))
+		elif recname == 'MRNG':
+			snap = MemSnapshot.MemSnapshot(None)
+			if not snap.deserialize_ranges(data):
+				print "MRNG deser failed"
+				return False
+			for name, range_dels in snap.range_dels.iteritems():
+				for start, end in range_dels:
+					print "MRNG %s [%s, %s)" % (name, start, end)
+		else:
+			print recname
+
 def dumpfile(filename):
 	fd = os.open(filename, os.O_RDONLY)
 
@@ -117,9 +222,21 @@ def dumpfile(filename):
 	elif magic == 'TABLROOT':
 		return dtableroot(fd)
 
+	elif magic == 'ROOTTREE':
+		return droottree(fd)
+
 	elif magic == 'SUPER   ':
 		return dsuper(fd)
 
+	elif magic == 'VALUELOG':
+		return dvaluelog(fd)
+
+	elif magic == 'MANIFEST':
+		return dmanifest(fd)
+
+	elif magic == 'MEMTABLE':
+		return dmemtable(fd)
+
 	return False
 
 
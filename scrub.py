@@ -0,0 +1,365 @@
+#!/usr/bin/python
+#
+# Copyright 2012 Red Hat, Inc.
+#
+# Distributed under the MIT/X11 software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+
+import os
+import re
+import sys
+import time
+import json
+import struct
+import argparse
+import multiprocessing
+import google.protobuf.message
+
+import PageDb, PDcodec_pb2, Block, TableRoot
+from util import tryread, trypread, readrec
+
+
+FILE_RE = re.compile(r'^(block|root|log|vlog|manifest)\.([0-9a-f]+)$')
+
+# immutable once written, and therefore safe to skip once verified.
+# roots are immutable too, but are always re-read, because they name
+# the reachable blocks.
+INCREMENTAL_KINDS = ( 'block', )
+
+# record-structured files, read sequentially
+LOG_MAGIC = {
+	'log' : 'LOGGER  ',
+	'vlog' : 'VALUELOG',
+	'manifest' : 'MANIFEST',
+}
+
+
+class Throttle(object):
+	def __init__(self, rate):
+		# rate in bytes/sec; zero means unlimited
+		self.rate = rate
+		self.start = time.time()
+		self.done = 0
+
+	def __call__(self, n):
+		self.done += n
+		if self.rate <= 0:
+			return
+		ahead = (self.done / float(self.rate)) - \
+			(time.time() - self.start)
+		if ahead > 0:
+			time.sleep(ahead)
+
+
+worker_throttle = Throttle(0)
+
+def init_worker(rate):
+	global worker_throttle
+	worker_throttle = Throttle(rate)
+
+
+def filename(kind, file_id):
+	return "%s.%x" % (kind, file_id)
+
+def scrub_block(dbdir, file_id, throttle):
+	block = Block.Block(dbdir, file_id)
+	if not block.open():
+		return "open failed"
+	err = block.verify(throttle)
+	block.close()
+	return err
+
+def scrub_root(dbdir, file_id, throttle):
+	try:
+		st = os.stat(dbdir + '/' + filename('root', file_id))
+		root = TableRoot.TableRoot(dbdir, file_id)
+		if not root.load():
+			return ("load failed", [])
+	except OSError:
+		return ("open failed", [])
+	throttle(st.st_size)
+
+	try:
+		v = root.v
+	except IOError:
+		return ("root page corrupt", [])
+
+	last_key = None
+	for ent in v:
+		if last_key is not None and ent.key <= last_key:
+			return ("fence keys out of order", [])
+		last_key = ent.key
+
+	return (None, [ent.file_id for ent in v])
+
+def torn_record(fd, pos, size):
+	# whether the unreadable record at pos is a torn write: one
+	# that runs past the end of the file
+	hdr = trypread(fd, 8, pos)
+	if hdr is None or len(hdr) < 8:
+		return True
+	n = struct.unpack('<I', hdr[4:])[0]
+	return pos + 8 + n + 4 > size
+
+def scrub_log(dbdir, kind, file_id, throttle):
+	# returns (error, warning, {table name: root id})
+	tables = {}
+	try:
+		fd = os.open(dbdir + '/' + filename(kind, file_id),
+			     os.O_RDONLY)
+	except OSError:
+		return ("open failed", None, tables)
+
+	try:
+		st = os.fstat(fd)
+		if tryread(fd, 8) != LOG_MAGIC[kind]:
+			return ("bad header", None, tables)
+
+		while True:
+			pos = os.lseek(fd, 0, os.SEEK_CUR)
+			tup = readrec(fd)
+			if tup is None:
+				break
+			throttle(12 + len(tup[1]))
+
+			if tup[0] == 'LTBL':
+				obj = PDcodec_pb2.LogTable()
+				try:
+					obj.ParseFromString(tup[1])
+				except google.protobuf.message.DecodeError:
+					return ("bad table record at %d" % (pos,),
+						None, tables)
+				tables[obj.tabname] = obj.root_id
+
+		torn = torn_record(fd, pos, st.st_size)
+	finally:
+		os.close(fd)
+
+	if pos == st.st_size:
+		return (None, None, tables)
+
+	# an incomplete final record is a torn write, which replay
+	# tolerates; report it, but do not call it corruption.  a bad
+	# record with data after it loses every later record.
+	if not torn:
+		return ("bad record at %d of %d" % (pos, st.st_size),
+			None, tables)
+	return (None, "unreadable tail at %d of %d" %
+		(pos, st.st_size), tables)
+
+def scrub_one(task):
+	(kind, dbdir, file_id) = task
+	throttle = worker_throttle
+
+	r = {
+		'kind' : kind,
+		'file_id' : file_id,
+		'name' : filename(kind, file_id),
+		'error' : None,
+	}
+	if kind == 'block':
+		r['error'] = scrub_block(dbdir, file_id, throttle)
+	elif kind == 'root':
+		(r['error'], r['blocks']) = scrub_root(dbdir, file_id,
+						       throttle)
+	elif kind in LOG_MAGIC:
+		(r['error'], r['warning'], r['tables']) = \
+			scrub_log(dbdir, kind, file_id, throttle)
+
+	return r
+
+
+class Scrubber(object):
+	def __init__(self, dbdir, workers=1, rate=0, state_file=None,
+		     incremental=False):
+		self.dbdir = dbdir
+		self.workers = workers
+		self.rate = rate
+		self.state_file = state_file
+		self.incremental = incremental
+		self.state = {}
+		self.pool = None
+
+		self.reachable = set()
+		self.corrupt = []
+		self.warnings = []
+		self.n_verified = 0
+		self.n_skipped = 0
+
+	def load_state(self):
+		if self.state_file is None or not self.incremental:
+			return
+		try:
+			f = open(self.state_file)
+			self.state = json.load(f)
+			f.close()
+		except (IOError, ValueError):
+			self.state = {}
+
+	def save_state(self):
+		if self.state_file is None:
+			return
+		tmpname = self.state_file + '.tmp'
+		f = open(tmpname, 'w')
+		json.dump(self.state, f, sort_keys=True)
+		f.close()
+		os.rename(tmpname, self.state_file)
+
+	def file_sig(self, name):
+		try:
+			st = os.stat(self.dbdir + '/' + name)
+		except OSError:
+			return None
+		return [st.st_size, int(st.st_mtime)]
+
+	def verify_files(self, kind, file_ids):
+		tasks = []
+		for file_id in file_ids:
+			name = filename(kind, file_id)
+			self.reachable.add(name)
+			if (kind in INCREMENTAL_KINDS and
+			    name in self.state and
+			    self.state[name] == self.file_sig(name)):
+				self.n_skipped += 1
+				continue
+			tasks.append((kind, self.dbdir, file_id))
+
+		if self.pool is None:
+			results = map(scrub_one, tasks)
+		else:
+			results = self.pool.map(scrub_one, tasks)
+
+		for r in results:
+			self.n_verified += 1
+			if r['error'] is not None:
+				self.corrupt.append((r['name'], r['error']))
+				self.state.pop(r['name'], None)
+				continue
+			if r.get('warning'):
+				self.warnings.append((r['name'], r['warning']))
+			if r['kind'] in INCREMENTAL_KINDS:
+				self.state[r['name']] = self.file_sig(r['name'])
+
+		return results
+
+	def scrub_super(self):
+		self.reachable.add('super')
+		sb = PageDb.PDSuper(self.dbdir)
+		if not sb.load():
+			self.corrupt.append(('super', "load failed"))
+			return None
+		self.n_verified += 1
+		return sb
+
+	def log_ids(self, sb):
+		# the same log chain walked by PageDb.read_logs
+		log_id = sb.log_id
+		while os.path.exists(self.dbdir + '/' +
+				     filename('log', log_id)):
+			yield log_id
+			log_id += 1
+
+	def run(self):
+		self.load_state()
+
+		if self.workers > 1:
+			rate = self.rate / self.workers
+			self.pool = multiprocessing.Pool(self.workers,
+							 init_worker, (rate,))
+		else:
+			init_worker(self.rate)
+
+		try:
+			sb = self.scrub_super()
+			if sb is None:
+				return False
+
+			root_ids = {}
+			for tm in sb.tables.itervalues():
+				root_ids[tm.name] = tm.root_id
+
+			# tables created since the last checkpoint
+			log_ids = list(self.log_ids(sb))
+			for r in self.verify_files('log', log_ids):
+				root_ids.update(r['tables'])
+
+			# roots are always re-read: that is how the set of
+			# reachable blocks is found
+			block_ids = set()
+			results = self.verify_files('root',
+						    sorted(root_ids.values()))
+			for r in results:
+				if r['error'] is None:
+					block_ids.update(r['blocks'])
+
+			# root changes not yet folded back into root files,
+			# as replayed from the manifest by PDSuper.load
+			for tm in sb.tables.itervalues():
+				if tm.root is not None:
+					block_ids.update(ent.file_id
+							 for ent in tm.root.v)
+
+			self.verify_files('block', sorted(block_ids))
+			self.verify_files('vlog', sorted(sb.vlog_ids))
+			if sb.manifest_id:
+				self.verify_files('manifest', [sb.manifest_id])
+		finally:
+			if self.pool is not None:
+				self.pool.close()
+				self.pool.join()
+				self.pool = None
+
+		self.save_state()
+
+		return len(self.corrupt) == 0
+
+	def orphans(self):
+		r = []
+		for name in sorted(os.listdir(self.dbdir)):
+			if FILE_RE.match(name) and name not in self.reachable:
+				r.append(name)
+		return r
+
+
+def main(argv):
+	p = argparse.ArgumentParser(description='verify a pagedb database')
+	p.add_argument('dbdir', help='database directory')
+	p.add_argument('--workers', type=int,
+		       default=multiprocessing.cpu_count(),
+		       help='verifier processes')
+	p.add_argument('--rate', type=float, default=0,
+		       help='total read rate limit, MB/sec (0: unlimited)')
+	p.add_argument('--state', default=None,
+		       help='file recording already-verified immutable files')
+	p.add_argument('--incremental', action='store_true',
+		       help='skip files already verified, per --state')
+	args = p.parse_args(argv)
+
+	if args.incremental and args.state is None:
+		p.error('--incremental requires --state')
+
+	scrubber = Scrubber(args.dbdir, args.workers,
+			    int(args.rate * 1024 * 1024), args.state,
+			    args.incremental)
+	ok = scrubber.run()
+
+	for name, err in scrubber.corrupt:
+		print "corrupt %s: %s" % (name, err)
+	for name, warn in scrubber.warnings:
+		print "warning %s: %s" % (name, warn)
+	orphans = scrubber.orphans()
+	for name in orphans:
+		print "orphan %s" % (name,)
+
+	print "%d verified, %d skipped, %d corrupt, %d orphaned" % \
+		(scrubber.n_verified, scrubber.n_skipped,
+		 len(scrubber.corrupt), len(orphans))
+
+	if not ok:
+		return 1
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -9,8 +9,19 @@
 import sys
 import shutil
 import os
+import json
+import ctypes
 
 import PageDb
+import PDcodec_pb2
+import Block
+import TableRoot
+import scrub
+import Replication
+import ChangeFeed
+import SlowLog
+import KeyArray
+import Advise
 
 DBDIR='/tmp/dbdir'
 DBTABLE='test1'
@@ -173,11 +184,1944 @@ def test3(test_iter):
 
 	print "test%d ok" % (test_iter,)
 
+def test_scan(test_iter):
+	db = PageDb.PageDb()
+	if not db.open(DBDIR):
+		print "open failed"
+		sys.exit(1)
+
+	table = db.open_table(DBTABLE)
+	if table is None:
+		print "open table failed"
+		sys.exit(1)
+
+	# overwrite, add and delete keys on top of checkpointed blocks
+	expect = {}
+	for k, v in datadict.iteritems():
+		if k not in deleted_keys:
+			expect[k] = v
+	txn = db.txn_begin()
+	expect['age'] = '39'
+	expect['zebra'] = 'stripes'
+	expect['aardvark'] = 'ants'
+	for k in ('age', 'zebra', 'aardvark'):
+		if not table.put(txn, k, expect[k]):
+			print "put", k, "failed"
+			sys.exit(1)
+	if not table.delete(txn, 'faith'):
+		print "del faith failed"
+		sys.exit(1)
+	del expect['faith']
+	if not db.txn_commit(txn):
+		print "txn commit failed"
+		sys.exit(1)
+
+	if list(table.scan(None)) != sorted(expect.items()):
+		print "scan mismatch before checkpoint"
+		sys.exit(1)
+
+	if not db.checkpoint():
+		print "checkpoint failed"
+		sys.exit(1)
+
+	db = PageDb.PageDb()
+	if not db.open(DBDIR):
+		print "reopen failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+
+	if list(table.scan(None)) != sorted(expect.items()):
+		print "scan mismatch after checkpoint"
+		sys.exit(1)
+
+	rng = [tup for tup in sorted(expect.items())
+	       if tup[0] >= 'age' and tup[0] < 'name']
+	if list(table.scan(None, 'age', 'name')) != rng:
+		print "range scan mismatch"
+		sys.exit(1)
+
+	print "test%d ok" % (test_iter,)
+
+def test_stats(test_iter):
+	db = PageDb.PageDb()
+	if not db.open(DBDIR):
+		print "open failed"
+		sys.exit(1)
+
+	table = db.open_table(DBTABLE)
+	txn = db.txn_begin()
+	table.put(txn, 'stats', 'yes')
+	db.txn_commit(txn)
+	table.get(None, 'name')
+	table.get(None, 'stats')
+	table.exists(None, 'biff129')
+
+	stats = db.stats()
+	if (stats['table']['get'] != 2 or
+	    stats['table']['exists'] != 1 or
+	    stats['table']['put'] != 1 or
+	    stats['log']['fsync'] != 1 or
+	    stats['log']['records'] < 3 or
+	    stats['blockmgr']['opens'] != 1 or
+	    stats['table']['get_latency']['count'] != 2):
+		print "stats mismatch:", stats
+		sys.exit(1)
+
+	db.enable_histograms(False)
+	table.get(None, 'name')
+	stats = db.stats()
+	if (stats['table']['get'] != 3 or
+	    stats['table']['get_latency']['count'] != 2):
+		print "histogram disable failed:", stats
+		sys.exit(1)
+
+	print "test%d ok" % (test_iter,)
+
+def test_slowlog(test_iter):
+	db = PageDb.PageDb()
+	if not db.open(DBDIR):
+		print "open failed"
+		sys.exit(1)
+
+	table = db.open_table(DBTABLE)
+
+	# zero threshold, so every operation is traced
+	db.set_slowlog(0.0)
+	table.get(None, 'name')
+	txn = db.txn_begin()
+	table.put(txn, 'slow', 'op')
+	db.txn_commit(txn)
+
+	recs = db.dump_slowlog()
+	ops = [rec['op'] for rec in recs]
+	if ops != ['get', 'put', 'txn_commit']:
+		print "slowlog ops mismatch:", ops
+		sys.exit(1)
+	phases = [name for name, us in recs[0]['phases']]
+	if phases != ['txn', 'memtable', 'root_lookup', 'block_open',
+		      'didx_search', 'value_copy']:
+		print "slowlog get phases mismatch:", phases
+		sys.exit(1)
+	phases = [name for name, us in recs[2]['phases']]
+	if phases != ['log_append', 'fsync', 'apply']:
+		print "slowlog commit phases mismatch:", phases
+		sys.exit(1)
+
+	if recs[0]['key'] != 'name'.encode('hex'):
+		print "slowlog key mismatch:", recs[0]['key']
+		sys.exit(1)
+
+	# binary keys, through a file
+	logname = DBDIR + '.slowlog'
+	f = open(logname, 'w')
+	db.set_slowlog(0.0, SlowLog.FileSink(f))
+	table.get(None, '\xff\x00\x80')
+	f.close()
+	f = open(logname)
+	recs = [json.loads(line) for line in f]
+	f.close()
+	os.unlink(logname)
+	if recs[-1]['key'] != 'ff0080':
+		print "slowlog binary key mismatch:", recs
+		sys.exit(1)
+
+	db.set_slowlog(None)
+	table.get(None, 'name')
+	if len(db.dump_slowlog()) != 0:
+		print "slowlog disable failed"
+		sys.exit(1)
+
+	print "test%d ok" % (test_iter,)
+
+def test_scrub(test_iter):
+	scrubber = scrub.Scrubber(DBDIR)
+	if not scrubber.run():
+		print "scrub failed:", scrubber.corrupt
+		sys.exit(1)
+
+	# corrupt a copy of the newest block
+	copydir = DBDIR + '.scrub'
+	if os.path.isdir(copydir):
+		shutil.rmtree(copydir)
+	shutil.copytree(DBDIR, copydir)
+	blocks = [name for name in os.listdir(copydir)
+		  if name.startswith('block.')]
+	blocks.sort(key=lambda name: int(name[6:], 16))
+	f = open(copydir + '/' + blocks[-1], 'r+b')
+	f.seek(12)
+	f.write('X')
+	f.close()
+
+	scrubber = scrub.Scrubber(copydir)
+	ok = scrubber.run()
+	shutil.rmtree(copydir)
+	if ok or [name for name, err in scrubber.corrupt] != [blocks[-1]]:
+		print "scrub missed corruption:", scrubber.corrupt
+		sys.exit(1)
+
+	# a bad record mid-log is corruption; a torn final one is not
+	shutil.copytree(DBDIR, copydir)
+	sb = PageDb.PDSuper(copydir)
+	sb.load()
+	name = 'log.%x' % (sb.log_id,)
+	size = os.path.getsize(copydir + '/' + name)
+	f = open(copydir + '/' + name, 'r+b')
+	f.truncate(size - 2)
+	f.close()
+	scrubber = scrub.Scrubber(copydir)
+	if not scrubber.run() or len(scrubber.warnings) != 1:
+		print "scrub torn log:", scrubber.corrupt, scrubber.warnings
+		sys.exit(1)
+
+	f = open(copydir + '/' + name, 'r+b')
+	f.seek(size // 3)
+	c = f.read(1)
+	f.seek(size // 3)
+	f.write(chr(ord(c) ^ 0xff))
+	f.close()
+	scrubber = scrub.Scrubber(copydir)
+	ok = scrubber.run()
+	shutil.rmtree(copydir)
+	if ok or [n for n, err in scrubber.corrupt] != [name]:
+		print "scrub missed log corruption:", scrubber.corrupt
+		sys.exit(1)
+
+	print "test%d ok" % (test_iter,)
+
+def test_get_many(test_iter):
+	db = PageDb.PageDb()
+	if not db.open(DBDIR):
+		print "open failed"
+		sys.exit(1)
+
+	table = db.open_table(DBTABLE)
+	txn = db.txn_begin()
+	table.put(txn, 'intxn', 'pending')
+
+	keys = list(datadict.keys()) + list(never_existed) + \
+	       [ 'intxn', 'stats', 'name' ]
+	for parallel in (False, True):
+		vals = table.get_many(txn, keys, parallel)
+		for k, v in zip(keys, vals):
+			if v != table.get(txn, k):
+				print "get_many mismatch for:", k
+				sys.exit(1)
+
+	db.txn_abort(txn)
+
+	# keys spread over many blocks, unsorted, with duplicates
+	dbdir = DBDIR + '.getmany'
+	if os.path.isdir(dbdir):
+		shutil.rmtree(dbdir)
+	os.mkdir(dbdir)
+	db = PageDb.PageDb()
+	if (not db.create(dbdir) or
+	    not db.create_table(DBTABLE, { 'target_blk_sz' : 2048 })):
+		print "create failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+	expect = {}
+	txn = db.txn_begin()
+	for i in xrange(0, 4000, 2):
+		expect['key%04d' % (i,)] = 'value%d' % (i,)
+		table.put(txn, 'key%04d' % (i,), 'value%d' % (i,))
+	db.txn_commit(txn)
+	db.checkpoint()
+	txn = db.txn_begin()
+	table.put(txn, 'key0100', 'new')
+	expect['key0100'] = 'new'
+	table.delete(txn, 'key0200')
+	del expect['key0200']
+	db.txn_commit(txn)
+	db.close()
+
+	keys = ['key%04d' % ((i * 7919) % 4010,) for i in xrange(600)]
+	keys += keys[:50] + ['a', 'zzz', 'key0100', 'key0200', 'key0100']
+	for parallel in (False, True):
+		db = PageDb.PageDb()
+		if not db.open(dbdir):
+			print "open failed"
+			sys.exit(1)
+		table = db.open_table(DBTABLE)
+		if len(table.tablemeta.root) < 10:
+			print "get_many keys not spread over blocks"
+			sys.exit(1)
+		vals = table.get_many(None, keys, parallel)
+		if vals != [expect.get(k) for k in keys]:
+			print "multi-block get_many mismatch, parallel", parallel
+			sys.exit(1)
+		if db.stats()['blockmgr']['opens'] < 10:
+			print "get_many did not open the blocks"
+			sys.exit(1)
+
+		# parallel opens share one pool until close
+		open_pool = db.blockmgr.open_pool
+		if (open_pool is None) == parallel:
+			print "get_many open pool mismatch, parallel", parallel
+			sys.exit(1)
+		db.blockmgr.cache.clear()
+		table.get_many(None, keys, parallel)
+		if db.blockmgr.open_pool is not open_pool:
+			print "get_many open pool not reused"
+			sys.exit(1)
+		db.close()
+		if db.blockmgr.open_pool is not None:
+			print "get_many open pool not closed"
+			sys.exit(1)
+	shutil.rmtree(dbdir)
+
+	print "test%d ok" % (test_iter,)
+
+def test_vlog(test_iter):
+	dbdir = DBDIR + '.vlog'
+	if os.path.isdir(dbdir):
+		shutil.rmtree(dbdir)
+	os.mkdir(dbdir)
+
+	db = PageDb.PageDb()
+	if not db.create(dbdir) or not db.create_table(DBTABLE):
+		print "create failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+	db.set_value_log(1000)
+
+	expect = {}
+	for i in xrange(20):
+		expect['big%02d' % (i,)] = chr(ord('a') + i) * 2000
+		expect['small%02d' % (i,)] = 'x' * i
+	txn = db.txn_begin()
+	for k, v in expect.iteritems():
+		table.put(txn, k, v)
+	db.txn_commit(txn)
+	if not db.checkpoint() or len(db.super.vlog_ids) != 1:
+		print "vlog checkpoint failed"
+		sys.exit(1)
+	old_vlog = db.super.vlog_ids[0]
+
+	# make half the value log garbage, then collect it
+	txn = db.txn_begin()
+	for i in xrange(0, 20, 2):
+		expect['big%02d' % (i,)] = 'replaced'
+		table.put(txn, 'big%02d' % (i,), 'replaced')
+	db.txn_commit(txn)
+	if not db.checkpoint() or not db.vlog_gc(old_vlog):
+		print "vlog gc failed"
+		sys.exit(1)
+	if old_vlog in db.super.vlog_ids:
+		print "vlog gc did not release file"
+		sys.exit(1)
+
+	db = PageDb.PageDb()
+	if not db.open(dbdir):
+		print "reopen failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+
+	for k, v in expect.iteritems():
+		if table.get(None, k) != v:
+			print "vlog get mismatch for:", k
+			sys.exit(1)
+	if list(table.scan(None)) != sorted(expect.items()):
+		print "vlog scan mismatch"
+		sys.exit(1)
+
+	# a damaged value, or a missing value log, is an error rather
+	# than a value or an absent key
+	vlog_fn = db.vlog.filename(db.super.vlog_ids[-1])
+	f = open(vlog_fn, 'r+b')
+	data = f.read()
+	f.seek(data.index('b' * 2000) + 100)
+	f.write('?')
+	f.close()
+	for fn in (lambda: table.get(None, 'big01'),
+		   lambda: table.get_many(None, ['big01']),
+		   lambda: list(table.scan(None))):
+		try:
+			fn()
+			print "vlog corrupt read not detected"
+			sys.exit(1)
+		except IOError:
+			pass
+	if table.get(None, 'big03') != expect['big03']:
+		print "vlog get mismatch after corruption"
+		sys.exit(1)
+
+	db.close()
+	os.unlink(vlog_fn)
+	db = PageDb.PageDb()
+	if not db.open(dbdir):
+		print "reopen failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+	try:
+		table.get(None, 'big03')
+		print "missing vlog not detected"
+		sys.exit(1)
+	except IOError:
+		pass
+
+	shutil.rmtree(dbdir)
+
+	print "test%d ok" % (test_iter,)
+
+def test_bufpool(test_iter):
+	db = PageDb.PageDb()
+	if not db.open(DBDIR):
+		print "open failed"
+		sys.exit(1)
+
+	table = db.open_table(DBTABLE)
+	expect = list(table.scan(None))
+
+	# tiny pool and pages, to force eviction and multi-page reads
+	db.use_buffer_pool(2 * 32, 32)
+	if list(table.scan(None)) != expect:
+		print "buffer pool scan mismatch"
+		sys.exit(1)
+	for k, v in expect:
+		if table.get(None, k) != v:
+			print "buffer pool get mismatch for:", k
+			sys.exit(1)
+	for k in never_existed:
+		if table.get(None, k) is not None:
+			print "buffer pool get found missing key:", k
+			sys.exit(1)
+
+	stats = db.stats()['bufpool']
+	if stats['misses'] == 0 or stats['evictions'] == 0:
+		print "buffer pool stats mismatch:", stats
+		sys.exit(1)
+
+	print "test%d ok" % (test_iter,)
+
+def test_rowcache(test_iter):
+	db = PageDb.PageDb()
+	if not db.open(DBDIR):
+		print "open failed"
+		sys.exit(1)
+
+	table = db.open_table(DBTABLE)
+
+	# move everything from the memtable into blocks
+	if not db.checkpoint():
+		print "checkpoint failed"
+		sys.exit(1)
+
+	db.set_row_cache(64 * 1024)
+	expect = list(table.scan(None))
+
+	# second pass is served from the cache
+	for n in xrange(2):
+		for k, v in expect:
+			if table.get(None, k) != v:
+				print "row cache get mismatch for:", k
+				sys.exit(1)
+		for k in never_existed:
+			if table.exists(None, k):
+				print "row cache exists for missing key:", k
+				sys.exit(1)
+
+	stats = db.stats()['rowcache']
+	if stats['hits'] < len(expect) or stats['entries'] == 0:
+		print "row cache stats mismatch:", stats
+		sys.exit(1)
+
+	# commits invalidate cached entries, including negative ones
+	k = expect[0][0]
+	missing = list(never_existed)[0]
+	txn = db.txn_begin()
+	table.put(txn, k, 'rowcache-new')
+	table.put(txn, missing, 'rowcache-found')
+	db.txn_commit(txn)
+	if (table.get(None, k) != 'rowcache-new' or
+	    table.get(None, missing) != 'rowcache-found'):
+		print "row cache returned stale value"
+		sys.exit(1)
+
+	if not db.checkpoint():
+		print "checkpoint failed"
+		sys.exit(1)
+	if db.rowcache.snapshot()['entries'] != 0:
+		print "row cache not cleared by checkpoint"
+		sys.exit(1)
+
+	# restore original contents for later tests
+	txn = db.txn_begin()
+	table.put(txn, k, expect[0][1])
+	table.delete(txn, missing)
+	db.txn_commit(txn)
+	if table.get(None, k) != expect[0][1] or table.exists(None, missing):
+		print "row cache returned stale value after restore"
+		sys.exit(1)
+
+	print "test%d ok" % (test_iter,)
+
+def test_manifest(test_iter):
+	dbdir = DBDIR + '.manifest'
+	if os.path.isdir(dbdir):
+		shutil.rmtree(dbdir)
+	os.mkdir(dbdir)
+
+	db = PageDb.PageDb()
+	if not db.create(dbdir) or not db.create_table(DBTABLE):
+		print "create failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+
+	# checkpoints append edits; no root or superblock rewrites
+	expect = {}
+	for n in xrange(4):
+		txn = db.txn_begin()
+		for i in xrange(10):
+			k = 'm%d.%d' % (i, n)
+			expect[k] = 'value%d' % (n,)
+			table.put(txn, k, expect[k])
+		db.txn_commit(txn)
+		if not db.checkpoint():
+			print "checkpoint failed"
+			sys.exit(1)
+
+	roots = [name for name in os.listdir(dbdir)
+		 if name.startswith('root.')]
+	stats = db.stats()['manifest']
+	if len(roots) != 1 or stats['edits'] != 4:
+		print "manifest edits not used:", roots, stats
+		sys.exit(1)
+
+	# torn final record is dropped on replay
+	f = open(db.super.manifest.filename(), 'ab')
+	f.write('MEDT\xff')
+	f.close()
+
+	for n in xrange(3):
+		db = PageDb.PageDb()
+		if not db.open(dbdir):
+			print "manifest reopen failed"
+			sys.exit(1)
+		table = db.open_table(DBTABLE)
+		if dict(table.scan(None)) != expect:
+			print "manifest replay mismatch"
+			sys.exit(1)
+
+		# append after the dropped tail, then past the size
+		# limit, fold into a new snapshot
+		if n > 0:
+			db.super.manifest_max_sz = 0
+		txn = db.txn_begin()
+		expect['compact%d' % (n,)] = 'x'
+		table.put(txn, 'compact%d' % (n,), 'x')
+		db.txn_commit(txn)
+		if not db.checkpoint():
+			print "compacting checkpoint failed"
+			sys.exit(1)
+		if (n > 0 and
+		    db.stats()['manifest'].get('compactions') != 1):
+			print "manifest not compacted"
+			sys.exit(1)
+
+	scrubber = scrub.Scrubber(dbdir)
+	if not scrubber.run() or len(scrubber.warnings) != 0:
+		print "scrub failed:", scrubber.corrupt, scrubber.warnings
+		sys.exit(1)
+
+	shutil.rmtree(dbdir)
+
+	print "test%d ok" % (test_iter,)
+
+def test_rootpages(test_iter):
+	dbdir = DBDIR + '.rootpages'
+	if os.path.isdir(dbdir):
+		shutil.rmtree(dbdir)
+	os.mkdir(dbdir)
+
+	# synthetic root, spanning many leaf pages
+	root = TableRoot.TableRoot(dbdir, 1)
+	for i in xrange(20000):
+		ent = PDcodec_pb2.RootEnt()
+		ent.key = 'fence%08d' % (i * 10,)
+		ent.file_id = i + 100
+		root.v.append(ent)
+	expect = [(ent.key, ent.file_id) for ent in root.v]
+	if not root.dump():
+		print "paged root dump failed"
+		sys.exit(1)
+
+	root = TableRoot.TableRoot(dbdir, 1)
+	if (not root.load() or root.tree is None or
+	    root.tree.depth < 2 or len(root) != len(expect)):
+		print "paged root load failed"
+		sys.exit(1)
+	for k, n in (('', 100), ('fence00000005', 101),
+		     ('fence00000010', 101), ('zzz', 20099)):
+		if root.lookup(k).file_id != n:
+			print "paged root lookup mismatch for:", k
+			sys.exit(1)
+	if ([ent.file_id for ent in root.iterate('fence00100005')] !=
+	    range(10101, 20100)):
+		print "paged root iterate mismatch"
+		sys.exit(1)
+	if len(root.tree.cache) > TableRoot.ROOT_CACHE_PAGES:
+		print "paged root cache unbounded"
+		sys.exit(1)
+	if [(ent.key, ent.file_id) for ent in root.v] != expect:
+		print "paged root contents mismatch"
+		sys.exit(1)
+
+	# keys too long for a page fall back to the flat format
+	old_min = TableRoot.PAGED_MIN_ENTS
+	TableRoot.PAGED_MIN_ENTS = 4
+	root = TableRoot.TableRoot(dbdir, 2)
+	for i in xrange(4):
+		ent = PDcodec_pb2.RootEnt()
+		ent.key = '%08d' % (i,) + 'x' * 4800
+		ent.file_id = i + 100
+		root.v.append(ent)
+	expect = [(ent.key, ent.file_id) for ent in root.v]
+	root2 = TableRoot.TableRoot(dbdir, 2)
+	ok = root.dump() and root2.load()
+	TableRoot.PAGED_MIN_ENTS = old_min
+	if (not ok or root2.tree is not None or
+	    [(ent.key, ent.file_id) for ent in root2.v] != expect):
+		print "oversized root keys failed"
+		sys.exit(1)
+
+	# end to end, with every table root paged
+	old_blk_sz = Block.TARGET_BLK_SZ
+	TableRoot.PAGED_MIN_ENTS = 1
+	Block.TARGET_BLK_SZ = 64
+	db = PageDb.PageDb()
+	if not db.create(dbdir) or not db.create_table(DBTABLE):
+		print "create failed"
+		sys.exit(1)
+	db.super.manifest_max_sz = 0
+	table = db.open_table(DBTABLE)
+	txn = db.txn_begin()
+	data = {}
+	for i in xrange(200):
+		data['key%04d' % (i,)] = 'value%d' % (i,)
+		table.put(txn, 'key%04d' % (i,), data['key%04d' % (i,)])
+	db.txn_commit(txn)
+	if not db.checkpoint():
+		print "checkpoint failed"
+		sys.exit(1)
+	TableRoot.PAGED_MIN_ENTS = old_min
+	Block.TARGET_BLK_SZ = old_blk_sz
+
+	db = PageDb.PageDb()
+	if not db.open(dbdir):
+		print "reopen failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+	if table.tablemeta.root.tree is None:
+		print "table root not paged"
+		sys.exit(1)
+	for k, v in data.iteritems():
+		if table.get(None, k) != v:
+			print "paged root get mismatch for:", k
+			sys.exit(1)
+	expect = sorted(data.items())[:100]
+	if list(table.scan(None, None, 'key0100')) != expect:
+		print "paged root scan mismatch"
+		sys.exit(1)
+	if table.tablemeta.root.tree is None:
+		print "paged root read in full"
+		sys.exit(1)
+
+	# checkpoints through the manifest leave paged roots unread
+	# at open
+	TableRoot.PAGED_MIN_ENTS = 1
+	Block.TARGET_BLK_SZ = 64
+	txn = db.txn_begin()
+	for i in xrange(200, 300):
+		data['key%04d' % (i,)] = 'value%d' % (i,)
+		table.put(txn, 'key%04d' % (i,), data['key%04d' % (i,)])
+	db.txn_commit(txn)
+	if not db.checkpoint():
+		print "checkpoint failed"
+		sys.exit(1)
+	TableRoot.PAGED_MIN_ENTS = old_min
+	Block.TARGET_BLK_SZ = old_blk_sz
+	if db.stats()['manifest'].get('compactions'):
+		print "manifest compacted"
+		sys.exit(1)
+	db.close()
+
+	db = PageDb.PageDb()
+	if not db.open(dbdir):
+		print "reopen failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+	if table.tablemeta.root.tree is None:
+		print "edited paged root read in full"
+		sys.exit(1)
+	if dict(table.scan(None)) != data:
+		print "edited paged root scan mismatch"
+		sys.exit(1)
+	db.close()
+
+	shutil.rmtree(dbdir)
+
+	print "test%d ok" % (test_iter,)
+
+def test_memsnap(test_iter):
+	dbdir = DBDIR + '.memsnap'
+	if os.path.isdir(dbdir):
+		shutil.rmtree(dbdir)
+	os.mkdir(dbdir)
+
+	db = PageDb.PageDb()
+	if not db.create(dbdir) or not db.create_table(DBTABLE):
+		print "create failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+	expect = {}
+	txn = db.txn_begin()
+	for i in xrange(100):
+		expect['snap%03d' % (i,)] = 'v%d' % (i,)
+		table.put(txn, 'snap%03d' % (i,), 'v%d' % (i,))
+	db.txn_commit(txn)
+	txn = db.txn_begin()
+	for i in xrange(0, 100, 3):
+		del expect['snap%03d' % (i,)]
+		table.delete(txn, 'snap%03d' % (i,))
+	db.txn_commit(txn)
+	if not db.close():
+		print "close failed"
+		sys.exit(1)
+	if not os.path.exists(dbdir + '/memtable'):
+		print "memtable not saved"
+		sys.exit(1)
+
+	# snapshot, then snapshot plus log tail, after a crash
+	for n in xrange(2):
+		db = PageDb.PageDb()
+		if not db.open(dbdir):
+			print "reopen failed"
+			sys.exit(1)
+		if db.stats()['memsnap']['keys'] != 100:
+			print "memtable snapshot not used"
+			sys.exit(1)
+		table = db.open_table(DBTABLE)
+		if dict(table.scan(None)) != expect:
+			print "memtable snapshot mismatch"
+			sys.exit(1)
+
+		txn = db.txn_begin()
+		expect['tail%d' % (n,)] = 'x'
+		table.put(txn, 'tail%d' % (n,), 'x')
+		db.txn_commit(txn)
+		db = None
+
+	# a checkpointing close retires the snapshot
+	db = PageDb.PageDb()
+	if not db.open(dbdir) or not db.close(True):
+		print "checkpointing close failed"
+		sys.exit(1)
+	if os.path.exists(dbdir + '/memtable'):
+		print "stale memtable snapshot"
+		sys.exit(1)
+	db = PageDb.PageDb()
+	if not db.open(dbdir):
+		print "reopen failed"
+		sys.exit(1)
+	if dict(db.open_table(DBTABLE).scan(None)) != expect:
+		print "checkpointed data mismatch"
+		sys.exit(1)
+
+	shutil.rmtree(dbdir)
+
+	print "test%d ok" % (test_iter,)
+
+def test_log_format(test_iter):
+	dbdir = DBDIR + '.logfmt'
+	if os.path.isdir(dbdir):
+		shutil.rmtree(dbdir)
+	os.mkdir(dbdir)
+
+	db = PageDb.PageDb()
+	if (not db.create(dbdir) or not db.create_table('t1') or
+	    not db.create_table('t2')):
+		print "create failed"
+		sys.exit(1)
+
+	# alternate encodings within one log
+	expect = {}
+	log_bytes = []
+	for compact in (False, True, False, True):
+		db.set_log_format(compact)
+		n0 = db.stats()['log']['bytes']
+		txn = db.txn_begin()
+		for name in ('t1', 't2'):
+			table = db.open_table(name)
+			for i in xrange(20):
+				k = 'k%d' % (i,)
+				v = '%s.%d.%s' % (name, i, compact)
+				table.put(txn, k, v)
+				expect[(name, k)] = v
+			table.delete(txn, 'k0')
+			del expect[(name, 'k0')]
+		db.txn_commit(txn)
+		log_bytes.append(db.stats()['log']['bytes'] - n0)
+
+	if log_bytes[1] >= log_bytes[0]:
+		print "compact log records not smaller:", log_bytes
+		sys.exit(1)
+
+	db = PageDb.PageDb()
+	if not db.open(dbdir):
+		print "reopen failed"
+		sys.exit(1)
+	got = {}
+	for name in ('t1', 't2'):
+		for k, v in db.open_table(name).scan(None):
+			got[(name, k)] = v
+	if got != expect:
+		print "mixed log format replay mismatch"
+		sys.exit(1)
+
+	shutil.rmtree(dbdir)
+
+	print "test%d ok" % (test_iter,)
+
+def test_get_view(test_iter):
+	db = PageDb.PageDb()
+	if not db.open(DBDIR):
+		print "open failed"
+		sys.exit(1)
+
+	table = db.open_table(DBTABLE)
+	if not db.checkpoint():
+		print "checkpoint failed"
+		sys.exit(1)
+	txn = db.txn_begin()
+	table.put(txn, 'viewtxn', 'pending')
+
+	expect = dict(table.scan(txn))
+	for k in expect.keys() + list(never_existed):
+		r = table.get_view(txn, k)
+		if r is None:
+			if k in expect:
+				print "get_view missing key:", k
+				sys.exit(1)
+			continue
+		view, lease = r
+		if not view.readonly or view.tobytes() != expect[k]:
+			print "get_view mismatch for:", k
+			sys.exit(1)
+		lease.release()
+	db.txn_abort(txn)
+
+	# a leased block survives cache eviction and close
+	k = sorted(expect.keys())[0]
+	view, lease = table.get_view(None, k)
+	block = lease.block
+	if block is None:
+		print "get_view of block value not leased"
+		sys.exit(1)
+	db.blockmgr.size_max = 0
+	db.blockmgr.shrink_cache()
+	block.close()
+	if (block.file_id not in db.blockmgr.cache or
+	    block.map is None or view.tobytes() != expect[k]):
+		print "leased block evicted or closed"
+		sys.exit(1)
+	lease.release()
+	if block.map is not None:
+		print "deferred close not run on release"
+		sys.exit(1)
+	db.blockmgr.shrink_cache()
+	if block.file_id in db.blockmgr.cache:
+		print "released block not evictable"
+		sys.exit(1)
+
+	# views outlive the block that made them
+	block = None
+	if view.tobytes() != expect[k]:
+		print "view invalid after block close"
+		sys.exit(1)
+
+	print "test%d ok" % (test_iter,)
+
+def test_range_delete(test_iter):
+	dbdir = DBDIR + '.rangedel'
+	if os.path.isdir(dbdir):
+		shutil.rmtree(dbdir)
+	os.mkdir(dbdir)
+
+	# small blocks, so that whole blocks fall within the range
+	old_blk_sz = Block.TARGET_BLK_SZ
+	Block.TARGET_BLK_SZ = 64
+	db = PageDb.PageDb()
+	if not db.create(dbdir) or not db.create_table(DBTABLE):
+		print "create failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+	expect = {}
+	txn = db.txn_begin()
+	for i in xrange(200):
+		expect['key%04d' % (i,)] = 'value%d' % (i,)
+		table.put(txn, 'key%04d' % (i,), 'value%d' % (i,))
+	db.txn_commit(txn)
+	if not db.checkpoint():
+		print "checkpoint failed"
+		sys.exit(1)
+
+	# a memtable key inside the range, and one rewritten after it
+	txn = db.txn_begin()
+	table.put(txn, 'key0050x', 'gone')
+	db.txn_commit(txn)
+	txn = db.txn_begin()
+	if not table.delete_range(txn, 'key0020', 'key0150'):
+		print "delete_range failed"
+		sys.exit(1)
+	if table.get(txn, 'key0030') is not None:
+		print "range delete not visible in txn"
+		sys.exit(1)
+	table.put(txn, 'key0100', 'again')
+	db.txn_commit(txn)
+	for i in xrange(20, 150):
+		del expect['key%04d' % (i,)]
+	expect['key0100'] = 'again'
+
+	def check(table, what):
+		if dict(table.scan(None)) != expect:
+			print "range delete scan mismatch,", what
+			sys.exit(1)
+		for k in ('key0019', 'key0020', 'key0050x', 'key0100',
+			  'key0149', 'key0150'):
+			if table.get(None, k) != expect.get(k):
+				print "range delete get mismatch,", what, k
+				sys.exit(1)
+			if table.exists(None, k) != (k in expect):
+				print "range delete exists mismatch,", what, k
+				sys.exit(1)
+		keys = sorted(expect.keys()) + ['key0077']
+		if table.get_many(None, keys) != [expect.get(k) for k in keys]:
+			print "range delete get_many mismatch,", what
+			sys.exit(1)
+
+	check(table, 'in memtable')
+
+	# saved memtable keeps the tombstone
+	db.close()
+	db = PageDb.PageDb()
+	if not db.open(dbdir):
+		print "reopen failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+	check(table, 'after restart')
+
+	if not db.checkpoint():
+		print "checkpoint failed"
+		sys.exit(1)
+	Block.TARGET_BLK_SZ = old_blk_sz
+	if db.stats()['checkpoint']['blocks_dropped'] == 0:
+		print "covered blocks not dropped"
+		sys.exit(1)
+	check(table, 'after checkpoint')
+
+	db = PageDb.PageDb()
+	if not db.open(dbdir):
+		print "reopen failed"
+		sys.exit(1)
+	check(db.open_table(DBTABLE), 'after reopen')
+
+	shutil.rmtree(dbdir)
+
+	print "test%d ok" % (test_iter,)
+
+def test_blind_delete(test_iter):
+	dbdir = DBDIR + '.blinddel'
+	if os.path.isdir(dbdir):
+		shutil.rmtree(dbdir)
+	os.mkdir(dbdir)
+
+	db = PageDb.PageDb()
+	if not db.create(dbdir) or not db.create_table(DBTABLE):
+		print "create failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+	txn = db.txn_begin()
+	for i in xrange(100):
+		table.put(txn, 'key%03d' % (i,), 'value%d' % (i,))
+	db.txn_commit(txn)
+	if not db.checkpoint():
+		print "checkpoint failed"
+		sys.exit(1)
+
+	txn = db.txn_begin()
+	if table.delete(txn, 'key050', True) != True:
+		print "checked delete of present key failed"
+		sys.exit(1)
+	if table.delete(txn, 'key050x', True) != False:
+		print "checked delete of absent key succeeded"
+		sys.exit(1)
+	for i in xrange(100):
+		if not table.delete(txn, 'gone%03d' % (i,)):
+			print "blind delete failed"
+			sys.exit(1)
+	db.txn_commit(txn)
+	if table.exists(None, 'key050') or not table.exists(None, 'key051'):
+		print "blind delete state mismatch"
+		sys.exit(1)
+
+	# unmatched tombstones alone leave blocks untouched
+	if not db.checkpoint():
+		print "checkpoint failed"
+		sys.exit(1)
+	txn = db.txn_begin()
+	for i in xrange(100):
+		table.delete(txn, 'gone%03d' % (i,))
+		table.delete(txn, 'key%03dx' % (i,))
+	table.put(txn, 'key050', 'value50')
+	table.delete(txn, 'key050')
+	db.txn_commit(txn)
+	old_v = [(ent.key, ent.file_id) for ent in table.tablemeta.root.v]
+	if not db.checkpoint():
+		print "checkpoint failed"
+		sys.exit(1)
+	if db.stats()['checkpoint']['tombstones_dropped'] != 201:
+		print "unmatched tombstones not dropped"
+		sys.exit(1)
+	if [(ent.key, ent.file_id) for ent in table.tablemeta.root.v] != old_v:
+		print "block rewritten for unmatched tombstones"
+		sys.exit(1)
+	if (table.exists(None, 'key050') or
+	    len(list(table.scan(None))) != 99):
+		print "blind delete contents mismatch"
+		sys.exit(1)
+
+	shutil.rmtree(dbdir)
+
+	print "test%d ok" % (test_iter,)
+
+def test_block_merge(test_iter):
+	dbdir = DBDIR + '.merge'
+	if os.path.isdir(dbdir):
+		shutil.rmtree(dbdir)
+	os.mkdir(dbdir)
+
+	old_blk_sz = Block.TARGET_BLK_SZ
+	Block.TARGET_BLK_SZ = 256
+	db = PageDb.PageDb()
+	if not db.create(dbdir) or not db.create_table(DBTABLE):
+		print "create failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+	expect = {}
+	txn = db.txn_begin()
+	for i in xrange(400):
+		expect['key%04d' % (i,)] = 'value%d' % (i,)
+		table.put(txn, 'key%04d' % (i,), 'value%d' % (i,))
+	db.txn_commit(txn)
+	if not db.checkpoint():
+		print "checkpoint failed"
+		sys.exit(1)
+
+	# thin out every block, then empty a run of them
+	txn = db.txn_begin()
+	for i in xrange(400):
+		if i % 10 != 0 or 100 <= i < 200:
+			table.delete(txn, 'key%04d' % (i,))
+			del expect['key%04d' % (i,)]
+	db.txn_commit(txn)
+	if not db.checkpoint():
+		print "checkpoint failed"
+		sys.exit(1)
+	n_blocks = len(table.tablemeta.root)
+
+	# merged a few blocks at a time, across checkpoints
+	db.set_block_merge(4, 1.0)
+	for n in xrange(len(table.tablemeta.root)):
+		if not db.checkpoint():
+			print "checkpoint failed"
+			sys.exit(1)
+		if dict(table.scan(None)) != expect:
+			print "block merge contents mismatch"
+			sys.exit(1)
+	Block.TARGET_BLK_SZ = old_blk_sz
+	if (db.stats()['compact']['blocks_read'] == 0 or
+	    len(table.tablemeta.root) * 2 > n_blocks):
+		print "underfilled blocks not merged"
+		sys.exit(1)
+
+	db = PageDb.PageDb()
+	if not db.open(dbdir):
+		print "reopen failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+	for k in ('key0000', 'key0010', 'key0150', 'key0390', 'key0399'):
+		if table.get(None, k) != expect.get(k):
+			print "block merge get mismatch for:", k
+			sys.exit(1)
+	if dict(table.scan(None)) != expect:
+		print "block merge contents mismatch after reopen"
+		sys.exit(1)
+
+	shutil.rmtree(dbdir)
+
+	print "test%d ok" % (test_iter,)
+
+def test_table_options(test_iter):
+	dbdir = DBDIR + '.options'
+	if os.path.isdir(dbdir):
+		shutil.rmtree(dbdir)
+	os.mkdir(dbdir)
+
+	db = PageDb.PageDb()
+	if not db.create(dbdir):
+		print "create failed"
+		sys.exit(1)
+	for bad in ({'compression' : 'lz4'}, {'target_blk_sz' : 1},
+		    {'blocksize' : 4096}):
+		if db.create_table('bad', bad):
+			print "invalid table options accepted:", bad
+			sys.exit(1)
+	opts = {
+		'target_blk_sz' : 1024,
+		'compression' : 'zlib',
+		'bloom_bits' : 10,
+	}
+	if (not db.create_table('small', opts) or
+	    not db.create_table('ids', {'key_encoding' : 'uint64'}) or
+	    not db.create_table(DBTABLE)):
+		print "create_table with options failed"
+		sys.exit(1)
+
+	small = db.open_table('small')
+	ids = db.open_table('ids')
+	txn = db.txn_begin()
+	expect = {}
+	for i in xrange(200):
+		expect['key%04d' % (i,)] = 'value %d ' % (i,) * 20
+		small.put(txn, 'key%04d' % (i,), expect['key%04d' % (i,)])
+	if ids.put(txn, 'short', 'x') or not ids.put(txn, '\0' * 8, 'x'):
+		print "uint64 key encoding not enforced"
+		sys.exit(1)
+	db.txn_commit(txn)
+
+	# options survive replay, the memtable snapshot, and checkpoint
+	for n in xrange(3):
+		if n == 2 and not db.checkpoint():
+			print "checkpoint failed"
+			sys.exit(1)
+		if n == 1 and not db.close():
+			print "close failed"
+			sys.exit(1)
+		if n < 2:
+			db = PageDb.PageDb()
+			if not db.open(dbdir):
+				print "reopen failed"
+				sys.exit(1)
+		small = db.open_table('small')
+		opts = small.tablemeta.options
+		if (opts.target_blk_sz != 1024 or opts.bloom_bits != 10 or
+		    opts.compression != PDcodec_pb2.TableOptions.ZLIB):
+			print "table options lost"
+			sys.exit(1)
+		if db.open_table(DBTABLE).tablemeta.options.ListFields():
+			print "default table has options"
+			sys.exit(1)
+
+	if len(small.tablemeta.root) < 10:
+		print "target block size ignored"
+		sys.exit(1)
+	block = Block.Block(dbdir, small.tablemeta.root.v[0].file_id)
+	if not block.open() or block.bloom is None:
+		print "block Bloom filter missing"
+		sys.exit(1)
+	if block.verify() is not None:
+		print "block verify failed:", block.verify()
+		sys.exit(1)
+	if block.st.st_size > 1024:
+		print "block values not compressed"
+		sys.exit(1)
+
+	db = PageDb.PageDb()
+	if not db.open(dbdir):
+		print "reopen failed"
+		sys.exit(1)
+	small = db.open_table('small')
+	if dict(small.scan(None)) != expect:
+		print "compressed table scan mismatch"
+		sys.exit(1)
+	keys = sorted(expect.keys()) + ['key0100x', 'nothere']
+	if small.get_many(None, keys) != [expect.get(k) for k in keys]:
+		print "compressed table get_many mismatch"
+		sys.exit(1)
+	v = small.get_view(None, 'key0007')
+	if v is None or v[0].tobytes() != expect['key0007']:
+		print "compressed table get_view mismatch"
+		sys.exit(1)
+	v[1].release()
+	if small.get(None, 'key0100x') is not None:
+		print "compressed table found missing key"
+		sys.exit(1)
+
+	shutil.rmtree(dbdir)
+
+	print "test%d ok" % (test_iter,)
+
+def test_backup(test_iter):
+	dbdir = DBDIR + '.backup'
+	for d in (dbdir, dbdir + '.1', dbdir + '.2'):
+		if os.path.isdir(d):
+			shutil.rmtree(d)
+	os.mkdir(dbdir)
+
+	def write(table, lo, hi, expect):
+		txn = db.txn_begin()
+		for i in xrange(lo, hi):
+			expect['key%04d' % (i,)] = 'value%d' % (i,)
+			table.put(txn, 'key%04d' % (i,), 'value%d' % (i,))
+		db.txn_commit(txn)
+
+	def check(dir, expect, expect2, standalone=True):
+		bdb = PageDb.PageDb()
+		if not bdb.open(dir):
+			print "backup open failed:", dir
+			sys.exit(1)
+		if (dict(bdb.open_table(DBTABLE).scan(None)) != expect or
+		    dict(bdb.open_table('later').scan(None)) != expect2):
+			print "backup contents mismatch:", dir
+			sys.exit(1)
+		if standalone and bdb.super.manifest_id != 0:
+			print "backup superblock not standalone:", dir
+			sys.exit(1)
+
+	db = PageDb.PageDb()
+	if not db.create(dbdir) or not db.create_table(DBTABLE):
+		print "create failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+	expect = {}
+	write(table, 0, 100, expect)
+	db.checkpoint()
+	write(table, 100, 200, expect)
+	db.checkpoint()
+
+	# memtable data, a table created since the last checkpoint,
+	# and an uncommitted transaction
+	write(table, 200, 210, expect)
+	db.create_table('later')
+	expect2 = {}
+	write(db.open_table('later'), 0, 10, expect2)
+	txn = db.txn_begin()
+	table.put(txn, 'uncommitted', 'x')
+
+	# the backup leaves the database's file ids and log alone
+	next_file_id = db.super.next_file_id
+	log_pos = db.logger.tell()
+	if not db.backup(dbdir + '.1'):
+		print "backup failed"
+		sys.exit(1)
+	if (db.super.next_file_id != next_file_id or
+	    db.logger.tell() != log_pos):
+		print "backup wrote to the database"
+		sys.exit(1)
+	db.txn_commit(txn)
+	expect1 = dict(expect)
+	expect['uncommitted'] = 'x'
+	check(dbdir + '.1', expect1, expect2)
+
+	# incremental: unchanged blocks come from the first backup
+	write(table, 1000, 1010, expect)
+	db.checkpoint()
+	st = db.stats()['backup']
+	linked = st['files_linked']
+	copied = st.get('bytes_copied', 0)
+	if not db.backup(dbdir + '.2', dbdir + '.1'):
+		print "incremental backup failed"
+		sys.exit(1)
+	st = db.stats()['backup']
+	if st['files_linked'] - linked < 2:
+		print "incremental backup linked nothing"
+		sys.exit(1)
+	check(dbdir + '.2', expect, expect2)
+
+	# again into the same directory: only the log is copied
+	if not db.backup(dbdir + '.2'):
+		print "repeated backup failed"
+		sys.exit(1)
+	st2 = db.stats()['backup']
+	if st2['files_linked'] != st['files_linked']:
+		print "repeated backup relinked files"
+		sys.exit(1)
+	check(dbdir + '.2', expect, expect2)
+
+	db.close()
+	check(dbdir, expect, expect2, False)
+
+	for d in (dbdir, dbdir + '.1', dbdir + '.2'):
+		shutil.rmtree(d)
+
+	print "test%d ok" % (test_iter,)
+
+def test_replication(test_iter):
+	dbdir = DBDIR + '.primary'
+	fdir = DBDIR + '.follower'
+	for d in (dbdir, fdir):
+		if os.path.isdir(d):
+			shutil.rmtree(d)
+	os.mkdir(dbdir)
+
+	db = PageDb.PageDb()
+	if not db.create(dbdir) or not db.create_table(DBTABLE):
+		print "create failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+	expect = {}
+	txn = db.txn_begin()
+	for i in xrange(100):
+		expect['key%04d' % (i,)] = 'value%d' % (i,)
+		table.put(txn, 'key%04d' % (i,), 'value%d' % (i,))
+	db.txn_commit(txn)
+	db.checkpoint()
+
+	# a transaction open across the start of replication
+	open_txn = db.txn_begin()
+	table.put(open_txn, 'straddle', 'x')
+
+	(rfd, wfd) = os.pipe()
+	tailer = Replication.start(db, fdir, Replication.FdTransport(None, wfd))
+	if tailer is None:
+		print "replication start failed"
+		sys.exit(1)
+	fdb = PageDb.PageDb()
+	if not fdb.open(fdir):
+		print "follower open failed"
+		sys.exit(1)
+	follower = Replication.Follower(fdb,
+					Replication.FdTransport(rfd, None))
+
+	db.txn_commit(open_txn)
+	expect['straddle'] = 'x'
+	aborted = db.txn_begin()
+	table.put(aborted, 'aborted', 'x')
+	db.txn_abort(aborted)
+	db.create_table('later')
+	later = db.open_table('later')
+	expect2 = {}
+	for n in xrange(3):
+		txn = db.txn_begin()
+		for i in xrange(n * 50, n * 50 + 50):
+			k = 'key%04d' % (i + 1000,)
+			expect[k] = expect2[k] = 'value%d' % (i,)
+			table.put(txn, k, expect[k])
+			later.put(txn, k, expect[k])
+		table.delete(txn, 'key%04d' % (n,))
+		del expect['key%04d' % (n,)]
+		db.txn_commit(txn)
+		if n == 1:
+			db.checkpoint()
+
+	lag = tailer.lag()
+	if lag['records'] == 0 or lag['bytes'] == 0:
+		print "replication lag not reported"
+		sys.exit(1)
+	if tailer.pump() is None or follower.poll() is None:
+		print "replication failed"
+		sys.exit(1)
+	if tailer.lag() != { 'records' : 0, 'bytes' : 0 }:
+		print "replication lag after pump:", tailer.lag()
+		sys.exit(1)
+	if fdb.stats()['repl']['checkpoints'] != 1:
+		print "checkpoint boundary not replicated"
+		sys.exit(1)
+
+	if fdb.txn_begin() is not None or fdb.create_table('nope'):
+		print "follower not read-only"
+		sys.exit(1)
+	for n in xrange(2):
+		if (dict(fdb.open_table(DBTABLE).scan(None)) != expect or
+		    dict(fdb.open_table('later').scan(None)) != expect2):
+			print "follower contents mismatch"
+			sys.exit(1)
+
+		# follower restart, replaying its own log
+		fdb.close()
+		fdb = PageDb.PageDb()
+		if not fdb.open(fdir):
+			print "follower reopen failed"
+			sys.exit(1)
+	os.close(rfd)
+	os.close(wfd)
+
+	# the restarted follower resumes from its saved position
+	position = follower.position()
+	(rfd, wfd) = os.pipe()
+	follower = Replication.Follower(fdb,
+					Replication.FdTransport(rfd, None))
+	if position is None or follower.position() != position:
+		print "follower position not saved:", follower.position()
+		sys.exit(1)
+	tailer = Replication.resume(db, Replication.FdTransport(None, wfd),
+				    position)
+	if tailer is None:
+		print "replication resume failed"
+		sys.exit(1)
+	txn = db.txn_begin()
+	table.put(txn, 'resumed', 'x')
+	expect['resumed'] = 'x'
+	db.txn_commit(txn)
+	if (tailer.pump() is None or follower.poll() is None or
+	    dict(fdb.open_table(DBTABLE).scan(None)) != expect):
+		print "resumed follower contents mismatch"
+		sys.exit(1)
+	fdb.close()
+	db.close()
+	os.close(rfd)
+	os.close(wfd)
+	for d in (dbdir, fdir):
+		shutil.rmtree(d)
+
+	print "test%d ok" % (test_iter,)
+
+def test_changefeed(test_iter):
+	dbdir = DBDIR + '.cdc'
+	if os.path.isdir(dbdir):
+		shutil.rmtree(dbdir)
+	os.mkdir(dbdir)
+
+	db = PageDb.PageDb()
+	if not db.create(dbdir) or not db.create_table(DBTABLE):
+		print "create failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+
+	def commit(n, base):
+		txn = db.txn_begin()
+		for i in xrange(n):
+			table.put(txn, 'key%04d' % (base + i,), 'v')
+		db.txn_commit(txn)
+
+	# committed before any subscription: read back from the log
+	commit(10, 0)
+	aborted = db.txn_begin()
+	table.put(aborted, 'aborted', 'x')
+	db.txn_abort(aborted)
+	db.checkpoint()
+
+	db.set_change_ring(20)
+	live = db.subscribe()
+	full = db.subscribe(ChangeFeed.START)
+
+	commit(10, 10)
+	txn = db.txn_begin()
+	table.delete(txn, 'key0000')
+	table.delete_range(txn, 'key0001', 'key0003')
+	db.txn_commit(txn)
+
+	r = list(live)
+	if ([c.op for c in r[-2:]] != [ChangeFeed.CHANGE_DELETE,
+				       ChangeFeed.CHANGE_DELETE_RANGE] or
+	    (r[-1].key, r[-1].value) != ('key0001', 'key0003') or
+	    [c.key for c in r[:10]] != ['key%04d' % (i,)
+					 for i in xrange(10, 20)] or
+	    r[0].table != DBTABLE or r[0].value != 'v' or
+	    r[0].txn_id == r[-1].txn_id):
+		print "live changes mismatch"
+		sys.exit(1)
+	if live.position != r[-1].position or list(live) != []:
+		print "live position mismatch"
+		sys.exit(1)
+
+	# shared with every subscriber, including one that started
+	# behind the ring
+	r2 = list(full)
+	if (len(r2) != 22 or r2[10:] != r or
+	    [c.key for c in r2[:10]] != ['key%04d' % (i,)
+					  for i in xrange(10)]):
+		print "full changes mismatch"
+		sys.exit(1)
+
+	# a slow subscriber overtaken by the ring, across a checkpoint
+	pos = live.position
+	for i in xrange(5):
+		commit(10, 100 + i * 10)
+		if i == 2:
+			db.checkpoint()
+	if db.stats()['cdc']['ring_changes'] > 20:
+		print "change ring unbounded"
+		sys.exit(1)
+	r = list(live)
+	if ([c.key for c in r] !=
+	    ['key%04d' % (i,) for i in xrange(100, 150)]):
+		print "slow subscriber changes mismatch"
+		sys.exit(1)
+
+	# resuming from a saved position; part way through a
+	# transaction, the position is still the one before it
+	sub = db.subscribe(pos)
+	sub.next()
+	if sub.position != pos:
+		print "partial transaction position mismatch"
+		sys.exit(1)
+	sub.close()
+	for (p, n) in ((pos, 50), (r[9].position, 40), (live.position, 0)):
+		sub = db.subscribe(p)
+		if len(list(sub)) != n:
+			print "resume mismatch"
+			sys.exit(1)
+		sub.close()
+
+	for sub in (live, full):
+		sub.close()
+	if db.stats()['cdc']['subscribers'] != 0:
+		print "subscription leak"
+		sys.exit(1)
+	db.close()
+	shutil.rmtree(dbdir)
+
+	print "test%d ok" % (test_iter,)
+
+def test_memtable_limits(test_iter):
+	dbdir = DBDIR + '.memlimit'
+	if os.path.isdir(dbdir):
+		shutil.rmtree(dbdir)
+	os.mkdir(dbdir)
+
+	db = PageDb.PageDb()
+	if not db.create(dbdir) or not db.create_table(DBTABLE):
+		print "create failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+
+	# accounting follows overwrites, deletes and range deletes
+	txn = db.txn_begin()
+	table.put(txn, 'a', 'xx')
+	table.put(txn, 'a', 'xxxx')
+	table.put(txn, 'b', 'y')
+	table.delete(txn, 'b')
+	table.put(txn, 'c', '')
+	table.delete_range(txn, 'c', 'd')
+	table.delete_range(txn, 'f', 'g')
+	table.delete_range(txn, 'h', 'i')
+	table.delete_range(txn, 'ff', 'hh')
+	table.delete_range(txn, 'p', 'p')
+	db.txn_commit(txn)
+	tablemeta = db.super.tables[DBTABLE]
+	n = tablemeta.mem_bytes
+	tablemeta.mem_recount()
+	if n != tablemeta.mem_bytes or n != db.stats()['memtable']['bytes']:
+		print "memtable accounting mismatch"
+		sys.exit(1)
+	db.checkpoint()
+
+	budget = 50 * (PageDb.MEM_ENT_OVERHEAD + 20)
+	db.set_memtable_limits(budget, max_delay=0.0001)
+	for i in xrange(200):
+		txn = db.txn_begin()
+		table.put(txn, 'key%04d' % (i,), 'value%06d' % (i,))
+		db.txn_commit(txn)
+		if db.mem_bytes() >= budget:
+			print "memtable over budget"
+			sys.exit(1)
+	stats = db.stats()['memtable']
+	if stats['auto_checkpoints'] < 3 or stats['budget'] != budget:
+		print "memtable auto checkpoint failed"
+		sys.exit(1)
+
+	# an open transaction holds off the checkpoint: commits slow
+	# down, then new transactions stall until it ends
+	open_txn = db.txn_begin()
+	stalled = False
+	n_more = 0
+	for i in xrange(200):
+		txn = db.txn_begin()
+		if txn is None:
+			stalled = db.stalled()
+			break
+		table.put(txn, 'more%04d' % (i,), 'value%06d' % (i,))
+		db.txn_commit(txn)
+		n_more += 1
+	stats = db.stats()['memtable']
+	if (not stalled or stats['stalls'] != 1 or
+	    stats['slowdowns'] == 0 or
+	    stats['bytes'] < 2 * budget):
+		print "memtable backpressure failed"
+		sys.exit(1)
+	db.txn_commit(open_txn)
+	txn = db.txn_begin()
+	if db.mem_bytes() != 0 or txn is None or db.stalled():
+		print "memtable stall not cleared"
+		sys.exit(1)
+	db.txn_abort(txn)
+
+	# refusals that are not backpressure are not stalls
+	db.readonly = True
+	if db.txn_begin() is not None or db.stalled():
+		print "read-only refusal reported as a stall"
+		sys.exit(1)
+	db.readonly = False
+
+	# log size limit
+	db.set_memtable_limits(0, log_limit=4096)
+	n = db.stats()['memtable']['auto_checkpoints']
+	for i in xrange(100):
+		txn = db.txn_begin()
+		table.put(txn, 'log%04d' % (i,), 'value%06d' % (i,))
+		db.txn_commit(txn)
+	if (db.stats()['memtable']['auto_checkpoints'] == n or
+	    db.logger.tell() >= 4096):
+		print "log limit checkpoint failed"
+		sys.exit(1)
+
+	# recounted from a saved memtable
+	n = db.mem_bytes()
+	db.close()
+	db = PageDb.PageDb()
+	if not db.open(dbdir) or db.mem_bytes() != n:
+		print "reopen failed"
+		sys.exit(1)
+	if len(list(db.open_table(DBTABLE).scan(None))) != 301 + n_more:
+		print "memtable limit data mismatch"
+		sys.exit(1)
+	db.close()
+	shutil.rmtree(dbdir)
+
+	print "test%d ok" % (test_iter,)
+
+def test_uint64_keys(test_iter):
+	dbdir = DBDIR + '.uint64'
+	if os.path.isdir(dbdir):
+		shutil.rmtree(dbdir)
+	os.mkdir(dbdir)
+
+	db = PageDb.PageDb()
+	if (not db.create(dbdir) or
+	    not db.create_table('ids', { 'key_encoding' : 'uint64',
+					 'target_blk_sz' : 2048 })):
+		print "create failed"
+		sys.exit(1)
+	table = db.open_table('ids')
+
+	# keys past 2^63 must sort as unsigned
+	nums = [i * 7919 for i in xrange(1000)] + [(1 << 63) + 5,
+						   (1 << 64) - 1]
+	txn = db.txn_begin()
+	for n in nums:
+		table.put(txn, KeyArray.key_str(n), 'v%d' % (n,))
+	db.txn_commit(txn)
+	db.checkpoint()
+
+	tablemeta = db.super.tables['ids']
+	root = tablemeta.root
+	if len(root) < 4 or root.fence_keys() is None:
+		print "uint64 root not indexed"
+		sys.exit(1)
+	for ent in root.v:
+		block = db.blockmgr.get(ent.file_id)
+		if block.keyarr is None or block.verify() is not None:
+			print "uint64 block not indexed"
+			sys.exit(1)
+
+	txn = db.txn_begin()
+	for n in nums[::97] + [1, 7920, (1 << 63)]:
+		v = table.get(txn, KeyArray.key_str(n))
+		if v != (n in nums and 'v%d' % (n,) or None):
+			print "uint64 get mismatch", n
+			sys.exit(1)
+
+	probe = nums[::3] + [n + 1 for n in nums[::5]] + [nums[-1]]
+	vals = table.get_many(txn, [KeyArray.key_str(n) for n in probe])
+	if vals != ['v%d' % (n,) if n in nums else None for n in probe]:
+		print "uint64 get_many mismatch"
+		sys.exit(1)
+
+	# non-uint64 scan bounds still compare as strings
+	keys = [k for k, v in table.scan(txn, '\x00\x00\x00\x01')]
+	if keys != [KeyArray.key_str(n) for n in sorted(nums)
+		    if KeyArray.key_str(n) >= '\x00\x00\x00\x01']:
+		print "uint64 scan mismatch"
+		sys.exit(1)
+	db.txn_abort(txn)
+	db.close()
+
+	# both searches agree, with or without NumPy
+	arr = KeyArray.from_keys([KeyArray.key_str(n) for n in sorted(nums)])
+	q = [0, 1, 7919, 7920, (1 << 63), (1 << 64) - 1]
+	if (arr.match_many(q) != [0, None, 1, None, None, 1001] or
+	    arr.find_many(q) != [arr.find(n) for n in q]):
+		print "KeyArray search mismatch"
+		sys.exit(1)
+	shutil.rmtree(dbdir)
+
+	print "test%d ok" % (test_iter,)
+
+def test_approximate(test_iter):
+	dbdir = DBDIR + '.approx'
+	if os.path.isdir(dbdir):
+		shutil.rmtree(dbdir)
+	os.mkdir(dbdir)
+
+	db = PageDb.PageDb()
+	if (not db.create(dbdir) or
+	    not db.create_table(DBTABLE, { 'target_blk_sz' : 2048 })):
+		print "create failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+
+	txn = db.txn_begin()
+	for i in xrange(1000):
+		table.put(txn, 'key%04d' % (i,), 'value%06d' % (i,))
+	db.txn_commit(txn)
+	db.checkpoint()
+
+	tablemeta = db.super.tables[DBTABLE]
+	total = sum(tablemeta.block_size(ent.file_id)
+		    for ent in tablemeta.root.v)
+	if (table.approximate_count() != 1000 or
+	    table.approximate_size() != total):
+		print "approximate totals mismatch"
+		sys.exit(1)
+
+	# boundary blocks are searched, so counts are exact here
+	for (start, end, n) in (('key0100', 'key0600', 500),
+				('key0250', 'key0251', 1),
+				('key0250x', 'key0251', 0),
+				(None, 'key0010', 10),
+				('key0990', None, 10),
+				('a', 'b', 0),
+				('z', None, 0)):
+		if table.approximate_count(start, end) != n:
+			print "approximate count mismatch", start, end
+			sys.exit(1)
+	size = table.approximate_size('key0100', 'key0600')
+	if not (0.4 * total < size < 0.6 * total):
+		print "approximate size mismatch"
+		sys.exit(1)
+
+	# memtable contributions
+	txn = db.txn_begin()
+	for i in xrange(20):
+		table.put(txn, 'new%04d' % (i,), 'x' * 10)
+	table.delete(txn, 'key0100')
+	db.txn_commit(txn)
+	if (table.approximate_count('key', 'o') != 1019 or
+	    table.approximate_size('new', 'o') != 20 * 17 or
+	    table.approximate_count('key0100', 'key0600') != 499):
+		print "approximate memtable mismatch"
+		sys.exit(1)
+	db.close()
+
+	# only the boundary blocks are opened; unreadable blocks are
+	# left out, rather than ending the estimate
+	for n in xrange(2):
+		db = PageDb.PageDb()
+		if not db.open(dbdir):
+			print "open failed"
+			sys.exit(1)
+		table = db.open_table(DBTABLE)
+		if n == 0:
+			count = table.approximate_count('key0100', 'key0900')
+			if (count != 799 or
+			    db.stats()['blockmgr']['opens'] != 2):
+				print "approximate opened interior blocks"
+				sys.exit(1)
+			ents = list(table.tablemeta.root.iterate())
+			mid = ents[len(ents) // 2].file_id
+			n_mid = Block.read_trailer(dbdir, mid)[1]
+			db.close()
+			os.rename(dbdir + '/block.%x' % (mid,), dbdir + '/moved')
+			continue
+		if table.approximate_count('key0100', 'key0900') != count - n_mid:
+			print "approximate unreadable block mismatch"
+			sys.exit(1)
+		db.close()
+	shutil.rmtree(dbdir)
+
+	print "test%d ok" % (test_iter,)
+
+def scan_fn(k, v):
+	# module-level, so worker processes can unpickle it
+	if k.endswith('7'):
+		return None
+	return (k, v[:8], len(v))
+
+def test_parallel_scan(test_iter):
+	dbdir = DBDIR + '.pscan'
+	if os.path.isdir(dbdir):
+		shutil.rmtree(dbdir)
+	os.mkdir(dbdir)
+
+	db = PageDb.PageDb()
+	if (not db.create(dbdir) or
+	    not db.create_table(DBTABLE, { 'target_blk_sz' : 2048 })):
+		print "create failed"
+		sys.exit(1)
+	db.set_value_log(200)
+	table = db.open_table(DBTABLE)
+
+	txn = db.txn_begin()
+	for i in xrange(2000):
+		v = 'value%06d' % (i,)
+		if i % 10 == 0:
+			v *= 30
+		table.put(txn, 'key%04d' % (i,), v)
+	db.txn_commit(txn)
+	db.checkpoint()
+
+	# memtable: overwrites, deletes, a range deletion, and keys
+	# before, among and after the blocks'
+	txn = db.txn_begin()
+	table.put(txn, 'key0005', 'new')
+	table.put(txn, 'key1000a', 'new')
+	table.put(txn, 'a', 'new')
+	table.put(txn, 'z', 'new')
+	table.delete(txn, 'key0010')
+	table.delete_range(txn, 'key0500', 'key0700')
+	table.put(txn, 'key0600', 'new')
+	db.txn_commit(txn)
+
+	expect = [scan_fn(k, v) for k, v in table.scan(None)]
+	expect = [r for r in expect if r is not None]
+	for workers in (1, 3):
+		if list(table.parallel_scan(scan_fn, workers)) != expect:
+			print "parallel scan mismatch, %d workers" % (workers,)
+			sys.exit(1)
+	if db.stats()['table']['parallel_scan_parts'] != 4 + 12:
+		print "parallel scan not partitioned"
+		sys.exit(1)
+
+	# the memtable as of the call
+	it = table.parallel_scan(scan_fn, 2)
+	txn = db.txn_begin()
+	table.put(txn, 'key0001', 'later')
+	db.txn_commit(txn)
+	if list(it) != expect:
+		print "parallel scan snapshot mismatch"
+		sys.exit(1)
+
+	# a missing block is an error, not a shorter result
+	file_id = list(table.tablemeta.root.iterate())[-3].file_id
+	os.rename(dbdir + '/block.%x' % (file_id,), dbdir + '/moved')
+	for workers in (1, 3):
+		try:
+			list(table.parallel_scan(scan_fn, workers))
+		except IOError:
+			continue
+		print "parallel scan missed block error, %d workers" % (workers,)
+		sys.exit(1)
+	os.rename(dbdir + '/moved', dbdir + '/block.%x' % (file_id,))
+	db.close()
+	shutil.rmtree(dbdir)
+
+	print "test%d ok" % (test_iter,)
+
+def test_access_hints(test_iter):
+	dbdir = DBDIR + '.advise'
+	if os.path.isdir(dbdir):
+		shutil.rmtree(dbdir)
+	os.mkdir(dbdir)
+
+	db = PageDb.PageDb()
+	if (not db.create(dbdir) or
+	    not db.create_table(DBTABLE, { 'target_blk_sz' : 2048 })):
+		print "create failed"
+		sys.exit(1)
+	table = db.open_table(DBTABLE)
+	txn = db.txn_begin()
+	for i in xrange(2000):
+		table.put(txn, 'key%04d' % (i,), 'value%06d' % (i,))
+	db.txn_commit(txn)
+	db.checkpoint()
+	db.close()
+
+	db = PageDb.PageDb()
+	if not db.open(dbdir):
+		print "open failed"
+		sys.exit(1)
+	db.set_access_hints(True)
+	table = db.open_table(DBTABLE)
+
+	# the mapping address found is the block's
+	block = db.blockmgr.get(table.tablemeta.root.first().file_id)
+	if (Advise.libc is not None and
+	    ctypes.string_at(block.map_addr, 16) != block.map[:16]):
+		print "block map address wrong"
+		sys.exit(1)
+
+	if table.get(None, 'key0100') != 'value000100':
+		print "hinted get failed"
+		sys.exit(1)
+	n = 0
+	for k, v in table.scan(None):
+		if v != 'value%06d' % (int(k[3:]),):
+			print "hinted scan mismatch"
+			sys.exit(1)
+		n += 1
+	if n != 2000:
+		print "hinted scan count"
+		sys.exit(1)
+
+	n_blocks = table.prefetch('key0100', 'key0300')
+	if Advise.libc is not None:
+		st = db.stats()
+		if (st['block']['advise_random'] == 0 or
+		    st['block']['advise_sequential'] == 0 or
+		    st['blockmgr']['prefetches'] < 2 or
+		    n_blocks < 2):
+			print "access hints not counted"
+			sys.exit(1)
+
+	# disabled, blocks are read without hints
+	db.set_access_hints(False)
+	n_hints = dict(db.stats()['block'])
+	if (table.get(None, 'key1999') != 'value001999' or
+	    len(list(table.scan(None))) != 2000):
+		print "unhinted reads failed"
+		sys.exit(1)
+	if db.stats()['block'] != n_hints:
+		print "hints not disabled"
+		sys.exit(1)
+
+	# the setting is per database, and off by default
+	db.set_access_hints(True)
+	db2 = PageDb.PageDb()
+	if not db2.open(DBDIR):
+		print "open failed"
+		sys.exit(1)
+	list(db2.open_table(DBTABLE).scan(None))
+	if 'block' in db2.stats():
+		print "hints on by default:", db2.stats()['block']
+		sys.exit(1)
+	db2.close()
+	db.close()
+	shutil.rmtree(dbdir)
+
+	print "test%d ok" % (test_iter,)
+
 prep()
 test1(1)
 test2(2)
 test3(3)
 test2(4)
+test_scan(5)
+test_stats(6)
+test_slowlog(7)
+test_scrub(8)
+test_get_many(9)
+test_vlog(10)
+test_bufpool(11)
+test_rowcache(12)
+test_manifest(13)
+test_rootpages(14)
+test_memsnap(15)
+test_log_format(16)
+test_get_view(17)
+test_range_delete(18)
+test_blind_delete(19)
+test_block_merge(20)
+test_table_options(21)
+test_backup(22)
+test_replication(23)
+test_changefeed(24)
+test_memtable_limits(25)
+test_uint64_keys(26)
+test_approximate(27)
+test_parallel_scan(28)
+test_access_hints(29)
 
 sys.exit(0)
 
@@ -28,6 +28,16 @@ def tryread(fd, n):
 		return None
 	return data
 
+def trypread(fd, n, pos):
+	# may return fewer than n bytes, at end of file
+	try:
+		if hasattr(os, 'pread'):
+			return os.pread(fd, n, pos)
+		os.lseek(fd, pos, os.SEEK_SET)
+		return os.read(fd, n)
+	except OSError:
+		return None
+
 def trywrite(fd, data):
 	try:
 		bytes = os.write(fd, data)
@@ -37,6 +47,30 @@ def trywrite(fd, data):
 		return False
 	return True
 
+def fsync_dir(dirname):
+	# make file creations, renames and removals in dirname durable
+	try:
+		fd = os.open(dirname, os.O_RDONLY)
+	except OSError:
+		return False
+	try:
+		os.fsync(fd)
+	except OSError:
+		return False
+	finally:
+		os.close(fd)
+	return True
+
+def varint(n):
+	# LEB128: 7 bits per byte, low bits first
+	if n < 0x80:
+		return chr(n)
+	r = ''
+	while n >= 0x80:
+		r += chr((n & 0x7f) | 0x80)
+		n >>= 7
+	return r + chr(n)
+
 def writepb(fd, recname, obj):
 	if len(recname) != 4:
 		return False